@@ -7,3 +7,7 @@ from . import ansible  # noqa: F401
 from . import ipxe  # noqa: F401
 from . import hosts  # noqa: F401
 from . import system  # noqa: F401
+from . import profile  # noqa: F401
+from . import analytics  # noqa: F401
+from . import run  # noqa: F401
+from . import rollout  # noqa: F401
@@ -0,0 +1,29 @@
+from flask import request, jsonify
+import logging
+
+from . import api_bp
+from services.analytics import analytics as install_analytics
+
+
+@api_bp.route('/analytics/installs', methods=['GET'])
+def api_install_analytics():
+    """Install and per-stage durations over ``days``, optionally for one ``version``."""
+    days = request.args.get('days', 30, type=float)
+    version = request.args.get('version') or None
+    try:
+        return jsonify(install_analytics.report(days, version))
+    except Exception as e:
+        logging.error(f'Ошибка при расчёте длительности установок: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+
+
+@api_bp.route('/analytics/outliers', methods=['GET'])
+def api_install_outliers():
+    """Hosts that were or are much slower than the fleet."""
+    days = request.args.get('days', 7, type=float)
+    limit = request.args.get('limit', 50, type=int)
+    try:
+        return jsonify(install_analytics.outliers(days, limit))
+    except Exception as e:
+        logging.error(f'Ошибка при поиске медленных хостов: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
@@ -1,6 +1,8 @@
-from flask import request, jsonify
+from flask import request, jsonify, abort
+from werkzeug.utils import safe_join
 import os
 import subprocess
+import hmac
 import logging
 import re
 
@@ -11,14 +13,25 @@ from config import (
     ANSIBLE_TEMPLATES_DIR,
 )
 from . import api_bp
+from .hosts import run_playbook_async
 from services import (
     list_files_in_dir,
     create_file_api_handlers,
 )
+from services.files import conditional_response
+from services import get_ansible_mark
+from services.marks import MARK_MAX_BYTES, MARK_TOKEN, MarkError, marks, normalize_mark
+from services.inventory import inventory as dynamic_inventory
+from services.run_profiles import DEFAULT_PROFILE, ProfileError, facts, profiles as run_profiles
+from services.listing import lister
+from services import hash_index
 
 
 playbook_get, playbook_post = create_file_api_handlers(
-    lambda: ANSIBLE_PLAYBOOK, name_prefix='playbook'
+    lambda: ANSIBLE_PLAYBOOK,
+    name_prefix='playbook',
+    mimetype='text/plain',
+    strong_etag=True,
 )
 api_bp.route('/ansible/playbook', methods=['GET'])(playbook_get)
 api_bp.route('/ansible/playbook', methods=['POST'])(playbook_post)
@@ -27,27 +40,172 @@ inventory_get, inventory_post = create_file_api_handlers(
     lambda: ANSIBLE_INVENTORY,
     allow_missing_get=True,
     name_prefix='inventory',
+    mimetype='text/plain',
+    strong_etag=True,
 )
 api_bp.route('/ansible/inventory', methods=['GET'])(inventory_get)
 api_bp.route('/ansible/inventory', methods=['POST'])(inventory_post)
 
 
+@api_bp.route('/ansible/dynamic-inventory', methods=['GET'])
+def api_dynamic_inventory():
+    """Inventory in the dynamic inventory script format (``--list``)."""
+    try:
+        data, etag = dynamic_inventory.snapshot()
+    except Exception as e:
+        logging.error(f'Ошибка построения динамического инвентаря: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    return conditional_response(data, etag, mimetype='application/json')
+
+
+def _mark_token_ok() -> bool:
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else request.headers.get('X-Mark-Token', '')
+    return hmac.compare_digest(token.encode(), MARK_TOKEN.encode())
+
+
+@api_bp.route('/ansible/mark', methods=['POST'])
+def api_push_ansible_mark():
+    """Accept ``ansible_mark.json`` pushed by a host at the end of its run."""
+    if not MARK_TOKEN:
+        return jsonify({'status': 'error', 'msg': 'ANSIBLE_MARK_TOKEN is not set'}), 403
+    if not _mark_token_ok():
+        return jsonify({'status': 'error', 'msg': 'invalid token'}), 401
+    if (request.content_length or 0) > MARK_MAX_BYTES:
+        return jsonify({'status': 'error', 'msg': 'mark too large'}), 413
+    data = request.get_json(silent=True)
+    try:
+        data = normalize_mark(data)
+    except MarkError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 400
+    ip = data.pop('ip', None) or request.remote_addr
+    if not isinstance(ip, str) or not re.match(r'^\d{1,3}(\.\d{1,3}){3}$', ip):
+        return jsonify({'status': 'error', 'msg': 'invalid ip'}), 400
+    try:
+        mark = marks.store(ip, data, 'push')
+    except Exception as e:
+        logging.error(f'Ошибка сохранения отметки Ansible для {ip}: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    logging.info(f'Получена отметка Ansible от {ip}: {mark["status"]}')
+    return jsonify({'status': 'ok', 'ip': ip, 'received': mark['received']})
+
+
+@api_bp.route('/ansible/mark/<ip>', methods=['GET'])
+def api_get_ansible_mark(ip):
+    """Mark of *ip*: pushed, cached, or read over SSH after the push deadline."""
+    return jsonify(get_ansible_mark(ip))
+
+
+@api_bp.route('/ansible/run', methods=['POST'])
+def api_ansible_run():
+    """Queue a playbook run for ``ip`` with an optional run ``profile``."""
+    data = request.get_json(silent=True) or {}
+    ip = data.get('ip')
+    if not ip:
+        return jsonify({'status': 'error', 'msg': 'ip required'}), 400
+    try:
+        run_playbook_async(ip, data.get('profile') or None)
+    except ProfileError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 400
+    return jsonify({'status': 'ok', 'ip': ip}), 202
+
+
+@api_bp.route('/ansible/profiles', methods=['GET'])
+def api_ansible_profiles():
+    return jsonify({
+        'default': DEFAULT_PROFILE,
+        'profiles': run_profiles.profiles(),
+        'groups': run_profiles.groups(),
+    })
+
+
+@api_bp.route('/ansible/profiles/stats', methods=['GET'])
+def api_ansible_profile_stats():
+    """Playbook run durations per profile over ``days``."""
+    days = request.args.get('days', 30, type=float)
+    try:
+        return jsonify(run_profiles.stats(days))
+    except Exception as e:
+        logging.error(f'Ошибка при расчёте длительности запусков playbook: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+
+
+@api_bp.route('/ansible/profiles/<name>', methods=['POST'])
+def api_ansible_profile_save(name):
+    """Create or replace profile *name*; see :func:`services.run_profiles.validate_profile`."""
+    try:
+        profile = run_profiles.save(name, request.get_json(silent=True))
+    except ProfileError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 400
+    logging.info(f'Профиль запуска {name} сохранён')
+    return jsonify({'status': 'ok', 'name': name, 'profile': profile})
+
+
+@api_bp.route('/ansible/profiles/<name>', methods=['DELETE'])
+def api_ansible_profile_delete(name):
+    try:
+        if not run_profiles.delete(name):
+            return jsonify({'status': 'error', 'msg': 'not found'}), 404
+    except ProfileError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 409
+    return jsonify({'status': 'ok'})
+
+
+@api_bp.route('/ansible/profile-groups', methods=['POST'])
+def api_ansible_profile_group():
+    """Use ``profile`` for runs of hosts in inventory ``group``; empty unmaps it."""
+    data = request.get_json(silent=True) or {}
+    group = data.get('group')
+    if not group:
+        return jsonify({'status': 'error', 'msg': 'group required'}), 400
+    if data.get('profile'):
+        try:
+            dynamic_inventory.select((), group)
+        except KeyError:
+            return jsonify({'status': 'error', 'msg': f'unknown group {group}'}), 404
+    try:
+        run_profiles.set_group(group, data.get('profile') or '')
+    except ProfileError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 400
+    return jsonify({'status': 'ok', 'groups': run_profiles.groups()})
+
+
+@api_bp.route('/ansible/facts', methods=['GET'])
+def api_ansible_facts():
+    """Hosts in the managed fact cache and the age of their facts."""
+    return jsonify({'ttl': facts.ttl, 'hosts': facts.hosts()})
+
+
+@api_bp.route('/ansible/facts/<host>', methods=['DELETE'])
+def api_ansible_facts_delete(host):
+    return jsonify({'status': 'ok', 'removed': facts.invalidate(host)})
+
+
 def get_file_path(filename: str) -> str:
-    return os.path.join(ANSIBLE_FILES_DIR, filename)
+    path = safe_join(ANSIBLE_FILES_DIR, filename)
+    if path is None:
+        abort(404)
+    return path
 
 
 def get_template_path(filename: str) -> str:
-    return os.path.join(ANSIBLE_TEMPLATES_DIR, filename)
+    path = safe_join(ANSIBLE_TEMPLATES_DIR, filename)
+    if path is None:
+        abort(404)
+    return path
 
 
 file_get, file_post = create_file_api_handlers(
-    get_file_path, name_prefix='file'
+    get_file_path, name_prefix='file', digest_lookup=hash_index.lookup_digest
 )
 api_bp.route('/ansible/files/<path:filename>', methods=['GET'])(file_get)
 api_bp.route('/ansible/files/<path:filename>', methods=['POST'])(file_post)
 
 template_get, template_post = create_file_api_handlers(
-    get_template_path, name_prefix='template'
+    get_template_path,
+    name_prefix='template',
+    mimetype='text/plain',
+    strong_etag=True,
 )
 api_bp.route('/ansible/templates/<path:filename>', methods=['GET'])(template_get)
 api_bp.route('/ansible/templates/<path:filename>', methods=['POST'])(template_post)
@@ -55,20 +213,75 @@ api_bp.route('/ansible/templates/<path:filename>', methods=['POST'])(template_po
 
 @api_bp.route('/ansible/files', methods=['GET'])
 def api_ansible_files_list():
+    """List a directory of the offline files tree.
+
+    Supports ``sort`` (name, size, modified), ``order`` (asc, desc), ``q``
+    name filter, ``limit`` with ``cursor`` pagination and ``totals=1`` for
+    recursive directory sizes.
+    """
     rel_path = request.args.get('path', '').strip()
     base_dir = os.path.abspath(ANSIBLE_FILES_DIR)
     target_dir = os.path.abspath(os.path.join(base_dir, rel_path))
-    if not target_dir.startswith(base_dir):
+    if target_dir != base_dir and not target_dir.startswith(base_dir + os.sep):
         return jsonify({'error': 'Invalid path'}), 400
+    limit = min(request.args.get('limit', default=500, type=int), 5000)
     try:
-        files = list_files_in_dir(target_dir)
-        parent = os.path.relpath(os.path.dirname(target_dir), base_dir) if rel_path else ''
-        if parent == '.':
-            parent = ''
-        return jsonify({'files': files, 'path': rel_path, 'parent': parent})
+        os.makedirs(target_dir, exist_ok=True)
+        listing = lister.page(
+            target_dir,
+            sort=request.args.get('sort', 'name'),
+            order=request.args.get('order', 'asc'),
+            query=request.args.get('q', '').strip(),
+            cursor=request.args.get('cursor', ''),
+            limit=limit,
+            with_totals=request.args.get('totals') == '1',
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logging.error(f"Ошибка при получении списка файлов из {target_dir}: {e}")
         return jsonify({'error': str(e)}), 500
+    parent = os.path.relpath(os.path.dirname(target_dir), base_dir) if rel_path else ''
+    if parent == '.':
+        parent = ''
+    listing.update({'path': rel_path, 'parent': parent})
+    return jsonify(listing)
+
+
+@api_bp.route('/ansible/files-index', methods=['GET'])
+def api_files_index_status():
+    try:
+        return jsonify(hash_index.index_status())
+    except Exception as e:
+        logging.error(f'Ошибка при получении состояния индекса файлов: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+
+
+@api_bp.route('/ansible/files-index', methods=['POST'])
+def api_files_index_update():
+    """Start incremental re-hashing of new and changed files."""
+    if not hash_index.start_update():
+        return jsonify({'status': 'error', 'msg': 'update already running'}), 409
+    return jsonify({'status': 'started'}), 202
+
+
+@api_bp.route('/ansible/files-index/verify', methods=['GET'])
+def api_files_index_verify():
+    deep = request.args.get('deep') == '1'
+    try:
+        return jsonify(hash_index.verify_tree(deep=deep))
+    except Exception as e:
+        logging.error(f'Ошибка проверки файлов: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+
+
+@api_bp.route('/ansible/files-index/duplicates', methods=['GET'])
+def api_files_index_duplicates():
+    try:
+        return jsonify({'duplicates': hash_index.find_duplicates()})
+    except Exception as e:
+        logging.error(f'Ошибка поиска дубликатов: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
 
 
 @api_bp.route('/ansible/templates', methods=['GET'])
@@ -79,6 +292,37 @@ def api_ansible_templates_list():
         logging.error(f"Ошибка при получении списка шаблонов: {e}")
         return jsonify({'error': str(e)}), 500
 
+
+def colorize_ansible_line(line: str) -> str:
+    """Return *line* of the ansible-api journal marked up as HTML."""
+    line = f'<span style="font-size:14px;line-height:1.5">{line}</span>'
+    line = line.replace('INFO', '<span style="color:#51cf66; font-weight:bold">INFO</span>')
+    line = line.replace('WARNING', '<span style="color:#ffa94d; font-weight:bold">WARNING</span>')
+    line = line.replace('ERROR', '<span style="color:#ff6b6b; font-weight:bold">ERROR</span>')
+    line = line.replace('CRITICAL', '<span style="color:#ff375f; background:#ffccd5; font-weight:bold">CRITICAL</span>')
+    line = line.replace(' 200 ', '<span style="color:#51cf66; font-weight:bold"> 200 </span>')
+    line = line.replace(' 404 ', '<span style="color:#ff6b6b; font-weight:bold"> 404 </span>')
+    line = line.replace(' 500 ', '<span style="color:#ff375f; background:#ffccd5; font-weight:bold"> 500 </span>')
+    line = line.replace('GET', '<span style="color:#9775fa; font-weight:bold">GET</span>')
+    line = line.replace('POST', '<span style="color:#9775fa; font-weight:bold">POST</span>')
+    line = re.sub(
+        r'([0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5})',
+        r'<span style="color:#0ca678; font-weight:bold; font-family:monospace">\1</span>',
+        line,
+    )
+    line = re.sub(
+        r'\b(?:\d{1,3}\.){3}\d{1,3}\b',
+        r'<span style="color:#087f5b; font-weight:bold; font-family:monospace">\g<0></span>',
+        line,
+    )
+    line = re.sub(
+        r'(\w{3} \d{1,2} \d{2}:\d{2}:\d{2})',
+        r'<span style="color:#adb5bd">\1</span>',
+        line,
+    )
+    return line
+
+
 @api_bp.route('/logs/ansible', methods=['GET'])
 def api_logs_ansible():
     """Return colored ansible service logs with optional pagination."""
@@ -105,34 +349,7 @@ def api_logs_ansible():
         for line in lines:
             if not any(keyword in line for keyword in filter_keywords):
                 filtered_lines.append(line)
-        colored_lines = []
-        for line in filtered_lines:
-            line = f'<span style="font-size:14px;line-height:1.5">{line}</span>'
-            line = line.replace('INFO', '<span style="color:#51cf66; font-weight:bold">INFO</span>')
-            line = line.replace('WARNING', '<span style="color:#ffa94d; font-weight:bold">WARNING</span>')
-            line = line.replace('ERROR', '<span style="color:#ff6b6b; font-weight:bold">ERROR</span>')
-            line = line.replace('CRITICAL', '<span style="color:#ff375f; background:#ffccd5; font-weight:bold">CRITICAL</span>')
-            line = line.replace(' 200 ', '<span style="color:#51cf66; font-weight:bold"> 200 </span>')
-            line = line.replace(' 404 ', '<span style="color:#ff6b6b; font-weight:bold"> 404 </span>')
-            line = line.replace(' 500 ', '<span style="color:#ff375f; background:#ffccd5; font-weight:bold"> 500 </span>')
-            line = line.replace('GET', '<span style="color:#9775fa; font-weight:bold">GET</span>')
-            line = line.replace('POST', '<span style="color:#9775fa; font-weight:bold">POST</span>')
-            line = re.sub(
-                r'([0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5})',
-                r'<span style="color:#0ca678; font-weight:bold; font-family:monospace">\1</span>',
-                line,
-            )
-            line = re.sub(
-                r'\b(?:\d{1,3}\.){3}\d{1,3}\b',
-                r'<span style="color:#087f5b; font-weight:bold; font-family:monospace">\g<0></span>',
-                line,
-            )
-            line = re.sub(
-                r'(\w{3} \d{1,2} \d{2}:\d{2}:\d{2})',
-                r'<span style="color:#adb5bd">\1</span>',
-                line,
-            )
-            colored_lines.append(line)
+        colored_lines = [colorize_ansible_line(line) for line in filtered_lines]
         window = colored_lines[-(limit + offset):]
         if offset:
             window = window[:-offset]
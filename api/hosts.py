@@ -1,58 +1,29 @@
 from flask import request, jsonify
+import datetime
+import os
 import subprocess
 import logging
-import threading
+import time
 import re
 
 from config import (
-    SSH_PASSWORD,
-    SSH_USER,
     ANSIBLE_PLAYBOOK,
     ANSIBLE_INVENTORY,
 )
 from . import api_bp
 from services.registration import register_host
+from services.power import PowerError, get_ssh_credentials, reboot, wake
+from services.playbooks import queue as playbook_queue
+from services.run_profiles import (
+    FACT_CACHE_DIR,
+    FACT_CACHE_ENABLED,
+    profile_env,
+    profiles as run_profiles,
+)
+from services.hosts import registry as host_registry
+from services.inventory import USE_DYNAMIC_INVENTORY, inventory as dynamic_inventory
 from services import set_playbook_status
-
-
-def get_ssh_credentials(ip: str) -> tuple[str, str]:
-    """Return SSH user and password for *ip* from Ansible inventory.
-
-    Falls back to ``SSH_USER`` and ``SSH_PASSWORD`` if the inventory does not
-    contain specific credentials for the host. Inventory lines are expected to
-    be in the form ``host var1=value1 var2=value2``.
-    """
-    user = SSH_USER
-    password = SSH_PASSWORD
-    try:
-        with open(ANSIBLE_INVENTORY) as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#') or line.startswith('['):
-                    continue
-                parts = line.split()
-                host = parts[0]
-                if host == ip:
-                    vars_dict = {
-                        k: v
-                        for k, v in (
-                            p.split('=', 1) for p in parts[1:] if '=' in p
-                        )
-                    }
-                    user = vars_dict.get('ansible_user', user)
-                    password = (
-                        vars_dict.get('ansible_password')
-                        or vars_dict.get('ansible_ssh_pass')
-                        or password
-                    )
-                    break
-    except FileNotFoundError:
-        logging.warning(
-            f'Inventory file {ANSIBLE_INVENTORY} not found when looking up {ip}'
-        )
-    except Exception as e:
-        logging.error(f'Error reading inventory {ANSIBLE_INVENTORY}: {e}')
-    return user, password
+from services.metrics import PLAYBOOK_RUNS, PLAYBOOK_SECONDS, ssh_call
 
 
 def parse_playbook_summary(output: str) -> dict[str, str]:
@@ -100,19 +71,42 @@ def parse_playbook_summary(output: str) -> dict[str, str]:
     return result
 
 
-def run_playbook_async(ip: str) -> None:
-    """Запустить ansible-playbook в фоне и обновить статус в БД."""
-    set_playbook_status(ip, 'running')
+def run_playbook_async(ip: str, profile: str = None) -> None:
+    """Поставить ansible-playbook в очередь и обновить статус в БД.
+
+    Статус ``queued`` ставится сразу, ``running`` — когда освобождается слот.
+
+    *profile* выбирает профиль запуска (см. :mod:`services.run_profiles`);
+    без него берётся профиль группы хоста или профиль по умолчанию.
+
+    Raises:
+        ProfileError: если профиль *profile* не существует.
+    """
+    profile_name, settings = run_profiles.resolve(ip, profile)
 
     def worker():
+        set_playbook_status(ip, 'running')
+        inventory = ANSIBLE_INVENTORY
+        if USE_DYNAMIC_INVENTORY:
+            try:
+                inventory = dynamic_inventory.file()
+            except Exception as e:
+                logging.error(f'Динамический инвентарь недоступен, используется {inventory}: {e}')
         cmd = [
             "ansible-playbook",
             ANSIBLE_PLAYBOOK,
             "-i",
-            ANSIBLE_INVENTORY,
+            inventory,
         ]
+        env = dict(os.environ, **profile_env(settings))
+        if FACT_CACHE_ENABLED:
+            os.makedirs(FACT_CACHE_DIR, exist_ok=True)
+        started_at = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        started = time.monotonic()
+        outcome = 'error'
         try:
-            proc = subprocess.run(cmd, capture_output=True, text=True)
+            proc = subprocess.run(cmd, capture_output=True, text=True, env=env)
+            outcome = 'ok' if proc.returncode == 0 else 'failed'
             summary = parse_playbook_summary(proc.stdout + '\n' + proc.stderr)
             if summary:
                 for host_ip, status in summary.items():
@@ -126,8 +120,21 @@ def run_playbook_async(ip: str) -> None:
         except Exception as e:
             logging.error(f'Ошибка выполнения playbook: {e}')
             set_playbook_status(ip, 'failed')
-
-    threading.Thread(target=worker, daemon=True).start()
+        finally:
+            seconds = time.monotonic() - started
+            PLAYBOOK_RUNS.inc(outcome)
+            PLAYBOOK_SECONDS.observe(seconds, outcome)
+            try:
+                run_profiles.record(ip, profile_name, started_at, seconds, outcome)
+            except Exception as e:
+                logging.error(f'Не удалось сохранить длительность playbook: {e}')
+
+    # Before submit: the worker may take a free slot and set 'running' at once
+    set_playbook_status(ip, 'queued')
+    if not playbook_queue.submit(ip, worker):
+        logging.info(f'Playbook для {ip} уже в очереди, профиль {profile_name}')
+    else:
+        logging.info(f'Playbook для {ip} поставлен в очередь, профиль {profile_name}')
 
 
 @api_bp.route('/register', methods=['GET', 'POST'])
@@ -151,6 +158,29 @@ def api_register():
     return 'OK', 200
 
 
+@api_bp.route('/host-state', methods=['GET'])
+def api_host_state():
+    """Hosts from the in-memory registry, filtered by ``mac``, ``ip`` or ``stage``."""
+    mac = request.args.get('mac', '').lower()
+    ip = request.args.get('ip', '')
+    stage = request.args.get('stage')
+    if mac:
+        record = host_registry.get(mac)
+        records = [record] if record is not None else []
+    elif ip:
+        records = host_registry.by_ip(ip)
+    elif stage is not None:
+        records = host_registry.by_stage(stage)
+    else:
+        records = host_registry.all()
+    now = time.time()
+    return jsonify({
+        'version': host_registry.version,
+        'stages': host_registry.stages(),
+        'hosts': [host_registry.view(r, now) for r in records],
+    })
+
+
 @api_bp.route('/host/reboot', methods=['POST'])
 def api_host_reboot():
     data = request.get_json()
@@ -158,31 +188,7 @@ def api_host_reboot():
     if not ip or ip == '—':
         return jsonify({'status': 'error', 'msg': 'Неверный IP-адрес'}), 400
     try:
-        user, password = get_ssh_credentials(ip)
-        cmd = (
-            f"sshpass -p '{password}' ssh -o StrictHostKeyChecking=no "
-            f"-o UserKnownHostsFile=/dev/null {user}@{ip} "
-            "\"nohup sh -c 'sleep 2 && reboot' >/dev/null 2>&1 &\""
-        )
-        subprocess.run(
-            cmd, shell=True, check=True, timeout=10, capture_output=True, text=True
-        )
-        logging.info(f'Команда перезагрузки отправлена на {ip}')
-        return (
-            jsonify({'status': 'ok', 'msg': f'Команда перезагрузки отправлена на {ip}'}),
-            200,
-        )
-    except subprocess.TimeoutExpired as e:
-        msg = f'Команда перезагрузки отправлена на {ip} (таймаут ожидания ответа)'
-        logging.warning(msg + f" | Stderr: {e.stderr if e.stderr else 'N/A'}")
-        return jsonify({'status': 'ok', 'msg': msg}), 200
-    except subprocess.CalledProcessError as e:
-        msg = f'Команда перезагрузки отправлена на {ip} (возможна ошибка SSH)'
-        detailed_msg = f"{msg}. Код ошибки SSH: {e.returncode}"
-        if e.stderr:
-            detailed_msg += f". Вывод SSH: {e.stderr.strip()}"
-        logging.warning(detailed_msg)
-        return jsonify({'status': 'ok', 'msg': msg}), 200
+        return jsonify({'status': 'ok', 'msg': reboot(ip)}), 200
     except Exception as e:
         msg = f'Неизвестная ошибка при отправке команды перезагрузки на {ip}: {e}'
         logging.error(msg)
@@ -196,17 +202,10 @@ def api_host_wol():
     if not mac or mac == '—':
         return jsonify({'status': 'error', 'msg': 'Неверный MAC-адрес'}), 400
     try:
-        subprocess.run(['wakeonlan', mac], capture_output=True, text=True, check=True)
-        logging.info(f'Wake-on-LAN пакет отправлен на {mac}')
-        return jsonify({'status': 'ok', 'msg': f'Wake-on-LAN пакет отправлен на {mac}.'}), 200
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Ошибка выполнения wakeonlan: {e.stderr.strip() if e.stderr else str(e)}"
-        logging.error(error_msg)
-        return jsonify({'status': 'error', 'msg': error_msg}), 500
-    except FileNotFoundError:
-        error_msg = "Команда 'wakeonlan' не найдена. Установите пакет 'wakeonlan'."
-        logging.error(error_msg)
-        return jsonify({'status': 'error', 'msg': error_msg}), 500
+        return jsonify({'status': 'ok', 'msg': wake(mac)}), 200
+    except PowerError as e:
+        logging.error(str(e))
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
     except Exception as e:
         error_msg = f"Внутренняя ошибка сервера: {str(e)}"
         logging.error(error_msg, exc_info=True)
@@ -226,9 +225,10 @@ def api_host_shutdown():
             f"-o UserKnownHostsFile=/dev/null {user}@{ip} "
             "\"shutdown -r +1\""
         )
-        result = subprocess.run(
-            cmd, shell=True, check=True, timeout=10, capture_output=True, text=True
-        )
+        with ssh_call('shutdown'):
+            result = subprocess.run(
+                cmd, shell=True, check=True, timeout=10, capture_output=True, text=True
+            )
         logging.info(f'Команда выключения отправлена на {ip}')
         msg = f'Команда выключения отправлена на {ip}'
         if result.stderr:
@@ -1,4 +1,4 @@
-from flask import request, jsonify
+from flask import request, jsonify, url_for
 import subprocess
 import logging
 
@@ -8,11 +8,35 @@ from config import (
     DNSMASQ_PATH,
     BOOT_IPXE_PATH,
     AUTOEXEC_IPXE_PATH,
+    BOOT_ARTIFACTS_DIR,
 )
 from . import api_bp
-from services import read_file, write_file
+from services import write_file
+from services.files import (
+    file_etag,
+    read_file_versioned,
+    combine_etags,
+    conditional_response,
+    versioned_text_response,
+    not_modified,
+    if_match_failed,
+    write_lock,
+)
 import os
 import shutil
+from jinja2 import TemplateNotFound, TemplateError
+
+from services.preseed import (
+    normalize_mac,
+    host_vars,
+    default_template_name,
+    render_preseed,
+)
+from services.boot import BOOT_ACTIONS, boot_script, state as boot_state
+from services.artifacts import cache as artifact_cache, downloads as artifact_downloads
+from services.hosts import registry as host_registry
+from services.rollout import controller as rollouts
+from services import dhcp
 
 
 def _preseed_file_path(name: str) -> str:
@@ -42,7 +66,10 @@ def api_preseed_get():
     if not name:
         return '', 404
     path = _preseed_file_path(name)
-    return read_file(path), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    try:
+        return versioned_text_response(path)
+    except FileNotFoundError:
+        return '', 404
 
 
 @api_bp.route('/preseed', methods=['POST'])
@@ -53,13 +80,48 @@ def api_preseed_post():
     body = request.get_data(as_text=True)
     try:
         path = _preseed_file_path(name)
-        write_file(path, body)
-        return jsonify({'status': 'ok'}), 200
+        with write_lock:
+            if if_match_failed(file_etag(path)):
+                return jsonify({'status': 'error', 'msg': 'file was modified'}), 412
+            write_file(path, body)
+        return jsonify({'status': 'ok', 'etag': file_etag(path)}), 200
     except IOError as e:
         logging.error(f'Ошибка при записи preseed файла: {e}')
         return jsonify({'status': 'error', 'msg': str(e)}), 500
 
 
+@api_bp.route('/preseed/render', methods=['GET'])
+@api_bp.route('/preseed/render/<mac>', methods=['GET'])
+def api_preseed_render(mac=None):
+    """Render preseed for the host with *mac* (path or ``mac`` argument).
+
+    The template is chosen by the ``template`` argument, the host's
+    ``preseed_template`` inventory variable or the active preseed.
+    """
+    mac = normalize_mac(mac or request.args.get('mac', ''))
+    if not mac:
+        return 'Invalid MAC', 400
+    try:
+        vars = host_vars(mac, request.args.get('ip') or request.remote_addr)
+        name = (
+            request.args.get('template')
+            or vars.get('preseed_template')
+            or default_template_name()
+        )
+        if not name:
+            return '', 404
+        body = render_preseed(name, vars)
+    except TemplateNotFound:
+        return '', 404
+    except TemplateError as e:
+        logging.error(f'Ошибка при формировании preseed для {mac}: {e}')
+        return f'Ошибка шаблона: {e}', 500
+    except Exception as e:
+        logging.error(f'Ошибка при формировании preseed для {mac}: {e}')
+        return 'Ошибка', 500
+    return body, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
 @api_bp.route('/preseed/create', methods=['POST'])
 def api_preseed_create():
     data = request.get_json(force=True)
@@ -123,13 +185,27 @@ def api_preseed_delete():
         return jsonify({'status': 'error', 'msg': str(e)}), 500
 
 
+def _ipxe_etag() -> str:
+    return combine_etags(file_etag(BOOT_IPXE_PATH), file_etag(AUTOEXEC_IPXE_PATH))
+
+
 @api_bp.route('/ipxe', methods=['GET'])
 def api_ipxe_get():
     try:
-        boot_content = read_file(BOOT_IPXE_PATH)
-        autoexec_content = read_file(AUTOEXEC_IPXE_PATH)
-        combined = f"### boot.ipxe ###\n{boot_content}\n### autoexec.ipxe ###\n{autoexec_content}"
-        return combined, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        cached = not_modified(_ipxe_etag())
+        if cached is not None:
+            return cached
+        boot_content, boot_etag, boot_mtime = read_file_versioned(BOOT_IPXE_PATH)
+        autoexec_content, autoexec_etag, autoexec_mtime = read_file_versioned(AUTOEXEC_IPXE_PATH)
+        combined = (
+            f"### boot.ipxe ###\n{boot_content.decode('utf-8')}"
+            f"\n### autoexec.ipxe ###\n{autoexec_content.decode('utf-8')}"
+        )
+        return conditional_response(
+            combined,
+            combine_etags(boot_etag, autoexec_etag),
+            max(boot_mtime, autoexec_mtime),
+        )
     except Exception as e:
         logging.error(f'Ошибка при чтении iPXE файлов: {e}')
         return 'Ошибка', 500
@@ -144,28 +220,122 @@ def api_ipxe_post():
             raise ValueError('Неверный формат данных')
         boot_content = parts[0].replace('### boot.ipxe ###\n', '', 1)
         autoexec_content = parts[1]
-        write_file(BOOT_IPXE_PATH, boot_content)
-        write_file(AUTOEXEC_IPXE_PATH, autoexec_content)
+        with write_lock:
+            if if_match_failed(_ipxe_etag()):
+                return jsonify({'status': 'error', 'msg': 'file was modified'}), 412
+            write_file(BOOT_IPXE_PATH, boot_content)
+            write_file(AUTOEXEC_IPXE_PATH, autoexec_content)
         logging.info('Файлы boot.ipxe и autoexec.ipxe обновлены')
-        return jsonify({'status': 'ok'}), 200
+        return jsonify({'status': 'ok', 'etag': _ipxe_etag()}), 200
     except Exception as e:
         logging.error(f'Ошибка при сохранении iPXE файлов: {e}')
         return jsonify({'status': 'error', 'msg': str(e)}), 500
 
 
+@api_bp.route('/ipxe/boot', methods=['GET'])
+def api_ipxe_boot():
+    """Return iPXE script for the host chainloading with ``?mac=${mac}&ip=${ip}``."""
+    mac = normalize_mac(request.args.get('mac', ''))
+    ip = request.args.get('ip') or request.remote_addr
+    preseed_url = url_for('api.api_preseed_render', mac=mac, _external=True) if mac else ''
+    action, script = boot_script(
+        mac, ip, preseed_url,
+        hold=bool(mac) and rollouts.holds(mac),
+        boot_path=url_for('api.api_ipxe_boot'),
+    )
+    return script, 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Cache-Control': 'no-store',
+        'X-Boot-Action': action,
+    }
+
+
+@api_bp.route('/ipxe/boot-action', methods=['GET'])
+def api_ipxe_boot_action_list():
+    return jsonify(boot_state.actions())
+
+
+@api_bp.route('/ipxe/boot-action', methods=['POST'])
+def api_ipxe_boot_action_set():
+    """Set one-shot boot action ``{"mac": ..., "action": ...}`` for the next boot."""
+    data = request.get_json(force=True, silent=True) or {}
+    mac = normalize_mac(data.get('mac', ''))
+    action = data.get('action', '')
+    if not mac:
+        return jsonify({'status': 'error', 'msg': 'mac required'}), 400
+    if action not in BOOT_ACTIONS:
+        return jsonify({'status': 'error', 'msg': f'action must be one of {", ".join(BOOT_ACTIONS)}'}), 400
+    try:
+        boot_state.set_action(mac, action)
+    except Exception as e:
+        logging.error(f'Ошибка при сохранении действия загрузки для {mac}: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    logging.info(f'Для {mac} назначена загрузка: {action}')
+    return jsonify({'status': 'ok'}), 200
+
+
+@api_bp.route('/ipxe/boot-action', methods=['DELETE'])
+def api_ipxe_boot_action_clear():
+    data = request.get_json(force=True, silent=True) or {}
+    mac = normalize_mac(data.get('mac', ''))
+    if not mac:
+        return jsonify({'status': 'error', 'msg': 'mac required'}), 400
+    try:
+        found = boot_state.clear_action(mac)
+    except Exception as e:
+        logging.error(f'Ошибка при удалении действия загрузки для {mac}: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    return jsonify({'status': 'ok' if found else 'not_found'}), 200
+
+
+@api_bp.route('/boot/downloads', methods=['GET'])
+def api_boot_downloads():
+    """Per-host boot artifact downloads, most recently active first."""
+    clients = artifact_downloads.snapshot()
+    if clients:
+        for c in clients:
+            c['mac'] = c['client'] if normalize_mac(c['client']) else host_registry.mac_for_ip(c['ip'])
+    clients.sort(key=lambda c: c['last_activity'], reverse=True)
+    return jsonify({
+        'enabled': bool(BOOT_ARTIFACTS_DIR),
+        'cache': artifact_cache.info(),
+        'clients': clients,
+    })
+
+
 @api_bp.route('/dnsmasq', methods=['GET'])
 def api_dnsmasq_get():
-    return read_file(DNSMASQ_PATH), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    try:
+        return versioned_text_response(DNSMASQ_PATH)
+    except FileNotFoundError:
+        return '', 404
 
 
 @api_bp.route('/dnsmasq', methods=['POST'])
 def api_dnsmasq_post():
+    """Save ``dnsmasq.conf``; dnsmasq is restarted only if settings changed."""
     body = request.get_data(as_text=True)
     try:
-        write_file(DNSMASQ_PATH, body)
-        subprocess.run(['sudo', 'systemctl', 'restart', 'dnsmasq'], check=True)
-        logging.info('dnsmasq.conf обновлён и dnsmasq перезапущен')
-        return jsonify({'status': 'ok'}), 200
+        with write_lock:
+            if if_match_failed(file_etag(DNSMASQ_PATH)):
+                return jsonify({'status': 'error', 'msg': 'file was modified'}), 412
+            try:
+                with open(DNSMASQ_PATH, encoding='utf-8') as f:
+                    old = f.read()
+            except FileNotFoundError:
+                old = ''
+            write_file(DNSMASQ_PATH, body)
+        restarted = dhcp.config_changed(old, body)
+        if restarted:
+            dhcp.restart_dnsmasq()
+            logging.info('dnsmasq.conf обновлён и dnsmasq перезапущен')
+        else:
+            logging.info('dnsmasq.conf обновлён без изменения настроек, перезапуск не нужен')
+        return jsonify({
+            'status': 'ok',
+            'etag': file_etag(DNSMASQ_PATH),
+            'restarted': restarted,
+        }), 200
     except subprocess.CalledProcessError as e:
         logging.error(f'Ошибка при сохранении dnsmasq.conf: {e}')
         msg = f"Ошибка выполнения команды: {e}"
@@ -175,3 +345,55 @@ def api_dnsmasq_post():
     except Exception as e:
         logging.error(f'Неизвестная ошибка при сохранении dnsmasq.conf: {e}')
         return jsonify({'status': 'error', 'msg': str(e)}), 500
+
+
+@api_bp.route('/dhcp/reservations', methods=['GET'])
+def api_dhcp_reservations():
+    return jsonify({
+        'reservations': dhcp.collect_reservations(),
+        'stats': dhcp.applier.stats,
+    })
+
+
+@api_bp.route('/dhcp/reservations', methods=['POST'])
+def api_dhcp_reservation_set():
+    """Add or update ``{"mac", "ip", "hostname", "options"}``; applied with a reload."""
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        dhcp.set_reservation(
+            data.get('mac', ''),
+            (data.get('ip') or '').strip(),
+            (data.get('hostname') or '').strip(),
+            data.get('options') or [],
+        )
+    except ValueError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 400
+    except Exception as e:
+        logging.error(f'Ошибка при сохранении DHCP-резервации: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    return jsonify({'status': 'ok'}), 200
+
+
+@api_bp.route('/dhcp/reservations', methods=['DELETE'])
+def api_dhcp_reservation_delete():
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        found = dhcp.delete_reservation(data.get('mac', ''))
+    except Exception as e:
+        logging.error(f'Ошибка при удалении DHCP-резервации: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    return jsonify({'status': 'ok' if found else 'not_found'}), 200
+
+
+@api_bp.route('/dhcp/apply', methods=['POST'])
+def api_dhcp_apply():
+    """Render reservation files and reload dnsmasq immediately."""
+    try:
+        changed = dhcp.applier.apply()
+    except subprocess.CalledProcessError as e:
+        logging.error(f'Ошибка перезагрузки dnsmasq: {e}')
+        return jsonify({'status': 'error', 'msg': f'Ошибка выполнения команды: {e}'}), 500
+    except Exception as e:
+        logging.error(f'Ошибка применения DHCP-резерваций: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    return jsonify({'status': 'ok', 'changed': changed}), 200
@@ -0,0 +1,85 @@
+from flask import request, jsonify, Response, current_app
+import logging
+
+from . import api_bp
+from services.profiling import profiler
+from tasks.scheduler import scheduler
+
+
+@api_bp.route('/profile/latency', methods=['GET'])
+def api_profile_latency():
+    """Latency percentiles per endpoint over the rolling window."""
+    return jsonify(profiler.latency.snapshot())
+
+
+@api_bp.route('/profile', methods=['GET'])
+def api_profile_status():
+    session = profiler.session
+    return jsonify({
+        'session': session.info() if session else None,
+        'top': profiler.top(int(request.args.get('limit', 30))) if session else '',
+    })
+
+
+@api_bp.route('/profile', methods=['POST'])
+def api_profile_start():
+    """Start profiling an endpoint or ``task:<job>``.
+
+    JSON body: ``target``, ``every`` (profile 1 of N, default 1), ``seconds``
+    (default 60) and ``limit`` (maximum number of profiled calls, default 100).
+    """
+    data = request.get_json(silent=True) or {}
+    target = (data.get('target') or '').strip()
+    try:
+        every = int(data.get('every', 1))
+        seconds = float(data.get('seconds', 60))
+        limit = int(data.get('limit', 100))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'msg': 'invalid parameters'}), 400
+    runner = None
+    if target.startswith('task:'):
+        job = scheduler.jobs.get(target[5:])
+        if job is None:
+            return jsonify({'status': 'error', 'msg': 'unknown task'}), 404
+        if not job.interval:
+            # A long-running job is never called again, sample its thread
+            if job.runner is None:
+                return jsonify({'status': 'error', 'msg': f'{target} is not running'}), 409
+            runner = job.runner
+    elif target not in current_app.view_functions:
+        return jsonify({'status': 'error', 'msg': 'unknown endpoint'}), 404
+    try:
+        session = profiler.start(target, every, seconds, limit, runner)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 409
+    return jsonify({'status': 'ok', 'session': session.info()})
+
+
+@api_bp.route('/profile', methods=['DELETE'])
+def api_profile_stop():
+    session = profiler.stop()
+    return jsonify({'status': 'ok', 'session': session.info() if session else None})
+
+
+@api_bp.route('/profile/download', methods=['GET'])
+def api_profile_download():
+    """Download the last session as ``pstats`` or ``collapsed`` stacks."""
+    fmt = request.args.get('format', 'pstats')
+    try:
+        if fmt == 'pstats':
+            data = profiler.pstats_dump()
+            mimetype, ext = 'application/octet-stream', 'prof'
+        elif fmt == 'collapsed':
+            data = profiler.collapsed()
+            mimetype, ext = 'text/plain', 'folded'
+        else:
+            return jsonify({'status': 'error', 'msg': 'format must be pstats or collapsed'}), 400
+    except LookupError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 404
+    except Exception as e:
+        logging.error(f'Ошибка при выгрузке профиля: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    name = profiler.session.target.replace(':', '-')
+    return Response(data, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={name}.{ext}',
+    })
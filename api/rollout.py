@@ -0,0 +1,97 @@
+from flask import request, jsonify
+import logging
+
+from . import api_bp
+from services.hosts import registry as host_registry
+from services.inventory import inventory as dynamic_inventory
+from services.playbooks import queue as playbook_queue
+from services.rollout import (
+    ROLLOUT_MAX_INSTALLING,
+    ROLLOUT_PLAYBOOK_CONCURRENCY,
+    ROLLOUT_WAVE_SIZE,
+    RolloutError,
+    controller as rollouts,
+)
+
+
+def _select_macs(data: dict) -> tuple[list, list]:
+    """MACs from ``macs``, a dynamic inventory ``group`` and/or a registry ``stage``.
+
+    Returns ``(macs, unknown)`` where *unknown* lists group members without a MAC.
+    """
+    macs = data.get('macs') or []
+    if isinstance(macs, str):
+        macs = [macs]
+    macs = list(macs)
+    unknown = []
+    if data.get('group'):
+        targets, _ = dynamic_inventory.select((), data['group'])
+        for name, vars in sorted(targets.items()):
+            mac = vars.get('pxe_mac') or vars.get('mac')
+            if mac:
+                macs.append(mac)
+            else:
+                unknown.append(name)
+    if data.get('stage') is not None:
+        macs += sorted(r.mac for r in host_registry.by_stage(data['stage']))
+    return macs, unknown
+
+
+@api_bp.route('/rollouts', methods=['GET'])
+def api_rollout_list():
+    return jsonify({'rollouts': rollouts.list(), 'playbooks': playbook_queue.counts()})
+
+
+@api_bp.route('/rollouts', methods=['POST'])
+def api_rollout_create():
+    """Start a rollout, see :mod:`services.rollout` for the parameters."""
+    data = request.get_json(silent=True) or {}
+    try:
+        macs, unknown = _select_macs(data)
+    except KeyError:
+        return jsonify({'status': 'error', 'msg': f'unknown group {data.get("group")}'}), 404
+    advance_stages = data.get('advance_stages')
+    if isinstance(advance_stages, str):
+        advance_stages = advance_stages.split(',')
+    try:
+        rollout = rollouts.create(
+            macs,
+            name=data.get('name', ''),
+            power=data.get('power', 'wol'),
+            boot_action=data.get('boot_action', 'install'),
+            wave_size=int(data.get('wave_size', ROLLOUT_WAVE_SIZE)),
+            max_installing=int(data.get('max_installing', ROLLOUT_MAX_INSTALLING)),
+            playbook_concurrency=int(
+                data.get('playbook_concurrency', ROLLOUT_PLAYBOOK_CONCURRENCY)
+            ),
+            advance_stages=advance_stages,
+        )
+    except (TypeError, ValueError) as e:
+        # RolloutError is a ValueError
+        return jsonify({'status': 'error', 'msg': str(e)}), 400
+    except Exception as e:
+        logging.error(f'Ошибка создания rollout: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
+    return jsonify(dict(rollout, unknown=unknown)), 201
+
+
+@api_bp.route('/rollouts/<int:rollout_id>', methods=['GET'])
+def api_rollout_get(rollout_id):
+    rollout = rollouts.get(rollout_id, with_hosts=True)
+    if rollout is None:
+        return jsonify({'status': 'error', 'msg': 'not found'}), 404
+    return jsonify(rollout)
+
+
+@api_bp.route('/rollouts/<int:rollout_id>/<command>', methods=['POST'])
+def api_rollout_command(rollout_id, command):
+    """``pause``, ``resume`` or ``abort`` a rollout."""
+    actions = {'pause': rollouts.pause, 'resume': rollouts.resume, 'abort': rollouts.abort}
+    if command not in actions:
+        return jsonify({'status': 'error', 'msg': 'command must be pause, resume or abort'}), 400
+    try:
+        return jsonify(actions[command](rollout_id))
+    except KeyError:
+        return jsonify({'status': 'error', 'msg': 'not found'}), 404
+    except RolloutError as e:
+        return jsonify({'status': 'error', 'msg': str(e)}), 409
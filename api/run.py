@@ -0,0 +1,96 @@
+from flask import request, jsonify, Response
+import hmac
+import json
+import logging
+import time
+
+from . import api_bp
+from services.inventory import inventory as dynamic_inventory
+from services.runner import (
+    CommandRun,
+    RUN_DEFAULT_PARALLEL,
+    RUN_DEFAULT_TIMEOUT,
+    RUN_MAX_OUTPUT,
+    RUN_TOKEN,
+    group_results,
+    status_counts,
+)
+
+
+def _run_token_ok() -> bool:
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else request.headers.get('X-Run-Token', '')
+    return hmac.compare_digest(token.encode(), RUN_TOKEN.encode())
+
+
+@api_bp.route('/run', methods=['POST'])
+def api_run():
+    """Run ``command`` on ``hosts`` and/or a ``group`` of the dynamic inventory.
+
+    Requires ``Authorization: Bearer $RUN_TOKEN``.  Results stream as NDJSON,
+    one line per host in completion order and a final ``summary`` line.  With
+    ``"summary": true`` the response is a single JSON document where
+    identical outputs are grouped.
+    """
+    if not RUN_TOKEN:
+        return jsonify({'status': 'error', 'msg': 'RUN_TOKEN is not set'}), 403
+    if not _run_token_ok():
+        logging.warning(f'Отклонён запуск команды от {request.remote_addr}: неверный токен')
+        return jsonify({'status': 'error', 'msg': 'invalid token'}), 401
+    data = request.get_json(silent=True) or {}
+    command = (data.get('command') or '').strip()
+    if not command:
+        return jsonify({'status': 'error', 'msg': 'command required'}), 400
+    hosts = data.get('hosts') or []
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    group = data.get('group')
+    if not hosts and not group:
+        return jsonify({'status': 'error', 'msg': 'hosts or group required'}), 400
+    try:
+        targets, unknown = dynamic_inventory.select(hosts, group)
+    except KeyError:
+        return jsonify({'status': 'error', 'msg': f'unknown group {group}'}), 404
+    try:
+        run = CommandRun(
+            command,
+            targets,
+            parallel=int(data.get('parallel', RUN_DEFAULT_PARALLEL)),
+            timeout=float(data.get('timeout', RUN_DEFAULT_TIMEOUT)),
+            max_output=int(data.get('max_output', RUN_MAX_OUTPUT)),
+        )
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'msg': 'invalid parallel, timeout or max_output'}), 400
+    logging.info(
+        f'Запуск команды от {request.remote_addr} на {len(targets)} хостах: {command}'
+    )
+    started = time.monotonic()
+
+    if data.get('summary'):
+        results = list(run)
+        return jsonify({
+            'command': command,
+            'hosts': len(targets),
+            'unknown': unknown,
+            'seconds': round(time.monotonic() - started, 3),
+            'counts': status_counts(results),
+            'groups': group_results(results),
+        })
+
+    def generate():
+        results = []
+        for name in unknown:
+            yield json.dumps({'host': name, 'status': 'unknown'}) + '\n'
+        for result in run:
+            results.append(result)
+            yield json.dumps(result) + '\n'
+        yield json.dumps({'summary': {
+            'command': command,
+            'hosts': len(targets),
+            'unknown': unknown,
+            'seconds': round(time.monotonic() - started, 3),
+            'counts': status_counts(results),
+            'distinct_outputs': len(group_results(results)),
+        }}) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
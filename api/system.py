@@ -4,14 +4,36 @@ import logging
 
 from config import DB_PATH
 from . import api_bp
+from services.boot import state as boot_state
+from services.hosts import registry as host_registry
+from services.analytics import analytics as install_analytics
+from services.marks import marks
+from services.rollout import controller as rollouts
+from services.run_profiles import profiles as run_profiles
+from tasks.scheduler import scheduler
 
 
 @api_bp.route('/clear-db', methods=['POST'])
 def api_clear_db():
     try:
         pathlib.Path(DB_PATH).unlink(missing_ok=True)
+        boot_state.reset()
+        host_registry.reset()
+        install_analytics.reset()
+        marks.reset()
+        rollouts.reset()
+        run_profiles.reset()
         logging.info('База данных очищена')
         return jsonify({'status': 'ok'}), 200
     except Exception as e:
         logging.error(f'Ошибка при очистке базы данных: {e}')
         return jsonify({'status': 'error', 'msg': str(e)}), 500
+
+
+@api_bp.route('/tasks', methods=['GET'])
+def api_tasks():
+    try:
+        return jsonify(scheduler.status())
+    except Exception as e:
+        logging.error(f'Ошибка при получении состояния задач: {e}')
+        return jsonify({'status': 'error', 'msg': str(e)}), 500
@@ -1,10 +1,14 @@
 import logging
 from flask import Flask
 
+from config import BOOT_ARTIFACTS_DIR
 from logtail import logtail_bp
+from artifacts import artifacts_bp
 from api import api_bp
 from web import web_bp
 from tasks import start_background_tasks
+from services.profiling import profiler
+from services.hosts import registry as host_registry
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -12,10 +16,14 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 def create_app() -> Flask:
     app = Flask(__name__, static_folder='static')
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+    profiler.init_app(app)
 
     app.register_blueprint(logtail_bp)
     app.register_blueprint(api_bp)
     app.register_blueprint(web_bp)
+    if BOOT_ARTIFACTS_DIR:
+        app.register_blueprint(artifacts_bp)
+    host_registry.load()
     start_background_tasks()
     return app
 
@@ -0,0 +1,65 @@
+"""Blueprint serving kernels, initrds and installer images over HTTP.
+
+Registered only when ``BOOT_ARTIFACTS_DIR`` is set.  Point
+``IPXE_BOOT_BASE_URL`` at ``http://<panel>/boot`` to let the generated iPXE
+scripts fetch their artifacts from here.
+"""
+
+import mimetypes
+import os
+import stat
+
+from flask import Blueprint, Response, abort, request, send_file
+from werkzeug.utils import safe_join
+
+from config import BOOT_ARTIFACTS_DIR
+from services.artifacts import cache, downloads
+from services.preseed import normalize_mac
+
+artifacts_bp = Blueprint('artifacts', __name__, url_prefix='/boot')
+
+
+@artifacts_bp.route('/<path:filename>', methods=['GET', 'HEAD'])
+def serve_artifact(filename):
+    path = safe_join(BOOT_ARTIFACTS_DIR, filename)
+    if path is None:
+        abort(404)
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+    if not stat.S_ISREG(st.st_mode):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    etag = f'{st.st_mtime_ns:x}-{st.st_size:x}'
+    if cache.cacheable(st):
+        data = cache.get(path, st)
+        response = Response(data, mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = st.st_mtime
+        response = response.make_conditional(
+            request, accept_ranges=True, complete_length=len(data)
+        )
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=etag)
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    client = normalize_mac(request.args.get('mac', '')) or request.remote_addr
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if request.method == 'GET' and response.status_code in (200, 206):
+        if file_wrapper is not None and isinstance(response.response, file_wrapper):
+            # Handed to the server unchanged so it can use sendfile
+            downloads.track_file(
+                response.response, client, request.remote_addr, filename,
+                response.content_length or 0,
+            )
+        else:
+            response.response = downloads.track(
+                response.response, client, request.remote_addr, filename
+            )
+    else:
+        # HEAD and 304 responses carry no body to account
+        downloads.begin(client, request.remote_addr, filename)
+        downloads.end(client)
+    return response
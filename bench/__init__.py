@@ -0,0 +1,10 @@
+"""Benchmarks run from the repository root, e.g.::
+
+    python -m bench.registration_storm --hosts 2000 --concurrency 50
+
+Each benchmark starts pxe-watch in a child process against a temporary
+database and inventory, with the stand-ins from ``bench/fakebin`` first on
+``PATH`` instead of ``ansible-playbook``, ``sshpass``/``ssh`` and
+``journalctl``.  Results are printed and, with ``--output``, written as JSON
+tagged with the git revision so runs of different versions can be compared.
+"""
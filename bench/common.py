@@ -0,0 +1,294 @@
+"""Shared helpers for the benchmarks: sandbox, server process, sampling."""
+
+import datetime
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+FAKEBIN = REPO / 'bench' / 'fakebin'
+
+
+def prepare_sandbox(workdir: Path, inventory_lines=(), env_overrides=None) -> dict:
+    """Create the files pxe-watch expects under *workdir* and return its env."""
+    for name in ('preseeds', 'tftp', 'tftp/templates', 'files', 'templates'):
+        (workdir / name).mkdir(parents=True, exist_ok=True)
+    (workdir / 'inventory.ini').write_text(
+        '[all]\n' + ''.join(line + '\n' for line in inventory_lines)
+    )
+    (workdir / 'playbook.yml').write_text('- hosts: all\n  tasks: []\n')
+    (workdir / 'dnsmasq.conf').write_text('port=0\n')
+    (workdir / 'preseed.cfg').write_text('d-i debian-installer/locale string en_US\n')
+
+    env = os.environ.copy()
+    env.update({
+        'PATH': f'{FAKEBIN}{os.pathsep}{env.get("PATH", "")}',
+        'PYTHONPATH': str(REPO),
+        'PYTHONUNBUFFERED': '1',
+        'DB_PATH': str(workdir / 'pxe.db'),
+        'ANSIBLE_INVENTORY': str(workdir / 'inventory.ini'),
+        'ANSIBLE_PLAYBOOK': str(workdir / 'playbook.yml'),
+        'ANSIBLE_FILES_DIR': str(workdir / 'files'),
+        'ANSIBLE_TEMPLATES_DIR': str(workdir / 'templates'),
+        'PRESEED_DIR': str(workdir / 'preseeds'),
+        'PRESEED_PATH': str(workdir / 'preseed.cfg'),
+        'DNSMASQ_PATH': str(workdir / 'dnsmasq.conf'),
+        'BOOT_IPXE_PATH': str(workdir / 'tftp' / 'boot.ipxe'),
+        'AUTOEXEC_IPXE_PATH': str(workdir / 'tftp' / 'autoexec.ipxe'),
+        'IPXE_TEMPLATES_DIR': str(workdir / 'tftp' / 'templates'),
+        'LOGS_DIR': str(workdir / 'logs'),
+        'DNSMASQ_LEASES_PATH': str(workdir / 'dnsmasq.leases'),
+        'DNSMASQ_LOG_PATH': '',
+        'DHCP_HOSTSFILE': str(workdir / 'pxe-watch.hosts'),
+        'DHCP_OPTSFILE': str(workdir / 'pxe-watch.opts'),
+        'DNSMASQ_RELOAD_CMD': 'true',
+        'DNSMASQ_RESTART_CMD': 'true',
+        'TASKS_LOCK_PATH': str(workdir / 'tasks.lock'),
+        'BOOT_ARTIFACTS_DIR': '',
+    })
+    env.update(env_overrides or {})
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+SERVE_SNIPPET = (
+    'import sys\n'
+    'from werkzeug.serving import run_simple\n'
+    'from app import create_app\n'
+    'run_simple("127.0.0.1", int(sys.argv[1]), create_app(), threaded=True)\n'
+)
+
+
+class Server:
+    """pxe-watch running in a child process, werkzeug or gunicorn+gevent."""
+
+    def __init__(self, workdir: Path, env: dict, kind: str = 'werkzeug', workers: int = 1):
+        self.workdir = workdir
+        self.port = free_port()
+        self.log_path = workdir / 'server.log'
+        if kind == 'gunicorn':
+            env = dict(env, GUNICORN_BIND=f'127.0.0.1:{self.port}', GUNICORN_WORKERS=str(workers))
+            env.pop('GUNICORN_ACCESSLOG', None)
+            cmd = [sys.executable, '-m', 'gunicorn', '-c', str(REPO / 'gunicorn.conf.py'),
+                   '--chdir', str(REPO), 'app:app']
+        else:
+            cmd = [sys.executable, '-c', SERVE_SNIPPET, str(self.port)]
+        self._log = open(self.log_path, 'w')
+        # cwd is the sandbox so a developer's .env is not picked up
+        self.proc = subprocess.Popen(
+            cmd, env=env, cwd=workdir, stdout=self._log, stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+    def wait_ready(self, path: str = '/metrics', timeout: float = 30) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'server exited, see {self.log_path}')
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=2)
+                conn.request('GET', path)
+                conn.getresponse().read()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('server did not start')
+
+    def stop(self) -> None:
+        if self.proc.poll() is None:
+            os.killpg(self.proc.pid, 15)
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.proc.pid, 9)
+                self.proc.wait()
+        self._log.close()
+
+    def log_count(self, needle: str) -> int:
+        with open(self.log_path, errors='replace') as f:
+            return sum(needle in line for line in f)
+
+
+def _children() -> dict[int, list[int]]:
+    tree: dict[int, list[int]] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, fields follow the last ')'
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        tree.setdefault(ppid, []).append(int(entry))
+    return tree
+
+
+def descendants(pid: int, tree: dict = None) -> list[int]:
+    tree = _children() if tree is None else tree
+    result = []
+    stack = [pid]
+    while stack:
+        for child in tree.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def count_descendants(pid: int, needle: str) -> int:
+    """Number of live descendants of *pid* whose command line contains *needle*."""
+    return sum(needle in _cmdline(child) for child in descendants(pid))
+
+
+def tree_cpu_seconds(pid: int) -> float:
+    """CPU seconds used so far by *pid* and its live descendants."""
+    return sum(_cpu_seconds(p) for p in [pid] + descendants(pid))
+
+
+def _status(pid: int) -> dict:
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM', 'Threads'):
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def _cpu_seconds(pid: int) -> float:
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    # utime and stime are fields 14 and 15 of stat, 12 and 13 after the name
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class ProcessSampler:
+    """Samples RSS, threads, CPU and descendant processes of a server.
+
+    The server itself is the process group leader; with gunicorn the
+    workers are its direct children and their figures are summed.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> 'ProcessSampler':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def sample(self) -> dict:
+        tree = _children()
+        server_pids = [self.pid]
+        if 'gunicorn' in _cmdline(self.pid):
+            server_pids += tree.get(self.pid, [])
+        descendants = []
+        stack = list(server_pids)
+        while stack:
+            for child in tree.get(stack.pop(), []):
+                if child not in server_pids:
+                    descendants.append(child)
+                    stack.append(child)
+        rss = hwm = threads = 0
+        cpu = 0.0
+        for pid in server_pids:
+            status = _status(pid)
+            rss += status.get('VmRSS', 0)
+            hwm += status.get('VmHWM', 0)
+            threads += status.get('Threads', 0)
+            cpu += _cpu_seconds(pid)
+        return {
+            't': time.monotonic(),
+            'rss_kb': rss,
+            'hwm_kb': hwm,
+            'threads': threads,
+            'children': len(descendants),
+            'playbooks': sum('ansible-playbook' in _cmdline(pid) for pid in descendants),
+            'cpu_s': cpu,
+        }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.samples.append(self.sample())
+            self._stop.wait(self.interval)
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {}
+        return {
+            'peak_rss_mb': round(max(s['hwm_kb'] for s in self.samples) / 1024, 1),
+            'final_rss_mb': round(self.samples[-1]['rss_kb'] / 1024, 1),
+            'peak_threads': max(s['threads'] for s in self.samples),
+            'peak_child_processes': max(s['children'] for s in self.samples),
+            'peak_playbook_runs': max(s['playbooks'] for s in self.samples),
+            'cpu_seconds': round(self.samples[-1]['cpu_s'] - self.samples[0]['cpu_s'], 2),
+        }
+
+
+def _cmdline(pid: int) -> str:
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return f.read().replace(b'\0', b' ').decode(errors='replace')
+    except OSError:
+        return ''
+
+
+def percentiles(values: list[float], points=(50, 95, 99)) -> dict:
+    if not values:
+        return {f'p{p}_ms': None for p in points}
+    ordered = sorted(values)
+    return {
+        f'p{p}_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 2)
+        for p in points
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=REPO,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_results(path: str, benchmark: str, params: dict, results) -> None:
+    """Append one JSON line so successive runs accumulate in one file."""
+    record = {
+        'benchmark': benchmark,
+        'revision': git_revision(),
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'results': results,
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
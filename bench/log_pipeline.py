@@ -0,0 +1,339 @@
+"""Log pipeline throughput: ``/api/tail``, ``/api/journal`` and colorizers.
+
+A writer appends timestamped lines at ``--rate`` lines per second to a log
+file that an inventory host with ``ansible_connection=local`` tails, and
+that the fake ``journalctl`` serves as the ``bench-app`` unit.  For every
+combination of path, viewer count, color rule count and filter complexity,
+``--viewers`` clients stream the log for ``--duration`` seconds::
+
+    python -m bench.log_pipeline --viewers 1,8,32 --rules 0,20 \\
+        --filters none,chain --output bench-results.jsonl
+
+Per scenario: delivered lines per second (total and per viewer), added
+latency per line from write to receipt, CPU seconds per viewer of the server
+and its stream pipelines, and server RSS growth.  The colorizers are also
+timed in-process per line.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import timeit
+from pathlib import Path
+from urllib.parse import urlencode
+
+from bench.common import (
+    ProcessSampler,
+    Server,
+    count_descendants,
+    percentiles,
+    prepare_sandbox,
+    tree_cpu_seconds,
+    write_results,
+)
+
+HOST = 'bench'
+UNIT = 'bench-app'
+LEVELS = ('INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR')
+MARK_RE = re.compile(rb'@@(\d+)@(\d+\.\d+)@@')
+
+# Query parameters per filter complexity; the chain keeps about half the lines
+FILTERS = {
+    'none': {'tail': {}, 'journal': {}},
+    'grep': {
+        'tail': {'grep': 'INFO|WARNING|ERROR'},
+        'journal': {'grep': 'INFO|WARNING|ERROR'},
+    },
+    'chain': {
+        'tail': {'grep': 'GET|POST', 'exclude': 'DEBUG|healthz', 'level': 'INFO'},
+        'journal': {'grep': 'GET|POST', 'include': 'api,10\\.0\\.', 'exclude': 'DEBUG,healthz'},
+    },
+}
+
+
+def make_line(n: int) -> str:
+    level = LEVELS[n % len(LEVELS)]
+    method = 'POST' if n % 4 == 0 else 'GET'
+    path = '/healthz' if n % 10 == 0 else '/api/register'
+    status = (200, 200, 200, 404, 500)[n % 5]
+    return (
+        f'@@{n}@{time.time():.6f}@@ {level} {method} {path} {status} '
+        f'10.0.{(n >> 8) & 0xff}.{n & 0xff} 52:54:00:00:{(n >> 8) & 0xff:02x}:{n & 0xff:02x} '
+        f'kw{n % 50:02d} request handled in {n % 97} ms\n'
+    )
+
+
+class Writer(threading.Thread):
+    """Appends lines to *path* at *rate* lines per second in 10 ms batches."""
+
+    def __init__(self, path: Path, rate: int):
+        super().__init__(daemon=True)
+        self.path = path
+        self.rate = rate
+        self.written = 0
+        self.stop = threading.Event()
+
+    def run(self) -> None:
+        started = time.monotonic()
+        with open(self.path, 'a', buffering=1) as f:
+            while not self.stop.is_set():
+                due = int((time.monotonic() - started) * self.rate)
+                while self.written < due:
+                    f.write(make_line(self.written))
+                    self.written += 1
+                f.flush()
+                self.stop.wait(0.01)
+
+
+class Viewer(threading.Thread):
+    """Streams one URL over a raw HTTP/1.0 socket and times every line."""
+
+    def __init__(self, port: int, path: str):
+        super().__init__(daemon=True)
+        self.port = port
+        self.path = path
+        self.lines = 0
+        self.bytes = 0
+        self.latencies = []
+        self.status = None
+        self.connected = threading.Event()
+        self.stop = threading.Event()
+
+    def run(self) -> None:
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(0.5)
+        sock.sendall(f'GET {self.path} HTTP/1.0\r\nHost: bench\r\n\r\n'.encode())
+        raw = b''
+        buf = b''
+        chunked = None
+        try:
+            while not self.stop.is_set():
+                try:
+                    chunk = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    break
+                now = time.time()
+                raw += chunk
+                if chunked is None:
+                    head, sep, rest = raw.partition(b'\r\n\r\n')
+                    if not sep:
+                        continue
+                    self.status = int(head.split(b' ', 2)[1])
+                    chunked = b'transfer-encoding: chunked' in head.lower()
+                    self.connected.set()
+                    raw = rest
+                if chunked:
+                    data, raw = _dechunk(raw)
+                else:
+                    data, raw = raw, b''
+                buf += data
+                *complete, buf = buf.split(b'\n')
+                for line in complete:
+                    self.bytes += len(line) + 1
+                    if not line:
+                        continue
+                    self.lines += 1
+                    m = MARK_RE.search(line)
+                    if m:
+                        self.latencies.append(now - float(m.group(2)))
+        finally:
+            self.connected.set()
+            sock.close()
+
+
+def _dechunk(raw: bytes) -> tuple[bytes, bytes]:
+    """Decode the complete chunks in *raw*; return ``(data, remainder)``."""
+    out = []
+    while True:
+        size_line, sep, rest = raw.partition(b'\r\n')
+        if not sep:
+            break
+        size = int(size_line.split(b';')[0], 16)
+        if len(rest) < size + 2:
+            break
+        out.append(rest[:size])
+        raw = rest[size + 2:]
+    return b''.join(out), raw
+
+
+def set_color_rules(db_path: Path, count: int) -> None:
+    keywords = ['INFO', 'WARNING', 'ERROR', 'GET', 'POST', ' 404 ', ' 500 ']
+    keywords += [f'kw{i:02d}' for i in range(50)]
+    with sqlite3.connect(db_path) as db:
+        db.execute('DELETE FROM color_rules WHERE host = ?', (HOST,))
+        db.executemany(
+            'INSERT INTO color_rules(host, keyword, color, enabled) VALUES (?, ?, ?, 1)',
+            [(HOST, kw, 'red') for kw in keywords[:count]],
+        )
+
+
+def url_for(kind: str, filters: dict, path_id: int) -> str:
+    if kind == 'tail':
+        params = {'lines': 0, 'follow': 'true', 'path_id': path_id, **filters}
+        return f'/api/tail/{HOST}?{urlencode(params)}'
+    params = {'service': UNIT, 'lines': 0, 'follow': 'true', **filters}
+    return f'/api/journal/{HOST}?{urlencode(params)}'
+
+
+def run_scenario(server, sampler, writer, kind, viewers, rules, filt, duration, path_id, workdir):
+    set_color_rules(workdir / 'logtail.sqlite', rules)
+    path = url_for(kind, FILTERS[filt][kind], path_id)
+    rss_before = sampler.sample()['rss_kb']
+    clients = [Viewer(server.port, path) for _ in range(viewers)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.connected.wait(10)
+    # Give the pipelines a moment to start following the file
+    time.sleep(0.5)
+    cpu_before = tree_cpu_seconds(server.proc.pid)
+    written_before = writer.written
+    started = time.monotonic()
+    lines_before = [c.lines for c in clients]
+    lat_before = [len(c.latencies) for c in clients]
+    time.sleep(duration)
+    elapsed = time.monotonic() - started
+    cpu = tree_cpu_seconds(server.proc.pid) - cpu_before
+    written = writer.written - written_before
+    delivered = [c.lines - b for c, b in zip(clients, lines_before)]
+    latencies = [v for c, b in zip(clients, lat_before) for v in c.latencies[b:]]
+    for c in clients:
+        c.stop.set()
+    for c in clients:
+        c.join(5)
+    # Wait for the server to notice and kill the pipelines
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and count_descendants(server.proc.pid, 'tail -n'):
+        time.sleep(0.2)
+    rss_after = sampler.sample()['rss_kb']
+    statuses = sorted({c.status for c in clients if c.status is not None})
+    return {
+        'path': kind,
+        'viewers': viewers,
+        'rules': rules,
+        'filter': filt,
+        'http_status': statuses,
+        'written_lps': round(written / elapsed, 1),
+        'delivered_lps': round(sum(delivered) / elapsed, 1),
+        'delivered_lps_per_viewer': round(sum(delivered) / elapsed / viewers, 1),
+        **{f'latency_{k}': v for k, v in percentiles(latencies).items()},
+        'cpu_s_per_viewer': round(cpu / viewers, 3),
+        'cpu_pct': round(cpu / elapsed * 100, 1),
+        'rss_growth_kb': rss_after - rss_before,
+    }
+
+
+def bench_colorizers(lines: int) -> dict:
+    """Time the HTML colorizers in-process, microseconds per line."""
+    from logtail import apply_color_rules_html
+    from api.ansible import colorize_ansible_line
+
+    sample = [make_line(n) for n in range(1000)]
+    journal = [f'Oct 19 10:00:{n % 60:02d} panel ansible-api[812]: {line}'
+               for n, line in enumerate(sample)]
+    keywords = ['INFO', 'WARNING', 'ERROR', 'GET', 'POST'] + [f'kw{i:02d}' for i in range(50)]
+    rounds = max(1, lines // len(sample))
+    results = {}
+
+    def per_line(func) -> float:
+        seconds = min(timeit.repeat(func, number=rounds, repeat=3))
+        return round(seconds / (rounds * len(sample)) * 1e6, 2)
+
+    for count in (0, 5, 20, 50):
+        rules = [(kw, 'red') for kw in keywords[:count]]
+        results[f'color_rules_{count}_us'] = per_line(
+            lambda: [apply_color_rules_html(line, rules) for line in sample])
+    results['ansible_colorizer_us'] = per_line(
+        lambda: [colorize_ansible_line(line) for line in journal])
+    return results
+
+
+def run(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix='pxe-bench-'))
+    (workdir / 'journal').mkdir()
+    log = workdir / 'journal' / f'{UNIT}.log'
+    log.touch()
+    env = prepare_sandbox(
+        workdir,
+        inventory_lines=[f'{HOST} ansible_connection=local'],
+        env_overrides={
+            'FAKE_JOURNAL_DIR': str(workdir / 'journal'),
+            'STREAM_MAX_TOTAL': '10000',
+            'STREAM_MAX_PER_HOST': '10000',
+        },
+    )
+    server = Server(workdir, env, args.server, args.workers)
+    writer = Writer(log, args.rate)
+    try:
+        server.wait_ready('/logtail')
+        with sqlite3.connect(workdir / 'logtail.sqlite') as db:
+            path_id = db.execute(
+                'INSERT INTO host_logpaths(host, path, name) VALUES (?, ?, ?)',
+                (HOST, str(log), 'bench'),
+            ).lastrowid
+        sampler = ProcessSampler(server.proc.pid)
+        rss_start = sampler.sample()['rss_kb']
+        writer.start()
+        scenarios = []
+        for kind in args.paths.split(','):
+            for viewers in (int(v) for v in args.viewers.split(',')):
+                for rules in (int(r) for r in args.rules.split(',')):
+                    for filt in args.filters.split(','):
+                        result = run_scenario(server, sampler, writer, kind, viewers,
+                                              rules, filt, args.duration, path_id, workdir)
+                        scenarios.append(result)
+                        print(' '.join(f'{k}={v}' for k, v in result.items()), flush=True)
+        rss_end = sampler.sample()['rss_kb']
+    finally:
+        writer.stop.set()
+        server.stop()
+        if args.keep:
+            print(f'sandbox kept in {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Imported only now so that config picks up the sandbox environment
+    os.environ.update(env)
+    return {
+        'scenarios': scenarios,
+        'server_rss_growth_kb': rss_end - rss_start,
+        'colorizers': bench_colorizers(args.color_lines),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--paths', default='tail,journal')
+    parser.add_argument('--viewers', default='1,8', help='comma separated viewer counts')
+    parser.add_argument('--rules', default='0,20', help='comma separated color rule counts')
+    parser.add_argument('--filters', default='none,chain',
+                        help='comma separated: ' + ', '.join(FILTERS))
+    parser.add_argument('--rate', type=int, default=1000, help='lines written per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per scenario')
+    parser.add_argument('--color-lines', type=int, default=20000,
+                        help='lines per colorizer timing round')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+    parser.add_argument('--output', help='append results as a JSON line to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the sandbox directory')
+    args = parser.parse_args()
+
+    results = run(args)
+    print(f"server_rss_growth_kb {results['server_rss_growth_kb']}")
+    for key, value in results['colorizers'].items():
+        print(f'{key:<24}  {value}')
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k not in ('output', 'keep')}
+        write_results(args.output, 'log_pipeline', params, results)
+
+
+if __name__ == '__main__':
+    main()
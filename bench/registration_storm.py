@@ -0,0 +1,193 @@
+"""Registration storm: many installers calling ``/api/register`` at once.
+
+Every simulated host walks through the installer stages in order and each
+registration starts a (fake) ``ansible-playbook`` run, as in production::
+
+    python -m bench.registration_storm --hosts 2000 --concurrency 64 \\
+        --ansible-delay 5 --output bench-results.jsonl
+
+Reported: request throughput, client-side latency percentiles, HTTP errors,
+``database is locked`` errors from the server log, peak threads, child
+processes and RSS of the server, and how long the playbook backlog took to
+drain afterwards.
+"""
+
+import argparse
+import http.client
+import queue
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from bench.common import ProcessSampler, Server, percentiles, prepare_sandbox, write_results
+
+DEFAULT_STAGES = 'dhcp,tftp:undionly.kpxe,preseed,install,done'
+
+
+def mac_for(i: int) -> str:
+    return '52:54:00:{:02x}:{:02x}:{:02x}'.format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+
+def ip_for(i: int) -> str:
+    return f'10.{100 + (i >> 16) % 100}.{(i >> 8) & 0xff}.{i & 0xff}'
+
+
+class Client(threading.Thread):
+    def __init__(self, port: int, jobs: queue.Queue, timeout: float):
+        super().__init__(daemon=True)
+        self.port = port
+        self.jobs = jobs
+        self.timeout = timeout
+        self.latencies = []
+        self.statuses: dict[int, int] = {}
+        self.errors = 0
+
+    def run(self) -> None:
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            i, stage = job
+            path = f'/api/register?mac={mac_for(i)}&ip={ip_for(i)}&stage={stage}'
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+                continue
+            self.latencies.append(time.perf_counter() - started)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        conn.close()
+
+
+def scrape(port: int) -> str:
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/metrics')
+    return conn.getresponse().read().decode()
+
+
+def metric(text: str, name: str) -> float:
+    m = re.search(rf'^{re.escape(name)} (\S+)$', text, re.M)
+    return float(m.group(1)) if m else 0.0
+
+
+def run(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix='pxe-bench-'))
+    env = prepare_sandbox(workdir, env_overrides={
+        'FAKE_ANSIBLE_DELAY': str(args.ansible_delay),
+        'FAKE_ANSIBLE_FAIL_PCT': str(args.ansible_fail_pct),
+        'FAKE_SSH_DELAY': str(args.ssh_delay),
+        'FAKE_JOURNAL_RATE': str(args.journal_rate),
+    })
+    server = Server(workdir, env, args.server, args.workers)
+    try:
+        server.wait_ready()
+        sampler = ProcessSampler(server.proc.pid).start()
+        stages = [s for s in args.stages.split(',') if s]
+        jobs: queue.Queue = queue.Queue()
+        for stage in stages:
+            for i in range(args.hosts):
+                jobs.put((i, stage))
+        clients = [Client(server.port, jobs, args.timeout) for _ in range(args.concurrency)]
+        for _ in clients:
+            jobs.put(None)
+
+        started = time.monotonic()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.monotonic() - started
+        load_samples = len(sampler.samples)
+
+        # Wait for the fake playbook runs started by the storm to finish
+        drain_started = time.monotonic()
+        while time.monotonic() - drain_started < args.drain:
+            if not sampler.sample()['playbooks']:
+                break
+            time.sleep(0.5)
+        drain = time.monotonic() - drain_started
+        sampler.stop()
+        text = scrape(server.port)
+
+        latencies = [v for c in clients for v in c.latencies]
+        statuses: dict[int, int] = {}
+        for c in clients:
+            for status, n in c.statuses.items():
+                statuses[status] = statuses.get(status, 0) + n
+        with sqlite3.connect(workdir / 'pxe.db') as db:
+            hosts = db.execute('SELECT COUNT(*) FROM hosts').fetchone()[0]
+            playbooks = dict(db.execute(
+                'SELECT status, COUNT(*) FROM playbook_status GROUP BY status'
+            ).fetchall())
+        load = ProcessSampler(server.proc.pid)
+        load.samples = sampler.samples[:load_samples] or sampler.samples
+        count = metric(text, 'pxe_registration_duration_seconds_count')
+        return {
+            'requests': len(latencies),
+            'seconds': round(elapsed, 2),
+            'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+            **percentiles(latencies),
+            'max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+            'status_codes': {str(k): v for k, v in sorted(statuses.items())},
+            'connection_errors': sum(c.errors for c in clients),
+            'db_locked_errors': server.log_count('database is locked'),
+            'server_registration_mean_ms': round(
+                metric(text, 'pxe_registration_duration_seconds_sum') / count * 1000, 3
+            ) if count else None,
+            'during_load': load.summary(),
+            'overall': sampler.summary(),
+            'drain_seconds': round(drain, 2),
+            'hosts_in_db': hosts,
+            'playbook_status': playbooks,
+        }
+    finally:
+        server.stop()
+        if args.keep:
+            print(f'sandbox kept in {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--stages', default=DEFAULT_STAGES,
+                        help='comma separated stages each host reports in order')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+    parser.add_argument('--ansible-delay', type=float, default=2.0,
+                        help='seconds each fake ansible-playbook run takes')
+    parser.add_argument('--ansible-fail-pct', type=int, default=5)
+    parser.add_argument('--ssh-delay', type=float, default=0.2)
+    parser.add_argument('--journal-rate', type=int, default=20,
+                        help='lines per second of the fake ansible-api journal')
+    parser.add_argument('--timeout', type=float, default=30, help='per request timeout')
+    parser.add_argument('--drain', type=float, default=60,
+                        help='maximum seconds to wait for playbook runs afterwards')
+    parser.add_argument('--output', help='append results as a JSON line to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the sandbox directory')
+    args = parser.parse_args()
+
+    results = run(args)
+    width = max(len(k) for k in results)
+    for key, value in results.items():
+        print(f'{key:<{width}}  {value}')
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k not in ('output', 'keep')}
+        write_results(args.output, 'registration_storm', params, results)
+
+
+if __name__ == '__main__':
+    main()
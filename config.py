@@ -23,3 +23,21 @@ SSH_OPTIONS = os.getenv(
     'SSH_OPTIONS',
     '-o StrictHostKeyChecking=accept-new -o UserKnownHostsFile=/dev/null'
 )
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', 64 * 1024 ** 3))
+IPXE_TEMPLATES_DIR = os.getenv('IPXE_TEMPLATES_DIR', '/srv/tftp/templates')
+IPXE_DEFAULT_ACTION = os.getenv('IPXE_DEFAULT_ACTION', 'menu')
+IPXE_BOOT_BASE_URL = os.getenv('IPXE_BOOT_BASE_URL', 'http://${next-server}/debian12')
+INSTALL_DONE_STAGES = [
+    s.strip() for s in os.getenv('INSTALL_DONE_STAGES', 'done,finished,complete').split(',')
+    if s.strip()
+]
+BOOT_ARTIFACTS_DIR = os.getenv('BOOT_ARTIFACTS_DIR', '')
+DNSMASQ_LEASES_PATH = os.getenv('DNSMASQ_LEASES_PATH', '/var/lib/misc/dnsmasq.leases')
+# dnsmasq log-facility file with log-dhcp; empty disables log following
+DNSMASQ_LOG_PATH = os.getenv('DNSMASQ_LOG_PATH', '/var/log/dnsmasq.log')
+DHCP_HOSTSFILE = os.getenv('DHCP_HOSTSFILE', '/etc/dnsmasq.d/pxe-watch.hosts')
+DHCP_OPTSFILE = os.getenv('DHCP_OPTSFILE', '/etc/dnsmasq.d/pxe-watch.opts')
+# Also reserve the current IP of hosts that registered through /api/register
+DHCP_RESERVE_SEEN_HOSTS = os.getenv('DHCP_RESERVE_SEEN_HOSTS', '0') == '1'
+DNSMASQ_RELOAD_CMD = os.getenv('DNSMASQ_RELOAD_CMD', 'sudo systemctl reload dnsmasq')
+DNSMASQ_RESTART_CMD = os.getenv('DNSMASQ_RESTART_CMD', 'sudo systemctl restart dnsmasq')
@@ -1,10 +1,35 @@
 import os
 import pathlib
 import sqlite3
+import time
 
 from config import DB_PATH
 
 
+class TimedConnection(sqlite3.Connection):
+    """Connection reporting the duration of each ``with`` transaction.
+
+    ``observer(seconds, outcome)`` is installed by :mod:`services.metrics`.
+    """
+
+    observer = None
+
+    def __enter__(self):
+        self._tx_started = time.perf_counter()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return super().__exit__(exc_type, exc, tb)
+        finally:
+            observer = TimedConnection.observer
+            if observer is not None:
+                observer(
+                    time.perf_counter() - self._tx_started,
+                    'rollback' if exc_type else 'commit',
+                )
+
+
 def get_db():
     """Create and initialize a SQLite database connection.
 
@@ -16,7 +41,9 @@ def get_db():
         sqlite3.Connection: ready-to-use database connection
     """
     os.makedirs(pathlib.Path(DB_PATH).parent, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn = sqlite3.connect(
+        DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES, factory=TimedConnection
+    )
     conn.row_factory = sqlite3.Row
 
     # Table with host info
@@ -44,4 +71,229 @@ def get_db():
         """
     )
 
+    # Content hashes of files in ANSIBLE_FILES_DIR
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            sha256 TEXT,
+            hashed TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS file_hashes_sha256 ON file_hashes(sha256)"
+    )
+
+    # One-shot boot action requested by an operator for the next iPXE boot
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS boot_actions (
+            mac TEXT PRIMARY KEY,
+            action TEXT,
+            created TEXT
+        )
+        """
+    )
+
+    # Read positions of followed log files (dnsmasq ingestion)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ingest_offsets (
+            source TEXT PRIMARY KEY,
+            inode INTEGER,
+            offset INTEGER,
+            updated TEXT
+        )
+        """
+    )
+
+    # DHCP reservations added by the operator
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS dhcp_reservations (
+            mac TEXT PRIMARY KEY,
+            ip TEXT,
+            hostname TEXT,
+            options TEXT,
+            updated TEXT
+        )
+        """
+    )
+
+    # Last Ansible completion mark of each host, pushed or pulled over SSH
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ansible_marks (
+            ip TEXT PRIMARY KEY,
+            status TEXT,
+            data TEXT,
+            received TEXT,
+            source TEXT
+        )
+        """
+    )
+
+    # Time each host spent in a stage, recorded when it reports the next one
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stage_transitions (
+            id INTEGER PRIMARY KEY,
+            mac TEXT,
+            from_stage TEXT,
+            to_stage TEXT,
+            started TEXT,
+            ended TEXT,
+            seconds REAL,
+            version TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS stage_transitions_ended ON stage_transitions(ended)"
+    )
+
+    # Current stage of each host and when its running install started
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS install_progress (
+            mac TEXT PRIMARY KEY,
+            stage TEXT,
+            entered TEXT,
+            started TEXT,
+            version TEXT
+        )
+        """
+    )
+
+    # Duration rollups per hour/day bucket, preseed/playbook version and stage
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS install_rollups (
+            period TEXT,
+            bucket TEXT,
+            version TEXT,
+            stage TEXT,
+            count INTEGER,
+            total REAL,
+            max REAL,
+            sketch TEXT,
+            PRIMARY KEY (period, bucket, version, stage)
+        )
+        """
+    )
+
+    # Transitions much slower than the fleet when they were recorded
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS install_outliers (
+            id INTEGER PRIMARY KEY,
+            mac TEXT,
+            stage TEXT,
+            seconds REAL,
+            baseline REAL,
+            ended TEXT,
+            version TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS install_outliers_ended ON install_outliers(ended)"
+    )
+
+    # Rollouts: hosts reinstalled in waves, admitted by the rollout controller
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollouts (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            status TEXT,
+            power TEXT,
+            boot_action TEXT,
+            wave_size INTEGER,
+            max_installing INTEGER,
+            playbook_concurrency INTEGER,
+            advance_stages TEXT,
+            created TEXT,
+            updated TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollout_hosts (
+            rollout_id INTEGER,
+            mac TEXT,
+            ip TEXT,
+            wave INTEGER,
+            state TEXT,
+            advanced INTEGER,
+            admitted TEXT,
+            finished TEXT,
+            error TEXT,
+            PRIMARY KEY (rollout_id, mac)
+        )
+        """
+    )
+
+    # Named ansible-playbook run profiles and the inventory groups using them
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS run_profiles (
+            name TEXT PRIMARY KEY,
+            settings TEXT,
+            updated TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS run_profile_groups (
+            group_name TEXT PRIMARY KEY,
+            profile TEXT
+        )
+        """
+    )
+
+    # Duration of every playbook run and the profile it used
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS playbook_runs (
+            id INTEGER PRIMARY KEY,
+            ip TEXT,
+            profile TEXT,
+            started TEXT,
+            seconds REAL,
+            outcome TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS playbook_runs_started ON playbook_runs(started)"
+    )
+
+    # Run statistics of background jobs (written by the leader process)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS task_status (
+            name TEXT PRIMARY KEY,
+            pid INTEGER,
+            running INTEGER,
+            runs INTEGER,
+            failures INTEGER,
+            last_start TEXT,
+            last_end TEXT,
+            last_duration REAL,
+            avg_duration REAL,
+            last_error TEXT,
+            last_result TEXT,
+            next_run TEXT,
+            updated TEXT
+        )
+        """
+    )
+
     return conn
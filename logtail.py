@@ -13,6 +13,9 @@ import json
 import subprocess
 import re
 import html
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from flask import (
@@ -22,19 +25,29 @@ from flask import (
     current_app,
     render_template,
 )
-from config import ANSIBLE_INVENTORY
+from config import ANSIBLE_INVENTORY, DB_PATH
+from services.streams import supervisor, StreamLimitError
+from services.metrics import ssh_call
+from services import logpages
 
 # ---------------------------------------------------------------------------
 # Константы и настройки
 # ---------------------------------------------------------------------------
 INI_FILE = ANSIBLE_INVENTORY
-DB_FILE = "logtail.sqlite"
+# Next to the main database instead of the working directory of the process
+DB_FILE = os.getenv(
+    "LOGTAIL_DB_PATH", os.path.join(os.path.dirname(DB_PATH), "logtail.sqlite")
+)
 
 # Defaults can be overridden via environment variables
 DEFAULT_SSH_USER = os.getenv("LOGTAIL_DEFAULT_SSH_USER", "root")
 DEFAULT_SSH_PASS = os.getenv("LOGTAIL_DEFAULT_SSH_PASS", "")
 DEFAULT_SSH_PORT = os.getenv("LOGTAIL_DEFAULT_SSH_PORT", "22")
 
+# How long a host's service catalog is reused before systemd is asked again
+SERVICE_CATALOG_TTL = int(os.getenv("LOGTAIL_SERVICE_CATALOG_TTL", "30"))
+SERVICE_STATUS_MAX_WORKERS = int(os.getenv("LOGTAIL_SERVICE_STATUS_WORKERS", "16"))
+
 logtail_bp = Blueprint("logtail", __name__)
 
 
@@ -94,11 +107,23 @@ def _init_db() -> None:
     init_logtail_db()
 
 
+_inventory_cache: dict = {"key": None, "hosts": {}}
+
+
 def load_inventory():
-    """Read Ansible inventory file and return mapping of hosts."""
+    """Read Ansible inventory file and return mapping of hosts.
+
+    The parsed mapping is cached until the file's inode, mtime or size
+    changes; callers must not modify it.
+    """
+    try:
+        st = os.stat(INI_FILE)
+    except OSError:
+        return {}
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if _inventory_cache["key"] == key:
+        return _inventory_cache["hosts"]
     hosts = {}
-    if not os.path.isfile(INI_FILE):
-        return hosts
     with open(INI_FILE) as f:
         for line in f:
             line = line.strip()
@@ -111,6 +136,7 @@ def load_inventory():
                         k, v = item.split("=", 1)
                         vars[k] = v
                 hosts[host] = vars
+    _inventory_cache.update(key=key, hosts=hosts)
     return hosts
 
 
@@ -154,6 +180,100 @@ def build_ssh_command(host: str, vars: dict, cmd: str):
     return False, ssh_cmd
 
 
+# ---------------------------------------------------------------------------
+# Service catalog
+# ---------------------------------------------------------------------------
+SERVICE_PROPERTIES = ("Id", "Description", "LoadState", "ActiveState", "SubState")
+
+_service_catalog: dict[str, tuple[float, dict]] = {}
+_service_catalog_lock = threading.Lock()
+_service_fetch_locks: dict[str, threading.Lock] = {}
+
+
+def service_unit_name(service: str) -> str:
+    """Return full unit name, appending ``.service`` when omitted."""
+    return service if service.endswith(".service") else f"{service}.service"
+
+
+def parse_systemctl_show(output: str) -> dict:
+    """Parse ``systemctl show`` output for several units.
+
+    Properties of every unit are printed as ``Key=Value`` lines and units are
+    separated by an empty line.  Returns mapping of unit name to its
+    properties.
+    """
+    catalog = {}
+    for block in output.split("\n\n"):
+        props = {}
+        for line in block.splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                props[key] = value
+        unit = props.get("Id")
+        if unit:
+            catalog[unit] = {
+                "name": unit,
+                "description": props.get("Description", ""),
+                "load": props.get("LoadState", ""),
+                "active": props.get("ActiveState", ""),
+                "sub": props.get("SubState", ""),
+            }
+    return catalog
+
+
+def fetch_service_catalog(host: str, vars: dict) -> dict:
+    """Collect state of all service units of *host* in one SSH round trip."""
+    cmd = (
+        "systemctl show --no-pager --property="
+        + ",".join(SERVICE_PROPERTIES)
+        + " '*.service'"
+    )
+    is_local, exec_cmd = build_ssh_command(host, vars, cmd)
+    with ssh_call("service_catalog") as call:
+        result = subprocess.run(
+            exec_cmd, capture_output=True, text=True, timeout=15, shell=is_local
+        )
+        call["ok"] = result.returncode == 0
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or "systemctl show failed")
+    return parse_systemctl_show(result.stdout)
+
+
+def get_service_catalog(host: str, vars: dict, refresh: bool = False) -> dict:
+    """Return cached service catalog of *host*, refreshing it when stale.
+
+    Concurrent requests for the same host share a single fetch so that
+    polling clients do not open parallel SSH sessions.
+    """
+    with _service_catalog_lock:
+        fetch_lock = _service_fetch_locks.setdefault(host, threading.Lock())
+    with fetch_lock:
+        cached = _service_catalog.get(host)
+        if (
+            cached
+            and not refresh
+            and time.monotonic() - cached[0] < SERVICE_CATALOG_TTL
+        ):
+            return cached[1]
+        catalog = fetch_service_catalog(host, vars)
+        with _service_catalog_lock:
+            _service_catalog[host] = (time.monotonic(), catalog)
+        return catalog
+
+
+def invalidate_service_catalog(host: str) -> None:
+    """Drop cached service catalog of *host*."""
+    with _service_catalog_lock:
+        _service_catalog.pop(host, None)
+
+
+def service_active_state(host: str, vars: dict, service: str) -> str:
+    """Return ``ActiveState`` of *service* on *host* or ``unknown``."""
+    catalog = get_service_catalog(host, vars)
+    unit = catalog.get(service_unit_name(service))
+    return unit["active"] if unit and unit["active"] else "unknown"
+
+
 # ---------------------------------------------------------------------------
 # Frontend route
 # ---------------------------------------------------------------------------
@@ -375,26 +495,143 @@ def api_tail(host):
     color_rules = [(row["keyword"], row["color"]) for row in color_rows]
 
     is_local, exec_cmd = build_ssh_command(host, vars, cmd)
+    try:
+        stream = supervisor.spawn(
+            "tail", host, request.remote_addr, exec_cmd, shell=is_local
+        )
+    except StreamLimitError as e:
+        return str(e), 429
 
     def generate():
-        proc = subprocess.Popen(
-            exec_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            shell=is_local,
+        for line in supervisor.iter_lines(stream):
+            if follow:
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                line = f"[{timestamp}] {line}"
+            colored_line = apply_color_rules_html(line, color_rules)
+            supervisor.record_sent(stream, len(colored_line.encode()))
+            yield colored_line
+
+    response = current_app.response_class(generate(), mimetype="text/html")
+    response.call_on_close(lambda: supervisor.release(stream))
+    return response
+
+
+# ---------------------------------------------------------------------------
+# Paged log browsing
+# ---------------------------------------------------------------------------
+def _configured_logpath(host):
+    """Return ``(path, vars)`` of the log chosen by ``path_id`` or an error response."""
+    path_id = request.args.get("path_id")
+    db = get_logtail_db()
+    if path_id:
+        row = db.execute(
+            "SELECT path FROM host_logpaths WHERE id=? AND host=?",
+            (path_id, host),
+        ).fetchone()
+    else:
+        row = db.execute(
+            "SELECT path FROM host_logpaths WHERE host=? LIMIT 1", (host,)
+        ).fetchone()
+    if not row or not row["path"]:
+        return None, ("log path not set", 400)
+    inventory = load_inventory()
+    if host not in inventory:
+        return None, ("unknown host", 404)
+    return (row["path"], inventory[host]), None
+
+
+def _run_remote(host, vars, cmd, site, timeout=60):
+    is_local, exec_cmd = build_ssh_command(host, vars, cmd)
+    with ssh_call(site) as call:
+        result = subprocess.run(
+            exec_cmd, capture_output=True, timeout=timeout, shell=is_local
         )
-        try:
-            for line in iter(proc.stdout.readline, ""):
-                if follow:
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    line = f"[{timestamp}] {line}"
-                colored_line = apply_color_rules_html(line, color_rules)
-                yield colored_line
-        finally:
-            proc.terminate()
+        call["ok"] = result.returncode == 0
+    return result
 
-    return current_app.response_class(generate(), mimetype="text/html")
+
+@logtail_bp.route("/api/logfiles/<host>")
+def api_logfiles(host):
+    """The configured log and its rotated siblings with sizes."""
+    target, error = _configured_logpath(host)
+    if error:
+        return error
+    logpath, vars = target
+    try:
+        result = _run_remote(host, vars, logpages.list_command(logpath), "log_files")
+    except subprocess.TimeoutExpired:
+        return jsonify({"status": "error", "error": "timeout"}), 504
+    if result.returncode != 0:
+        return jsonify({"status": "error", "error": result.stderr.decode(errors="replace").strip()}), 502
+    return jsonify({
+        "path": logpath,
+        "files": logpages.parse_list(result.stdout.decode(errors="replace"), logpath),
+    })
+
+
+@logtail_bp.route("/api/logpage/<host>")
+def api_logpage(host):
+    """A window of whole lines by byte offset.
+
+    ``direction=forward`` (default) reads ``length`` bytes from ``offset``,
+    ``backward`` the bytes before it; without ``offset`` the last page is
+    returned.  ``file`` selects a rotated sibling from ``/api/logfiles``.
+    """
+    target, error = _configured_logpath(host)
+    if error:
+        return error
+    logpath, vars = target
+    try:
+        path = logpages.sibling_path(logpath, request.args.get("file", ""))
+        offset = request.args.get("offset")
+        offset = max(int(offset), 0) if offset not in (None, "") else None
+        length = min(max(int(request.args.get("length", logpages.PAGE_DEFAULT)), 1), logpages.PAGE_MAX)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    backward = request.args.get("direction") == "backward" or offset is None
+    cmd = logpages.page_command(path, offset, length, backward)
+    try:
+        result = _run_remote(host, vars, cmd, "log_page")
+        page = logpages.parse_page(result.stdout, backward)
+    except subprocess.TimeoutExpired:
+        return jsonify({"status": "error", "error": "timeout"}), 504
+    except ValueError:
+        return jsonify({"status": "error", "error": result.stderr.decode(errors="replace").strip()}), 502
+    page.update(path=path, compressed=logpages.is_compressed(path))
+    return jsonify(page)
+
+
+@logtail_bp.route("/api/loggrep/<host>")
+def api_loggrep(host):
+    """Server-side ``grep -b -C`` over the log or a rotated sibling."""
+    target, error = _configured_logpath(host)
+    if error:
+        return error
+    logpath, vars = target
+    pattern = request.args.get("pattern", "")
+    if not pattern:
+        return jsonify({"status": "error", "error": "pattern required"}), 400
+    try:
+        path = logpages.sibling_path(logpath, request.args.get("file", ""))
+        context = min(max(int(request.args.get("context", 2)), 0), logpages.GREP_MAX_CONTEXT)
+        max_matches = min(max(int(request.args.get("max", 100)), 1), logpages.GREP_MAX_MATCHES)
+        offset = max(int(request.args.get("offset", 0)), 0)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    ignore_case = request.args.get("icase", "false").lower() == "true"
+    cmd = logpages.grep_command(path, pattern, context, max_matches, offset, ignore_case)
+    try:
+        result = _run_remote(host, vars, cmd, "log_grep", timeout=300)
+        found = logpages.parse_grep(result.stdout, max_matches)
+    except subprocess.TimeoutExpired:
+        return jsonify({"status": "error", "error": "timeout"}), 504
+    except ValueError:
+        return jsonify({"status": "error", "error": result.stderr.decode(errors="replace").strip()}), 502
+    if not found["matches"] and result.stderr.strip():
+        # e.g. an invalid pattern; grep's status is hidden by the pipe
+        return jsonify({"status": "error", "error": result.stderr.decode(errors="replace").strip()}), 400
+    found.update(path=path, pattern=pattern)
+    return jsonify(found)
 
 
 def apply_color_rules_html(line, color_rules):
@@ -423,25 +660,15 @@ def api_journal_services(host):
     if host not in inventory:
         return "unknown host", 404
     vars = inventory[host]
-    cmd = "systemctl list-units --type=service --no-pager --no-legend | head -50"
-    is_local, exec_cmd = build_ssh_command(host, vars, cmd)
+    refresh = request.args.get("refresh", "false").lower() == "true"
     try:
-        result = subprocess.run(
-            exec_cmd, capture_output=True, text=True, timeout=10, shell=is_local
-        )
-        if result.returncode == 0:
-            services = []
-            for line in result.stdout.strip().split("\n"):
-                if line:
-                    parts = line.split(None, 4)
-                    if len(parts) >= 5:
-                        service_name = parts[0]
-                        description = parts[4]
-                        services.append({"name": service_name, "description": description})
-            return jsonify({"services": services})
-        return "Failed to get services", 500
+        catalog = get_service_catalog(host, vars, refresh=refresh)
+        services = sorted(catalog.values(), key=lambda s: s["name"])
+        return jsonify({"services": services})
     except subprocess.TimeoutExpired:
         return "Timeout getting services", 500
+    except RuntimeError:
+        return "Failed to get services", 500
     except Exception as e:  # pragma: no cover
         return f"Error: {e}", 500
 
@@ -475,22 +702,44 @@ def api_journal(host):
                 cmd += f" | grep --line-buffered -v -E {shlex.quote(exc.strip())}"
 
     is_local, exec_cmd = build_ssh_command(host, vars, cmd)
+    try:
+        stream = supervisor.spawn(
+            "journal", host, request.remote_addr, exec_cmd, shell=is_local
+        )
+    except StreamLimitError as e:
+        return str(e), 429
 
     def generate():
-        proc = subprocess.Popen(
-            exec_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            shell=is_local,
-        )
-        try:
-            for line in iter(proc.stdout.readline, ""):
-                yield line
-        finally:
-            proc.terminate()
+        for line in supervisor.iter_lines(stream):
+            supervisor.record_sent(stream, len(line.encode()))
+            yield line
 
-    return current_app.response_class(generate(), mimetype="text/plain")
+    response = current_app.response_class(generate(), mimetype="text/plain")
+    response.call_on_close(lambda: supervisor.release(stream))
+    return response
+
+
+@logtail_bp.route("/api/streams", methods=["GET", "DELETE"])
+def api_streams():
+    """List active log streams or kill one of them."""
+    if request.method == "DELETE":
+        stream_id = (request.json or {}).get("id")
+        try:
+            stream_id = int(stream_id)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "error": "id required"}), 400
+        if not supervisor.kill(stream_id):
+            return jsonify({"status": "error", "error": "stream not found"}), 404
+        return jsonify({"status": "ok"})
+    return jsonify({
+        "streams": supervisor.list(),
+        "limits": {
+            "total": supervisor.max_total,
+            "per_host": supervisor.max_per_host,
+            "idle_timeout": supervisor.idle_timeout,
+            "max_age": supervisor.max_age,
+        },
+    })
 
 
 @logtail_bp.route("/api/journal-status/<host>")
@@ -502,18 +751,59 @@ def api_journal_status_get(host):
     if host not in inventory:
         return jsonify({"status": "error", "error": "unknown host"}), 404
     vars = inventory[host]
-    cmd = f"systemctl is-active {shlex.quote(service)}.service"
-    is_local, exec_cmd = build_ssh_command(host, vars, cmd)
     try:
-        result = subprocess.run(
-            exec_cmd, capture_output=True, text=True, timeout=10, shell=is_local
-        )
-        status = result.stdout.strip() if result.returncode == 0 else "unknown"
-        return jsonify({"active": status})
+        return jsonify({"active": service_active_state(host, vars, service)})
     except Exception as e:  # pragma: no cover
         return jsonify({"status": "error", "error": str(e)})
 
 
+@logtail_bp.route("/api/journal-status")
+def api_journal_status_bulk():
+    """Return active state of many services on one host or of one service
+    on many hosts.
+
+    Query parameters are either ``host`` with comma separated ``services`` or
+    ``service`` with comma separated ``hosts``.
+    """
+    host = request.args.get("host", "")
+    service = request.args.get("service", "")
+    services = [s.strip() for s in request.args.get("services", "").split(",") if s.strip()]
+    hosts = [h.strip() for h in request.args.get("hosts", "").split(",") if h.strip()]
+    inventory = load_inventory()
+
+    if host and services:
+        if host not in inventory:
+            return jsonify({"status": "error", "error": "unknown host"}), 404
+        try:
+            catalog = get_service_catalog(host, inventory[host])
+        except Exception as e:
+            return jsonify({"status": "error", "error": str(e)}), 500
+        statuses = {}
+        for name in services:
+            unit = catalog.get(service_unit_name(name))
+            statuses[name] = unit["active"] if unit and unit["active"] else "unknown"
+        return jsonify({"host": host, "statuses": statuses})
+
+    if service and hosts:
+        def state_for(h):
+            if h not in inventory:
+                return h, "unknown host"
+            try:
+                return h, service_active_state(h, inventory[h], service)
+            except Exception:
+                return h, "unknown"
+
+        workers = max(1, min(SERVICE_STATUS_MAX_WORKERS, len(hosts)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            statuses = dict(pool.map(state_for, hosts))
+        return jsonify({"service": service, "statuses": statuses})
+
+    return jsonify({
+        "status": "error",
+        "error": "host+services or service+hosts parameters required",
+    }), 400
+
+
 @logtail_bp.route("/api/journal-control/<host>", methods=["POST"])
 def api_journal_control(host):
     data = request.json
@@ -530,13 +820,17 @@ def api_journal_control(host):
     cmd = f"sudo systemctl {action} {shlex.quote(service)}.service"
     is_local, exec_cmd = build_ssh_command(host, vars, cmd)
     try:
-        result = subprocess.run(
-            exec_cmd, capture_output=True, text=True, timeout=30, shell=is_local
-        )
+        with ssh_call("journal_control") as call:
+            result = subprocess.run(
+                exec_cmd, capture_output=True, text=True, timeout=30, shell=is_local
+            )
+            call["ok"] = result.returncode == 0
+        invalidate_service_catalog(host)
         if result.returncode == 0:
             return jsonify({"status": "success"})
         return jsonify({"status": "error", "error": result.stderr.strip()}), 500
     except subprocess.TimeoutExpired:
+        invalidate_service_catalog(host)
         return jsonify({"status": "error", "error": "timeout"}), 500
     except Exception as e:  # pragma: no cover
         return jsonify({"status": "error", "error": str(e)}), 500
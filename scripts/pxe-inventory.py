@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Ansible dynamic inventory script backed by pxe-watch.
+
+    ansible-playbook -i scripts/pxe-inventory.py playbook.yml
+
+Fetches ``/api/ansible/dynamic-inventory`` from ``PXE_WATCH_URL`` (default
+``http://127.0.0.1:5000``).  Only the standard library is used so the script
+runs on any Ansible controller.
+"""
+
+import json
+import os
+import sys
+import urllib.request
+
+URL = os.getenv('PXE_WATCH_URL', 'http://127.0.0.1:5000').rstrip('/')
+TIMEOUT = float(os.getenv('PXE_WATCH_TIMEOUT', 30))
+
+
+def main() -> int:
+    if len(sys.argv) > 2 and sys.argv[1] == '--host':
+        # All host variables are returned in _meta.hostvars by --list
+        print('{}')
+        return 0
+    if sys.argv[1:] != ['--list']:
+        print(f'usage: {sys.argv[0]} --list | --host <name>', file=sys.stderr)
+        return 2
+    try:
+        with urllib.request.urlopen(f'{URL}/api/ansible/dynamic-inventory', timeout=TIMEOUT) as resp:
+            data = json.load(resp)
+    except (OSError, ValueError) as e:
+        print(f'pxe-watch inventory unavailable: {e}', file=sys.stderr)
+        return 1
+    json.dump(data, sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,8 +10,27 @@ from config import (
     SSH_PASSWORD,
     SSH_USER,
     SSH_OPTIONS,
+    UPLOAD_MAX_BYTES,
 )
 from db_utils import get_db
+from .metrics import ssh_call
+from .hosts import registry as host_registry
+from .marks import IN_PROGRESS, MarkError, marks, normalize_mark
+from .listing import lister
+from .hash_index import digest_headers
+from .files import (
+    send_path,
+    receive_upload,
+    atomic_write,
+    file_etag,
+    read_file_versioned,
+    conditional_response,
+    not_modified,
+    if_match_failed,
+    write_lock,
+    UploadOffsetError,
+    UploadTooLargeError,
+)
 
 
 def read_file(path: str) -> str:
@@ -24,54 +43,15 @@ def read_file(path: str) -> str:
 
 
 def write_file(path: str, content: str) -> None:
-    """Write content to a file creating directories if needed."""
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(content)
+    """Atomically write content to a file creating directories if needed."""
+    atomic_write(path, content.encode('utf-8'))
     logging.info(f'Файл {path} обновлён')
 
 
 def list_files_in_dir(directory: str):
     """Return list of files in directory with size, mtime and type."""
     os.makedirs(directory, exist_ok=True)
-    file_list = []
-    for f in os.listdir(directory):
-        file_path = os.path.join(directory, f)
-        try:
-            stat_info = os.stat(file_path)
-        except OSError as e:
-            logging.warning(
-                f"Не удалось получить информацию о файле {file_path}: {e}"
-            )
-            continue
-
-        is_dir = os.path.isdir(file_path)
-        size_str = "-"
-        if not is_dir:
-            size_bytes = stat_info.st_size
-            if size_bytes < 1024:
-                size_str = f"{size_bytes} B"
-            elif size_bytes < 1024 ** 2:
-                size_str = f"{size_bytes / 1024:.1f} KB"
-            elif size_bytes < 1024 ** 3:
-                size_str = f"{size_bytes / (1024 ** 2):.1f} MB"
-            else:
-                size_str = f"{size_bytes / (1024 ** 3):.1f} GB"
-
-        modified_str = datetime.datetime.fromtimestamp(
-            stat_info.st_mtime
-        ).strftime('%d.%m.%Y %H:%M')
-        file_list.append(
-            {
-                'name': f,
-                'size': size_str,
-                'modified': modified_str,
-                'is_dir': is_dir,
-            }
-        )
-
-    file_list.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
-    return file_list
+    return lister.page(directory)['files']
 
 
 def sync_inventory_hosts() -> None:
@@ -90,25 +70,31 @@ def sync_inventory_hosts() -> None:
         if not cfg.read(ANSIBLE_INVENTORY):
             return
         now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        missing = []
+        for section in cfg.sections():
+            mac_val = None
+            for key, val in cfg.items(section):
+                if key.startswith("mac") and val:
+                    mac_val = val.lower()
+                    break
+            if not mac_val or mac_val in host_registry:
+                continue
+            ip_val = cfg[section].get("ip")
+            if not ip_val and re.match(r"^\d{1,3}(\.\d{1,3}){3}$", section):
+                ip_val = section
+            missing.append((mac_val, ip_val or '—', now, now))
+        if not missing:
+            return
         with get_db() as db:
-            for section in cfg.sections():
-                mac_val = None
-                for key, val in cfg.items(section):
-                    if key.startswith("mac") and val:
-                        mac_val = val.lower()
-                        break
-                if not mac_val:
-                    continue
-                ip_val = cfg[section].get("ip")
-                if not ip_val and re.match(r"^\d{1,3}(\.\d{1,3}){3}$", section):
-                    ip_val = section
-                db.execute(
-                    """
-                    INSERT OR IGNORE INTO hosts(mac, ip, stage, details, ts, first_ts)
-                    VALUES (?, ?, '', '', ?, ?)
-                    """,
-                    (mac_val, ip_val or '—', now, now),
-                )
+            db.executemany(
+                """
+                INSERT OR IGNORE INTO hosts(mac, ip, stage, details, ts, first_ts)
+                VALUES (?, ?, '', '', ?, ?)
+                """,
+                missing,
+            )
+        for mac_val, ip_val, ts, _ in missing:
+            host_registry.add_missing(mac_val, ip_val, ts)
     except Exception as e:
         logging.warning(f"Не удалось синхронизировать инвентарь: {e}")
 
@@ -128,51 +114,56 @@ def set_playbook_status(ip: str, status: str) -> None:
                 """,
                 (ip, status, now),
             )
+        host_registry.set_playbook(ip, status, now)
     except Exception as e:
         logging.error(f"Ошибка обновления статуса playbook для {ip}: {e}")
 
 
 
 def get_ansible_mark(ip: str):
-    """Fetch ``/opt/ansible_mark.json`` or fall back to stored status.
+    """Return the host's Ansible mark, reading ``/opt/ansible_mark.json`` if needed.
 
-    Returns a dict with at least a ``status`` field.  When the mark file is
-    unavailable but a status exists in the local database, the database value is
-    returned so that the dashboard can still reflect the final playbook result.
+    Returns a dict with at least a ``status`` field.  A mark pushed by the host
+    (see :mod:`services.marks`) or read earlier is returned without SSH until
+    the next playbook run is queued; a queued run is reported as ``pending``
+    and during a run the file is only read once the push deadline has passed.
+    When the mark file is unavailable but a status exists in the local
+    database, the database value is returned so that the dashboard can still
+    reflect the final playbook result.
     """
     if not re.match(r'^\d{1,3}(\.\d{1,3}){3}$', ip) or ip == '—':
         return {'status': 'error', 'msg': 'Invalid IP'}
     db_status = None
     db_updated = None
     try:
-        with get_db() as db:
-            row = db.execute(
-                "SELECT status, updated FROM playbook_status WHERE ip = ?",
-                (ip,),
-            ).fetchone()
-        if row:
-            db_status = row['status']
-            db_updated = row['updated']
+        stored = host_registry.playbook(ip)
+        if stored:
+            db_status, db_updated = stored
+        mark = marks.current(ip)
+        if mark is not None:
+            return mark
+        if db_status == 'queued' or marks.awaiting_push(ip):
+            # The mark file still holds the previous run's result
+            return {'status': 'pending', 'install_date': db_updated}
 
         cmd = (
             f"sshpass -p '{SSH_PASSWORD}' ssh {SSH_OPTIONS} {SSH_USER}@{ip} "
             "'cat /opt/ansible_mark.json'"
         )
-        result = subprocess.run(
-            cmd, shell=True, capture_output=True, text=True, timeout=10
-        )
+        with ssh_call('get_ansible_mark') as call:
+            result = subprocess.run(
+                cmd, shell=True, capture_output=True, text=True, timeout=10
+            )
+            call['ok'] = result.returncode == 0
         if result.returncode == 0:
             try:
-                data = json.loads(result.stdout)
-                data['status'] = (data.get('status', 'ok') or 'ok').lower()
-                if data['status'] == 'success':
-                    data['status'] = 'ok'
+                data = normalize_mark(json.loads(result.stdout), strict=False)
                 # Once the mark file is successfully read we assume the
-                # playbook finished and update the stored status so that
-                # subsequent calls don't fall back to "running" when the host
-                # becomes unreachable.
+                # playbook finished and store the mark and status so that
+                # subsequent calls neither SSH again nor fall back to
+                # "running" when the host becomes unreachable.
                 try:
-                    set_playbook_status(ip, data['status'])
+                    marks.store(ip, data, 'ssh')
                 except Exception:
                     # Updating the database is best-effort; any failure should
                     # not prevent returning the fetched data.
@@ -180,11 +171,11 @@ def get_ansible_mark(ip: str):
                         f"Не удалось сохранить статус playbook для {ip}"
                     )
                 return data
-            except json.JSONDecodeError as e:
+            except (json.JSONDecodeError, MarkError) as e:
                 if db_status and db_updated:
                     if db_status in ('ok', 'failed'):
                         return {'status': db_status, 'install_date': db_updated}
-                    if db_status == 'running':
+                    if db_status in IN_PROGRESS:
                         return {'status': 'pending', 'install_date': db_updated}
                 return {
                     'status': 'error',
@@ -194,7 +185,7 @@ def get_ansible_mark(ip: str):
         if db_status and db_updated:
             if db_status in ('ok', 'failed'):
                 return {'status': db_status, 'install_date': db_updated}
-            if db_status == 'running':
+            if db_status in IN_PROGRESS:
                 return {'status': 'pending', 'install_date': db_updated}
 
         if result.returncode != 0:
@@ -209,45 +200,85 @@ def get_ansible_mark(ip: str):
         if db_status and db_updated:
             if db_status in ('ok', 'failed'):
                 return {'status': db_status, 'install_date': db_updated}
-            if db_status == 'running':
+            if db_status in IN_PROGRESS:
                 return {'status': 'pending', 'install_date': db_updated}
         return {'status': 'error', 'msg': 'Таймаут подключения к хосту'}
     except Exception as e:
         if db_status and db_updated:
             if db_status in ('ok', 'failed'):
                 return {'status': db_status, 'install_date': db_updated}
-            if db_status == 'running':
+            if db_status in IN_PROGRESS:
                 return {'status': 'pending', 'install_date': db_updated}
         return {'status': 'error', 'msg': f'Внутренняя ошибка: {str(e)}'}
 
 
-def create_file_api_handlers(file_path_getter, allow_missing_get: bool = False, name_prefix: str = ""):
-    """Create GET/POST handlers for file based APIs."""
+def create_file_api_handlers(
+    file_path_getter,
+    allow_missing_get: bool = False,
+    name_prefix: str = "",
+    mimetype: str = None,
+    strong_etag: bool = False,
+    digest_lookup=None,
+):
+    """Create GET/POST handlers for file based APIs.
+
+    GET streams the file with ``Range`` support; ``mimetype`` defaults to a
+    guess from the file name.  POST streams the request body into the file
+    (see :func:`services.files.receive_upload`); the ``offset`` query
+    parameter makes the upload resumable and ``final=0`` marks intermediate
+    chunks.
+
+    With ``strong_etag`` (small text files) GET uses a content-hash ETag and
+    answers ``If-None-Match`` with 304, and POST honours ``If-Match``.
+    ``digest_lookup`` returns a known SHA-256 of a file (or ``None``) which
+    is then sent as ETag and ``Digest`` header without hashing the file.
+    """
 
     def get_handler(*args, **kwargs):
+        file_path = file_path_getter(*args, **kwargs)
         try:
-            file_path = file_path_getter(*args, **kwargs)
-            return read_file(file_path), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+            if strong_etag:
+                cached = not_modified(file_etag(file_path))
+                if cached is not None:
+                    return cached
+                data, etag, mtime = read_file_versioned(file_path)
+                return conditional_response(data, etag, mtime, mimetype or 'text/plain')
+            digest = digest_lookup(file_path) if digest_lookup else None
+            response = send_path(file_path, mimetype, etag=digest or True)
+            if digest:
+                response.headers.update(digest_headers(digest))
+            return response
         except FileNotFoundError:
             if allow_missing_get:
                 return '', 200
-            return read_file(file_path_getter(*args, **kwargs))
+            abort(404)
         except Exception as e:
-            logging.error(
-                f'Ошибка при чтении файла {file_path_getter(*args, **kwargs)}: {e}'
-            )
+            logging.error(f'Ошибка при чтении файла {file_path}: {e}')
             return 'Ошибка', 500
 
     def post_handler(*args, **kwargs):
+        file_path = file_path_getter(*args, **kwargs)
+        offset = request.args.get('offset', type=int)
+        final = request.args.get('final', '1') != '0'
+        if offset is None and not final:
+            return jsonify({'status': 'error', 'msg': 'final=0 requires offset'}), 400
+        if (request.content_length or 0) + (offset or 0) > UPLOAD_MAX_BYTES:
+            return jsonify({'status': 'error', 'msg': 'file too large'}), 413
         try:
-            file_path = file_path_getter(*args, **kwargs)
-            body = request.get_data(as_text=True)
-            write_file(file_path, body)
-            return jsonify({'status': 'ok'}), 200
+            if strong_etag:
+                with write_lock:
+                    if if_match_failed(file_etag(file_path)):
+                        return jsonify({'status': 'error', 'msg': 'file was modified'}), 412
+                    size = receive_upload(file_path, request.stream, offset, final)
+                return jsonify({'status': 'ok', 'size': size, 'etag': file_etag(file_path)}), 200
+            size = receive_upload(file_path, request.stream, offset, final)
+            return jsonify({'status': 'ok', 'size': size}), 200
+        except UploadOffsetError as e:
+            return jsonify({'status': 'error', 'msg': str(e), 'offset': e.current}), 409
+        except UploadTooLargeError as e:
+            return jsonify({'status': 'error', 'msg': str(e)}), 413
         except Exception as e:
-            logging.error(
-                f'Ошибка при записи файла {file_path_getter(*args, **kwargs)}: {e}'
-            )
+            logging.error(f'Ошибка при записи файла {file_path}: {e}')
             return jsonify({'status': 'error', 'msg': str(e)}), 500
 
     get_handler.__name__ = f"{name_prefix}_get_handler"
@@ -0,0 +1,371 @@
+"""Installation duration analytics from stage transitions.
+
+When a host reports a new stage, the time it spent in the previous one is
+written to ``stage_transitions``; reaching one of ``INSTALL_DONE_STAGES``
+also records the whole install under the ``TOTAL`` stage.  Every duration is
+folded right away into ``install_rollups`` rows per hour and day bucket,
+preseed/playbook version and stage.  A row keeps count, sum, max and a
+:class:`DurationSketch`, a log-bucketed histogram whose bins simply add up,
+so percentiles of any range come from merging a few rollup rows instead of
+scanning transitions.
+
+Durations above ``ANALYTICS_OUTLIER_FACTOR`` times the recent p95 of their
+stage are copied to ``install_outliers`` as they arrive.
+"""
+
+import datetime
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from config import ANSIBLE_PLAYBOOK, INSTALL_DONE_STAGES, PRESEED_PATH
+from db_utils import get_db
+from services.files import file_etag
+
+SKETCH_ACCURACY = float(os.getenv('ANALYTICS_SKETCH_ACCURACY', 0.01))
+BASELINE_DAYS = int(os.getenv('ANALYTICS_BASELINE_DAYS', 7))
+BASELINE_TTL = float(os.getenv('ANALYTICS_BASELINE_TTL', 300))
+OUTLIER_FACTOR = float(os.getenv('ANALYTICS_OUTLIER_FACTOR', 1.5))
+MIN_SAMPLES = int(os.getenv('ANALYTICS_MIN_SAMPLES', 20))
+
+TOTAL = '_total'
+HOUR = 'hour'
+DAY = 'day'
+# Length of the bucket prefix of a 'YYYY-MM-DD HH:MM:SS' timestamp
+BUCKET_LEN = {HOUR: 13, DAY: 10}
+
+
+def _seconds(start: str, end: str) -> float:
+    delta = datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start)
+    return max(delta.total_seconds(), 0.0)
+
+
+def current_version() -> str:
+    """Short content hashes of the preseed and the playbook, ``<preseed>/<playbook>``."""
+    preseed = file_etag(PRESEED_PATH) or ''
+    playbook = file_etag(ANSIBLE_PLAYBOOK) or ''
+    return f'{preseed[:8] or "none"}/{playbook[:8] or "none"}'
+
+
+class DurationSketch:
+    """Histogram with logarithmic bins and relative error ``accuracy``.
+
+    A value lands in bin ``ceil(log_gamma(value))``; sketches built with the
+    same accuracy merge by adding bin counts.
+    """
+
+    MIN_VALUE = 0.01
+
+    def __init__(self, bins: dict = None, zero: int = 0, accuracy: float = SKETCH_ACCURACY):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = bins or {}
+        self.zero = zero
+
+    @property
+    def count(self) -> int:
+        return self.zero + sum(self.bins.values())
+
+    def add(self, value: float, n: int = 1) -> None:
+        if value < self.MIN_VALUE:
+            self.zero += n
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + n
+
+    def merge(self, other: 'DurationSketch') -> None:
+        self.zero += other.zero
+        for index, n in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + n
+
+    def quantile(self, q: float):
+        count = self.count
+        if not count:
+            return None
+        rank = q * (count - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        index = None
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                break
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def to_json(self) -> str:
+        return json.dumps({'z': self.zero, 'b': self.bins}, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text: str) -> 'DurationSketch':
+        data = json.loads(text) if text else {}
+        return cls({int(k): v for k, v in data.get('b', {}).items()}, data.get('z', 0))
+
+
+class Rollup:
+    """Count, sum, max and sketch of a set of durations."""
+
+    __slots__ = ('count', 'total', 'max', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sketch = DurationSketch()
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.sketch.add(seconds)
+
+    def merge_row(self, row) -> None:
+        self.count += row['count']
+        self.total += row['total']
+        self.max = max(self.max, row['max'])
+        self.sketch.merge(DurationSketch.from_json(row['sketch']))
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'max': None}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 1),
+            'p50': round(min(self.sketch.quantile(0.5), self.max), 1),
+            'p95': round(min(self.sketch.quantile(0.95), self.max), 1),
+            'max': round(self.max, 1),
+        }
+
+
+def _merge(rows, key) -> dict:
+    merged: dict = {}
+    for row in rows:
+        merged.setdefault(key(row), Rollup()).merge_row(row)
+    return merged
+
+
+def _fold(db, period: str, bucket: str, version: str, stage: str, seconds: float) -> None:
+    row = db.execute(
+        'SELECT count, total, max, sketch FROM install_rollups'
+        ' WHERE period = ? AND bucket = ? AND version = ? AND stage = ?',
+        (period, bucket, version, stage),
+    ).fetchone()
+    sketch = DurationSketch.from_json(row['sketch'] if row else None)
+    sketch.add(seconds)
+    db.execute(
+        """
+        INSERT INTO install_rollups(period, bucket, version, stage, count, total, max, sketch)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(period, bucket, version, stage) DO UPDATE SET
+            count = excluded.count,
+            total = excluded.total,
+            max = excluded.max,
+            sketch = excluded.sketch
+        """,
+        (
+            period, bucket, version, stage,
+            (row['count'] if row else 0) + 1,
+            (row['total'] if row else 0.0) + seconds,
+            max(row['max'] if row else 0.0, seconds),
+            sketch.to_json(),
+        ),
+    )
+
+
+class InstallAnalytics:
+    """Records stage transitions and answers duration queries from rollups."""
+
+    def __init__(self):
+        # mac -> (stage, entered, install started, version)
+        self._progress: dict[str, tuple] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._baseline: dict[str, Rollup] = {}
+        self._baseline_at = None
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with get_db() as db:
+                for row in db.execute(
+                    'SELECT mac, stage, entered, started, version FROM install_progress'
+                ):
+                    self._progress[row['mac']] = (
+                        row['stage'], row['entered'], row['started'], row['version'],
+                    )
+            self._loaded = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._progress.clear()
+            self._loaded = False
+            self._baseline_at = None
+
+    def observe(self, mac: str, stage: str, ts: str) -> None:
+        """Record the stage *mac* reported at *ts*; a repeated stage is free."""
+        if not stage:
+            return
+        self._ensure_loaded()
+        current = self._progress.get(mac)
+        if current is not None and current[0] == stage:
+            return
+        durations = []
+        if current is None or current[0] in INSTALL_DONE_STAGES:
+            started, version = ts, current_version()
+        else:
+            previous, entered, started, version = current
+            durations.append((previous, entered, _seconds(entered, ts)))
+            if stage in INSTALL_DONE_STAGES:
+                durations.append((TOTAL, started, _seconds(started, ts)))
+        baseline = self.baseline() if durations else {}
+        with get_db() as db:
+            # Rollups are read-modify-write; take the write lock up front
+            db.execute('BEGIN IMMEDIATE')
+            for from_stage, begun, seconds in durations:
+                db.execute(
+                    """
+                    INSERT INTO stage_transitions(
+                        mac, from_stage, to_stage, started, ended, seconds, version
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (mac, from_stage, stage, begun, ts, seconds, version),
+                )
+                for period, length in BUCKET_LEN.items():
+                    _fold(db, period, ts[:length], version, from_stage, seconds)
+                limit = self._limit(baseline, from_stage)
+                if limit is not None and seconds > limit:
+                    db.execute(
+                        """
+                        INSERT INTO install_outliers(mac, stage, seconds, baseline, ended, version)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (mac, from_stage, seconds, limit, ts, version),
+                    )
+                    logging.info(
+                        f'Хост {mac} медленно прошёл этап {from_stage}: {seconds:.0f} с'
+                    )
+            db.execute(
+                """
+                INSERT INTO install_progress(mac, stage, entered, started, version)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(mac) DO UPDATE SET
+                    stage = excluded.stage,
+                    entered = excluded.entered,
+                    started = excluded.started,
+                    version = excluded.version
+                """,
+                (mac, stage, ts, started, version),
+            )
+        self._progress[mac] = (stage, ts, started, version)
+
+    def baseline(self) -> dict:
+        """Per-stage rollups of the last ``BASELINE_DAYS`` days, cached for ``BASELINE_TTL``."""
+        now = time.monotonic()
+        if self._baseline_at is None or now - self._baseline_at > BASELINE_TTL:
+            since = datetime.datetime.utcnow() - datetime.timedelta(days=BASELINE_DAYS)
+            self._baseline = _merge(self._rows(DAY, since), lambda r: r['stage'])
+            self._baseline_at = now
+        return self._baseline
+
+    @staticmethod
+    def _limit(baseline: dict, stage: str):
+        rollup = baseline.get(stage)
+        if rollup is None or rollup.count < MIN_SAMPLES:
+            return None
+        return rollup.sketch.quantile(0.95) * OUTLIER_FACTOR
+
+    @staticmethod
+    def _rows(period: str, since: datetime.datetime, version: str = None) -> list:
+        sql = (
+            'SELECT bucket, version, stage, count, total, max, sketch FROM install_rollups'
+            ' WHERE period = ? AND bucket >= ?'
+        )
+        params = [period, since.strftime('%Y-%m-%d %H:%M:%S')[:BUCKET_LEN[period]]]
+        if version:
+            sql += ' AND version = ?'
+            params.append(version)
+        with get_db() as db:
+            return db.execute(sql, params).fetchall()
+
+    def report(self, days: float = 30, version: str = None) -> dict:
+        """Fleet durations over the last *days*: per stage, per version and per bucket."""
+        period = HOUR if days <= 2 else DAY
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        rows = self._rows(period, since, version)
+        stages = _merge(rows, lambda r: r['stage'])
+        total = stages.pop(TOTAL, Rollup())
+        totals = [r for r in rows if r['stage'] == TOTAL]
+        versions = _merge(totals, lambda r: r['version'])
+        series = _merge(totals, lambda r: r['bucket'])
+        return {
+            'period': period,
+            'since': since.strftime('%Y-%m-%d %H:%M:%S'),
+            'version': version,
+            'current_version': current_version(),
+            'install': total.summary(),
+            'stages': {stage: r.summary() for stage, r in sorted(stages.items())},
+            'versions': {v: r.summary() for v, r in sorted(versions.items())},
+            'series': [
+                dict(bucket=bucket, **r.summary()) for bucket, r in sorted(series.items())
+            ],
+        }
+
+    def outliers(self, days: float = 7, limit: int = 50) -> dict:
+        """Slow transitions recorded in the last *days* and hosts slow right now."""
+        since = (
+            datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        ).strftime('%Y-%m-%d %H:%M:%S')
+        with get_db() as db:
+            recorded = db.execute(
+                """
+                SELECT mac, stage, ROUND(seconds, 1) AS seconds, ROUND(baseline, 1) AS baseline,
+                       ended, version
+                FROM install_outliers
+                WHERE ended >= ? ORDER BY seconds / baseline DESC LIMIT ?
+                """,
+                (since, limit),
+            ).fetchall()
+        self._ensure_loaded()
+        baseline = self.baseline()
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        running = []
+        for mac, (stage, entered, started, version) in list(self._progress.items()):
+            if stage in INSTALL_DONE_STAGES or entered < since:
+                continue
+            limit_s = self._limit(baseline, stage)
+            seconds = _seconds(entered, now)
+            if limit_s is not None and seconds > limit_s:
+                running.append({
+                    'mac': mac, 'stage': stage, 'seconds': round(seconds, 1),
+                    'baseline': round(limit_s, 1), 'entered': entered, 'version': version,
+                })
+        running.sort(key=lambda h: h['seconds'] / h['baseline'], reverse=True)
+        return {
+            'since': since,
+            'completed': [dict(row) for row in recorded],
+            'in_progress': running[:limit],
+        }
+
+    def prune(self, cutoff: str) -> int:
+        """Drop raw transitions, outliers and hourly rollups older than *cutoff*."""
+        with get_db() as db:
+            deleted = db.execute(
+                'DELETE FROM stage_transitions WHERE ended < ?', (cutoff,)
+            ).rowcount
+            deleted += db.execute(
+                'DELETE FROM install_outliers WHERE ended < ?', (cutoff,)
+            ).rowcount
+            deleted += db.execute(
+                'DELETE FROM install_rollups WHERE period = ? AND bucket < ?',
+                (HOUR, cutoff[:BUCKET_LEN[HOUR]]),
+            ).rowcount
+        return deleted
+
+
+analytics = InstallAnalytics()
@@ -0,0 +1,246 @@
+"""Boot artifact serving: hot-file cache and per-host download stats.
+
+Files up to ``ARTIFACT_CACHE_FILE_MAX`` are kept in an LRU memory cache
+bounded by ``ARTIFACT_CACHE_BYTES``.  When many clients request the same
+uncached file at once only the first one reads it from disk; the others wait
+for that read and are served from memory.  Larger files are streamed from
+disk by ``send_file``.
+
+Downloads are accounted to the requesting host (``mac`` argument or client
+IP).  Bodies the server iterates (cached files, ranges) are counted chunk by
+chunk as the server writes them, so the byte counter and ``last_activity``
+move during the download and a stalled one shows up as idle.  A large file
+the server sends with ``sendfile`` never passes through Python; it is
+credited with its full length once the server closes it and is reported as
+``sending`` until then.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_BYTES = int(os.getenv('ARTIFACT_CACHE_BYTES', 512 * 1024 ** 2))
+CACHE_FILE_MAX = int(os.getenv('ARTIFACT_CACHE_FILE_MAX', 64 * 1024 ** 2))
+DOWNLOAD_STATS_TTL = int(os.getenv('ARTIFACT_STATS_TTL', 6 * 3600))
+
+
+def _stat_key(st: os.stat_result) -> tuple:
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class HotFileCache:
+    """LRU cache of small file contents validated by ``(inode, mtime, size)``."""
+
+    def __init__(self, max_bytes: int = CACHE_BYTES, file_max: int = CACHE_FILE_MAX):
+        self.max_bytes = max_bytes
+        self.file_max = file_max
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[tuple, bytes]] = OrderedDict()
+        self._loading: dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def cacheable(self, st: os.stat_result) -> bool:
+        return self.max_bytes > 0 and st.st_size <= self.file_max
+
+    def get(self, path: str, st: os.stat_result) -> bytes:
+        """Return content of *path* as of *st*, reading it at most once.
+
+        Raises:
+            OSError: if the file cannot be read.
+        """
+        key = _stat_key(st)
+        while True:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None and entry[0] == key:
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    return entry[1]
+                loading = self._loading.get(path)
+                if loading is None:
+                    loading = self._loading[path] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another request is reading this file; use its result
+            loading.wait()
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None and entry[0] == key:
+                    self.hits += 1
+                    return entry[1]
+            # The file changed meanwhile or the read failed: try ourselves
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+                key = _stat_key(os.fstat(f.fileno()))
+            with self._lock:
+                old = self._entries.pop(path, None)
+                if old is not None:
+                    self.size -= len(old[1])
+                self._entries[path] = (key, data)
+                self.size += len(data)
+                while self.size > self.max_bytes and self._entries:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+            return data
+        finally:
+            with self._lock:
+                self._loading.pop(path, None)
+            loading.set()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'file_max': self.file_max,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class _Download:
+    __slots__ = ('client', 'ip', 'bytes', 'requests', 'active', 'sending', 'files',
+                 'current', 'started', 'last_activity')
+
+    def __init__(self, client: str, ip: str):
+        self.client = client
+        self.ip = ip
+        self.bytes = 0
+        self.requests = 0
+        self.active = 0
+        self.sending = 0
+        self.files: dict[str, int] = {}
+        self.current = ''
+        self.started = time.time()
+        self.last_activity = self.started
+
+
+class DownloadStats:
+    """Bytes served per boot client, kept in memory."""
+
+    def __init__(self, ttl: int = DOWNLOAD_STATS_TTL):
+        self.ttl = ttl
+        self._clients: dict[str, _Download] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, client: str, ip: str, name: str, sendfile: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            d = self._clients.get(client)
+            if d is None:
+                d = self._clients[client] = _Download(client, ip)
+            d.ip = ip
+            d.requests += 1
+            d.active += 1
+            d.sending += sendfile
+            d.current = name
+            d.last_activity = now
+
+    def progress(self, client: str, name: str, sent: int) -> None:
+        with self._lock:
+            d = self._clients.get(client)
+            if d is None:
+                return
+            d.bytes += sent
+            d.files[name] = d.files.get(name, 0) + sent
+            d.last_activity = time.time()
+
+    def end(self, client: str, sendfile: bool = False) -> None:
+        with self._lock:
+            d = self._clients.get(client)
+            if d is None:
+                return
+            d.active = max(0, d.active - 1)
+            d.sending = max(0, d.sending - sendfile)
+            d.last_activity = time.time()
+
+    def track(self, body, client: str, ip: str, name: str) -> 'TrackedBody':
+        """Wrap response *body* so it is accounted to *client* while it is sent."""
+        self.begin(client, ip, name)
+        return TrackedBody(body, self, client, name)
+
+    def track_file(self, wrapper, client: str, ip: str, name: str, size: int):
+        """Account *wrapper*, a ``wsgi.file_wrapper`` body of *size* bytes.
+
+        The wrapper is returned as is so the server still sends it with
+        ``sendfile``; only its ``close`` is hooked.  An aborted transfer is
+        credited in full.
+        """
+        self.begin(client, ip, name, sendfile=True)
+        close = getattr(wrapper, 'close', None)
+
+        def closed():
+            try:
+                if close is not None:
+                    close()
+            finally:
+                self.progress(client, name, size)
+                self.end(client, sendfile=True)
+
+        wrapper.close = closed
+        return wrapper
+
+    def snapshot(self) -> list[dict]:
+        now = time.time()
+        with self._lock:
+            for client in [c for c, d in self._clients.items()
+                           if not d.active and now - d.last_activity > self.ttl]:
+                del self._clients[client]
+            return [
+                {
+                    'client': d.client,
+                    'ip': d.ip,
+                    'bytes': d.bytes,
+                    'requests': d.requests,
+                    'active': d.active,
+                    'sending': d.sending,
+                    'current': d.current,
+                    'files': dict(d.files),
+                    'started': d.started,
+                    'last_activity': d.last_activity,
+                    'idle': round(now - d.last_activity, 1),
+                }
+                for d in self._clients.values()
+            ]
+
+
+class TrackedBody:
+    """WSGI response body reporting every chunk once the server has written it.
+
+    A chunk counts when the server asks for the next one, so an aborted
+    transfer is credited only with what was sent.  ``close`` ends the
+    download; the server calls it for complete and interrupted responses.
+    """
+
+    def __init__(self, body, stats: DownloadStats, client: str, name: str):
+        self._body = body
+        self._stats = stats
+        self._client = client
+        self._name = name
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._body:
+            yield chunk
+            self._stats.progress(self._client, self._name, len(chunk))
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._stats.end(self._client)
+
+
+cache = HotFileCache()
+downloads = DownloadStats()
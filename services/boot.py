@@ -0,0 +1,205 @@
+"""Per-host iPXE boot scripts.
+
+iPXE chainloads ``/api/ipxe/boot?mac=${mac}&ip=${ip}`` and gets a script for
+one of the boot actions below.  The action is an operator-set one-shot
+action if present, otherwise it is derived from the host's stage.  Host
+stages and pending actions are kept in memory (loaded once and updated on
+every change) and scripts are precompiled Jinja templates, so answering a
+boot request does not touch the database.
+"""
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+from jinja2 import Environment
+
+from config import (
+    BOOT_IPXE_PATH,
+    IPXE_TEMPLATES_DIR,
+    IPXE_DEFAULT_ACTION,
+    IPXE_BOOT_BASE_URL,
+    INSTALL_DONE_STAGES,
+)
+from db_utils import get_db
+from services.hosts import registry as host_registry
+
+TEMPLATE_CHECK_INTERVAL = 5
+
+DEFAULT_TEMPLATES = {
+    'install': (
+        '#!ipxe\n'
+        'echo Installing {{ mac }}\n'
+        'kernel {{ boot_url }}/linux auto=true priority=critical '
+        'preseed/url={{ preseed_url }} netcfg/choose_interface=auto initrd=initrd.gz\n'
+        'initrd {{ boot_url }}/initrd.gz\n'
+        'boot\n'
+    ),
+    'local': (
+        '#!ipxe\n'
+        'echo Booting {{ mac }} from local disk\n'
+        'sanboot --no-describe --drive 0x80 || exit\n'
+    ),
+    'rescue': (
+        '#!ipxe\n'
+        'echo Rescue boot for {{ mac }}\n'
+        'kernel {{ boot_url }}/linux rescue/enable=true initrd=initrd.gz\n'
+        'initrd {{ boot_url }}/initrd.gz\n'
+        'boot\n'
+    ),
+    'menu': (
+        '#!ipxe\n'
+        'chain tftp://${next-server}/{{ menu_file }}\n'
+    ),
+    # Host held back by a rollout: ask again later without loading anything
+    'wait': (
+        '#!ipxe\n'
+        'echo Waiting for a rollout slot for {{ mac }}\n'
+        'sleep {{ wait_seconds }}\n'
+        'chain --replace --autofree {{ boot_path }}?mac=${mac}&ip=${ip}\n'
+    ),
+}
+# Actions an operator can set; ``wait`` is only given by a rollout
+BOOT_ACTIONS = tuple(a for a in DEFAULT_TEMPLATES if a != 'wait')
+HOLD_RETRY_SECONDS = int(os.getenv('IPXE_HOLD_RETRY_SECONDS', 30))
+
+_env = Environment(keep_trailing_newline=True)
+
+
+class _TemplateSet:
+    """Compiled boot templates, overridable by ``<action>.ipxe`` files."""
+
+    def __init__(self):
+        self._compiled = {}
+        self._mtimes = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, action: str):
+        if time.monotonic() - self._checked > TEMPLATE_CHECK_INTERVAL:
+            with self._lock:
+                self._refresh()
+        return self._compiled[action]
+
+    def _refresh(self) -> None:
+        for action, default in DEFAULT_TEMPLATES.items():
+            path = os.path.join(IPXE_TEMPLATES_DIR, f'{action}.ipxe')
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if action in self._compiled and self._mtimes.get(action) == mtime:
+                continue
+            source = default
+            if mtime is not None:
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        source = f.read()
+                except OSError as e:
+                    logging.warning(f'Не удалось прочитать шаблон {path}: {e}')
+            try:
+                self._compiled[action] = _env.from_string(source)
+            except Exception as e:
+                logging.error(f'Ошибка в шаблоне iPXE {path}: {e}')
+                self._compiled.setdefault(action, _env.from_string(default))
+            self._mtimes[action] = mtime
+        self._checked = time.monotonic()
+
+
+class BootState:
+    """In-memory pending one-shot boot actions; stages come from the host registry."""
+
+    def __init__(self):
+        self._actions: dict[str, str] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with get_db() as db:
+                for row in db.execute('SELECT mac, action FROM boot_actions'):
+                    self._actions[row['mac']] = row['action']
+            self._loaded = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._actions.clear()
+            self._loaded = False
+
+    def actions(self) -> dict:
+        self._ensure_loaded()
+        return dict(self._actions)
+
+    def set_action(self, mac: str, action: str) -> None:
+        self._ensure_loaded()
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with get_db() as db:
+            db.execute(
+                """
+                INSERT INTO boot_actions(mac, action, created) VALUES (?, ?, ?)
+                ON CONFLICT(mac) DO UPDATE SET
+                    action = excluded.action,
+                    created = excluded.created
+                """,
+                (mac, action, now),
+            )
+        self._actions[mac] = action
+
+    def clear_action(self, mac: str) -> bool:
+        self._ensure_loaded()
+        found = self._actions.pop(mac, None) is not None
+        with get_db() as db:
+            db.execute('DELETE FROM boot_actions WHERE mac = ?', (mac,))
+        return found
+
+    def take_action(self, mac: str) -> str:
+        """Return boot action for *mac*, consuming a one-shot action."""
+        self._ensure_loaded()
+        action = self._actions.pop(mac, None)
+        if action:
+            # Only a pending one-shot action costs a database write
+            try:
+                with get_db() as db:
+                    db.execute('DELETE FROM boot_actions WHERE mac = ?', (mac,))
+            except Exception as e:
+                logging.error(f'Не удалось удалить действие загрузки для {mac}: {e}')
+            return action
+        if host_registry.stage(mac) in INSTALL_DONE_STAGES:
+            return 'local'
+        return IPXE_DEFAULT_ACTION
+
+
+templates = _TemplateSet()
+state = BootState()
+
+
+def boot_script(mac: str, ip: str, preseed_url: str, hold: bool = False,
+                boot_path: str = '/api/ipxe/boot') -> tuple[str, str]:
+    """Return ``(action, script)`` for the host with *mac*.
+
+    Clients that did not send a MAC get the static menu.  A *hold* (host
+    waiting for admission to a rollout) keeps the one-shot action for later.
+    """
+    if hold and mac:
+        action = 'wait'
+    else:
+        action = state.take_action(mac) if mac else 'menu'
+        if action not in BOOT_ACTIONS:
+            action = 'menu'
+    script = templates.get(action).render(
+        mac=mac,
+        ip=ip,
+        action=action,
+        boot_url=IPXE_BOOT_BASE_URL,
+        preseed_url=preseed_url,
+        menu_file=os.path.basename(BOOT_IPXE_PATH),
+        boot_path=boot_path,
+        wait_seconds=HOLD_RETRY_SECONDS,
+    )
+    return action, script
@@ -0,0 +1,275 @@
+"""DHCP reservations rendered to dnsmasq ``dhcp-hostsfile``/``dhcp-optsfile``.
+
+Reservations are collected from three sources, the first one winning for a
+MAC: entries added through the API (``dhcp_reservations`` table), hosts of
+the Ansible inventory with a ``mac`` variable, and, with
+``DHCP_RESERVE_SEEN_HOSTS=1``, hosts that registered through
+``/api/register``.  Clients only seen through a DHCP lease or TFTP request
+never get a reservation.  The files are rewritten only when their content changes
+and dnsmasq re-reads them on ``SIGHUP``, so applying reservations does not
+interrupt running DHCP/TFTP transfers.  Requests to apply are debounced: a
+burst of changes results in one write and one reload.
+
+``dnsmasq.conf`` must reference the files::
+
+    dhcp-hostsfile=/etc/dnsmasq.d/pxe-watch.hosts
+    dhcp-optsfile=/etc/dnsmasq.d/pxe-watch.opts
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+
+from config import (
+    DNSMASQ_PATH,
+    DHCP_HOSTSFILE,
+    DHCP_OPTSFILE,
+    DNSMASQ_RELOAD_CMD,
+    DNSMASQ_RESTART_CMD,
+    DHCP_RESERVE_SEEN_HOSTS,
+)
+from db_utils import get_db
+from logtail import load_inventory
+from services.files import atomic_write
+from services.hosts import is_early_stage, registry as host_registry
+from services.preseed import normalize_mac
+
+RELOAD_DEBOUNCE = float(os.getenv('DNSMASQ_RELOAD_DEBOUNCE', 2))
+RELOAD_MAX_DELAY = float(os.getenv('DNSMASQ_RELOAD_MAX_DELAY', 10))
+
+IPV4_RE = re.compile(r'^\d{1,3}(\.\d{1,3}){3}$')
+HOSTNAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9-]{0,62}$')
+
+
+def collect_reservations() -> list[dict]:
+    """Return merged reservations sorted by MAC."""
+    result: dict[str, dict] = {}
+    claimed_ips: set[str] = set()
+
+    def add(mac, ip, hostname, options, source):
+        mac = normalize_mac(mac)
+        if not mac or mac in result:
+            return
+        if ip and (not IPV4_RE.match(ip) or ip in claimed_ips):
+            # An address already reserved for another MAC is not handed out twice
+            ip = ''
+        if hostname and not HOSTNAME_RE.match(hostname):
+            hostname = ''
+        if not ip and not hostname and not options:
+            return
+        if ip:
+            claimed_ips.add(ip)
+        result[mac] = {
+            'mac': mac,
+            'ip': ip,
+            'hostname': hostname,
+            'options': options,
+            'source': source,
+        }
+
+    with get_db() as db:
+        explicit = db.execute(
+            'SELECT mac, ip, hostname, options FROM dhcp_reservations'
+        ).fetchall()
+    for row in explicit:
+        add(row['mac'], row['ip'] or '', row['hostname'] or '',
+            json.loads(row['options'] or '[]'), 'manual')
+    for host, vars in load_inventory().items():
+        ip = vars.get('ip') or (host if IPV4_RE.match(host) else '')
+        hostname = vars.get('hostname') or ('' if IPV4_RE.match(host) else host)
+        add(vars.get('mac', ''), ip, hostname, [], 'inventory')
+    if DHCP_RESERVE_SEEN_HOSTS:
+        for record in host_registry.all():
+            if not is_early_stage(record.stage):
+                add(record.mac, record.ip, '', [], 'hosts')
+    return sorted(result.values(), key=lambda r: r['mac'])
+
+
+def render_files(reservations: list[dict]) -> tuple[str, str]:
+    """Return ``(hostsfile, optsfile)`` content for *reservations*."""
+    hosts = ['# Generated by pxe-watch, do not edit']
+    opts = ['# Generated by pxe-watch, do not edit']
+    for r in reservations:
+        fields = [r['mac']]
+        if r['options']:
+            tag = 'pw' + r['mac'].replace(':', '')
+            fields.append(f'set:{tag}')
+            opts.extend(f'tag:{tag},{option}' for option in r['options'])
+        if r['ip']:
+            fields.append(r['ip'])
+        if r['hostname']:
+            fields.append(r['hostname'])
+        hosts.append(','.join(fields))
+    return '\n'.join(hosts) + '\n', '\n'.join(opts) + '\n'
+
+
+def _write_if_changed(path: str, content: str) -> bool:
+    try:
+        with open(path, encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    atomic_write(path, content.encode('utf-8'))
+    return True
+
+
+def _run(cmd: str) -> None:
+    subprocess.run(shlex.split(cmd), check=True, capture_output=True)
+
+
+def config_changed(old: str, new: str) -> bool:
+    """Return ``True`` if *new* differs from *old* beyond comments and blanks."""
+    def significant(text):
+        lines = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                lines.append(line)
+        return lines
+    return significant(old) != significant(new)
+
+
+def restart_dnsmasq() -> None:
+    """Restart dnsmasq; only needed when ``dnsmasq.conf`` itself changed."""
+    _run(DNSMASQ_RESTART_CMD)
+    applier.stats['restarts'] += 1
+
+
+class ReservationApplier:
+    """Debounced render of reservation files followed by a dnsmasq reload."""
+
+    def __init__(self, debounce: float = RELOAD_DEBOUNCE, max_delay: float = RELOAD_MAX_DELAY):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.stats = {'requests': 0, 'applies': 0, 'reloads': 0, 'restarts': 0,
+                      'last_apply': None, 'last_error': None}
+        self._cond = threading.Condition()
+        self._first_request = None
+        self._last_request = None
+        self._thread = None
+        self._warned = False
+        self._reload_pending = False
+        # apply() runs from the debounce thread and the API
+        self._apply_lock = threading.Lock()
+
+    def schedule(self) -> None:
+        """Request an apply; bursts of requests are merged into one."""
+        with self._cond:
+            now = time.monotonic()
+            self.stats['requests'] += 1
+            if self._first_request is None:
+                self._first_request = now
+            self._last_request = now
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='dhcp-reservations', daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._first_request is None:
+                    self._cond.wait()
+                while True:
+                    now = time.monotonic()
+                    due = min(self._last_request + self.debounce,
+                              self._first_request + self.max_delay)
+                    if now >= due:
+                        break
+                    self._cond.wait(due - now)
+                self._first_request = self._last_request = None
+            try:
+                self.apply()
+            except Exception as e:
+                logging.error(f'Ошибка применения DHCP-резерваций: {e}', exc_info=True)
+
+    def apply(self) -> bool:
+        """Render the files now and reload dnsmasq if they changed."""
+        with self._apply_lock:
+            try:
+                return self._apply()
+            except Exception as e:
+                self.stats['last_error'] = str(e)
+                raise
+
+    def _apply(self) -> bool:
+        hosts, opts = render_files(collect_reservations())
+        changed = _write_if_changed(DHCP_HOSTSFILE, hosts)
+        changed = _write_if_changed(DHCP_OPTSFILE, opts) or changed
+        self.stats['applies'] += 1
+        self.stats['last_apply'] = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        if not self._warned:
+            self._warned = True
+            self._check_config()
+        if changed or self._reload_pending:
+            # Kept set if the reload fails so the next apply retries it
+            self._reload_pending = True
+            _run(DNSMASQ_RELOAD_CMD)
+            self._reload_pending = False
+            self.stats['reloads'] += 1
+            logging.info('DHCP-резервации обновлены, dnsmasq перечитал файлы')
+        self.stats['last_error'] = None
+        return changed
+
+    def _check_config(self) -> None:
+        try:
+            with open(DNSMASQ_PATH, encoding='utf-8') as f:
+                conf = f.read()
+        except OSError:
+            return
+        for option, path in (('dhcp-hostsfile', DHCP_HOSTSFILE), ('dhcp-optsfile', DHCP_OPTSFILE)):
+            if f'{option}={path}' not in conf:
+                logging.warning(f'{DNSMASQ_PATH} не содержит {option}={path}')
+
+
+def set_reservation(mac: str, ip: str = '', hostname: str = '', options=None) -> None:
+    """Add or update a manual reservation and schedule an apply.
+
+    Raises:
+        ValueError: on invalid MAC, IP or hostname.
+    """
+    mac = normalize_mac(mac)
+    if not mac:
+        raise ValueError('Invalid MAC')
+    if ip and not IPV4_RE.match(ip):
+        raise ValueError('Invalid IP')
+    if hostname and not HOSTNAME_RE.match(hostname):
+        raise ValueError('Invalid hostname')
+    now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    with get_db() as db:
+        db.execute(
+            """
+            INSERT INTO dhcp_reservations(mac, ip, hostname, options, updated)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(mac) DO UPDATE SET
+                ip = excluded.ip,
+                hostname = excluded.hostname,
+                options = excluded.options,
+                updated = excluded.updated
+            """,
+            (mac, ip, hostname, json.dumps(list(options or [])), now),
+        )
+    applier.schedule()
+
+
+def delete_reservation(mac: str) -> bool:
+    mac = normalize_mac(mac)
+    with get_db() as db:
+        deleted = db.execute(
+            'DELETE FROM dhcp_reservations WHERE mac = ?', (mac,)
+        ).rowcount
+    if deleted:
+        applier.schedule()
+    return bool(deleted)
+
+
+applier = ReservationApplier()
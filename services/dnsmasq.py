@@ -0,0 +1,267 @@
+"""Ingestion of dnsmasq leases and DHCP/TFTP log lines.
+
+Hosts are recorded from their first DHCP request instead of only when the
+installer calls ``/api/register``.  The lease file is re-read when its stat
+changes and only leases whose MAC, IP or hostname changed are applied.  The
+log file is followed from the offset stored in ``ingest_offsets``; a new
+inode or a shrunken file means it was rotated or truncated, and reading
+restarts from the beginning after the old file has been drained.
+
+Events are collected in memory and written with one ``executemany`` per
+flush.  Early stages (``dhcp``, ``tftp:<file>``) never replace a stage
+reported by the installer or Ansible; the host registry applies the same
+rule to its copy after each flush.
+"""
+
+import datetime
+import logging
+import os
+import re
+import time
+
+from config import DNSMASQ_LEASES_PATH, DNSMASQ_LOG_PATH, DHCP_RESERVE_SEEN_HOSTS
+from db_utils import get_db
+from services.dhcp import applier as dhcp_applier
+from services.hosts import registry as host_registry
+
+POLL_INTERVAL = float(os.getenv('DNSMASQ_INGEST_INTERVAL', 0.5))
+FLUSH_INTERVAL = float(os.getenv('DNSMASQ_INGEST_FLUSH', 1.0))
+FLUSH_BATCH = int(os.getenv('DNSMASQ_INGEST_BATCH', 500))
+READ_SIZE = 1024 * 1024
+
+DHCP_RE = re.compile(
+    r'dnsmasq-dhcp\[\d+\]:\s+(?:\d+\s+)?'
+    r'(?P<msg>DHCPACK|DHCPOFFER|DHCPREQUEST|DHCPDISCOVER)\([^)]*\)\s+'
+    r'(?:(?P<ip>\d{1,3}(?:\.\d{1,3}){3})\s+)?'
+    r'(?P<mac>[0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5})'
+)
+TFTP_RE = re.compile(
+    r'dnsmasq-tftp\[\d+\]:\s+(?:\d+\s+)?'
+    r'(?:sent|error \d+ .*? received from|failed sending)\s+'
+    r'(?:(?P<file>\S+)\s+to\s+)?(?P<ip>\d{1,3}(?:\.\d{1,3}){3})'
+)
+
+UPSERT_SQL = """
+    INSERT INTO hosts(mac, ip, stage, details, ts, first_ts)
+    VALUES (?, ?, ?, '', ?, ?)
+    ON CONFLICT(mac) DO UPDATE SET
+        ip = COALESCE(NULLIF(excluded.ip, ''), hosts.ip),
+        ts = excluded.ts,
+        first_ts = COALESCE(hosts.first_ts, excluded.ts),
+        stage = CASE
+            WHEN excluded.stage = '' THEN hosts.stage
+            WHEN hosts.stage IS NULL OR hosts.stage = '' OR hosts.stage = 'dhcp'
+                 OR hosts.stage LIKE 'tftp:%' THEN excluded.stage
+            ELSE hosts.stage
+        END
+"""
+
+
+class _FollowedFile:
+    """Incremental reader of an append-only log with rotation handling."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        self._partial = b''
+        self._load_offset()
+
+    def _load_offset(self) -> None:
+        with get_db() as db:
+            row = db.execute(
+                'SELECT inode, offset FROM ingest_offsets WHERE source = ?',
+                (self.path,),
+            ).fetchone()
+        if row:
+            self.inode, self.offset = row['inode'], row['offset']
+
+    def save_offset(self) -> None:
+        """Persist the offset of the last complete line read."""
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with get_db() as db:
+            db.execute(
+                """
+                INSERT INTO ingest_offsets(source, inode, offset, updated)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(source) DO UPDATE SET
+                    inode = excluded.inode,
+                    offset = excluded.offset,
+                    updated = excluded.updated
+                """,
+                (self.path, self.inode, self.committed_offset, now),
+            )
+
+    def _open(self, st: os.stat_result) -> None:
+        self.file = open(self.path, 'rb')
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # New file (rotated) or truncated: start from its beginning
+            self.inode = st.st_ino
+            self.offset = 0
+        self.file.seek(self.offset)
+        self._partial = b''
+
+    def read_lines(self) -> list[str]:
+        """Return complete lines appended since the last call."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        lines = []
+        if self.file is None:
+            if st is None:
+                return lines
+            self._open(st)
+        lines.extend(self._drain())
+        if st is not None and (st.st_ino != self.inode or st.st_size < self.offset):
+            # Rotated after we drained the old file: continue with the new one
+            self.file.close()
+            self._open(st)
+            lines.extend(self._drain())
+        return lines
+
+    def _drain(self) -> list[str]:
+        lines = []
+        while True:
+            chunk = self.file.read(READ_SIZE)
+            if not chunk:
+                break
+            data = self._partial + chunk
+            complete, _, self._partial = data.rpartition(b'\n')
+            if complete:
+                lines.extend(complete.decode('utf-8', 'replace').split('\n'))
+            self.offset += len(chunk)
+        # Offset only counts complete lines so a restart re-reads the tail
+        return lines
+
+    @property
+    def committed_offset(self) -> int:
+        return self.offset - len(self._partial)
+
+
+class DnsmasqIngestor:
+    """Follows dnsmasq leases and log and upserts ``hosts`` in batches."""
+
+    def __init__(self, leases_path: str = DNSMASQ_LEASES_PATH,
+                 log_path: str = DNSMASQ_LOG_PATH):
+        self.leases_path = leases_path
+        self.log_path = log_path
+        self.ip_to_mac: dict[str, str] = {}
+        self.stats = {'lease_events': 0, 'log_events': 0, 'flushes': 0, 'rows': 0}
+        self._leases: dict[str, tuple] = {}
+        self._leases_stat = None
+        self._log = None
+        # mac -> (ip, stage, ts) waiting for the next flush
+        self._pending: dict[str, tuple[str, str, str]] = {}
+        self._last_flush = time.monotonic()
+
+    def _event(self, mac: str, ip: str, stage: str) -> None:
+        mac = mac.lower()
+        if ip:
+            self.ip_to_mac[ip] = mac
+        ts = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        pending = self._pending.get(mac)
+        if pending and not stage:
+            stage = pending[1]
+        if pending and not ip:
+            ip = pending[0]
+        self._pending[mac] = (ip, stage, ts)
+
+    def poll_leases(self) -> None:
+        try:
+            st = os.stat(self.leases_path)
+        except FileNotFoundError:
+            return
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if key == self._leases_stat:
+            return
+        first_read = self._leases_stat is None
+        self._leases_stat = key
+        leases = {}
+        with open(self.leases_path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                # <expiry> <mac> <ip> <hostname> <client id>
+                parts = line.split()
+                if len(parts) >= 4 and ':' in parts[1]:
+                    leases[parts[1].lower()] = (parts[2], parts[3])
+        if first_read:
+            # First read after start: only hosts missing from the table are
+            # new, the others keep their last seen time.
+            self._leases = {r.mac: (r.ip, None) for r in host_registry.all()}
+        for mac, lease in leases.items():
+            self.ip_to_mac[lease[0]] = mac
+            previous = self._leases.get(mac)
+            if previous is None:
+                self._event(mac, lease[0], 'dhcp')
+            elif previous[0] != lease[0] or (previous[1] is not None and previous[1] != lease[1]):
+                self._event(mac, lease[0], '')
+            else:
+                continue
+            self.stats['lease_events'] += 1
+        self._leases = leases
+
+    def poll_log(self) -> None:
+        if not self.log_path:
+            return
+        if self._log is None:
+            self._log = _FollowedFile(self.log_path)
+        for line in self._log.read_lines():
+            m = DHCP_RE.search(line)
+            if m:
+                ip = m.group('ip') or ''
+                if m.group('msg') in ('DHCPACK', 'DHCPREQUEST') and ip:
+                    self._event(m.group('mac'), ip, 'dhcp')
+                else:
+                    self._event(m.group('mac'), '', 'dhcp')
+                self.stats['log_events'] += 1
+                continue
+            m = TFTP_RE.search(line)
+            if m:
+                mac = self.ip_to_mac.get(m.group('ip'))
+                if mac:
+                    name = os.path.basename(m.group('file') or '') or 'error'
+                    self._event(mac, m.group('ip'), f'tftp:{name}')
+                    self.stats['log_events'] += 1
+
+    def flush(self, force: bool = False) -> int:
+        now = time.monotonic()
+        if not self._pending:
+            self._last_flush = now
+            return 0
+        if not force and len(self._pending) < FLUSH_BATCH and now - self._last_flush < FLUSH_INTERVAL:
+            return 0
+        rows = [(mac, ip, stage, ts, ts) for mac, (ip, stage, ts) in self._pending.items()]
+        with get_db() as db:
+            db.executemany(UPSERT_SQL, rows)
+        for mac, ip, stage, ts, _ in rows:
+            host_registry.ingest(mac, ip, stage, ts)
+        self._pending.clear()
+        self._last_flush = now
+        if self._log is not None and self._log.inode is not None:
+            self._log.save_offset()
+        self.stats['flushes'] += 1
+        self.stats['rows'] += len(rows)
+        if DHCP_RESERVE_SEEN_HOSTS:
+            dhcp_applier.schedule()
+        return len(rows)
+
+    def run_once(self) -> None:
+        self.poll_leases()
+        self.poll_log()
+        self.flush()
+
+    def run_forever(self) -> None:
+        logging.info(
+            f'Слежение за dnsmasq: аренды {self.leases_path}, журнал {self.log_path or "—"}'
+        )
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f'Ошибка при разборе данных dnsmasq: {e}', exc_info=True)
+                time.sleep(5)
+            time.sleep(POLL_INTERVAL)
+
+
+ingestor = DnsmasqIngestor()
@@ -0,0 +1,288 @@
+"""Binary-safe streaming download and upload of managed files.
+
+Downloads go through ``send_file`` so the WSGI server can use ``sendfile``
+and ``Range``/``If-Range`` requests are answered without reading the whole
+file.  Uploads are copied from the request stream in fixed-size chunks into a
+temporary file in the target directory which then atomically replaces the
+target, so memory use does not depend on the file size.
+
+Small configuration files (preseed, dnsmasq, iPXE, playbook, inventory) are
+served with strong content-hash ETags so editors can revalidate with
+``If-None-Match`` and save with ``If-Match``.
+"""
+
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+
+from flask import send_file, request, Response
+
+from config import UPLOAD_MAX_BYTES
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# path -> ((inode, mtime_ns, size), sha256 hex digest)
+_etag_cache: dict[str, tuple[tuple, str]] = {}
+# Serialises If-Match check and write of the same file within the process
+write_lock = threading.Lock()
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload exceeds ``UPLOAD_MAX_BYTES``."""
+
+
+class UploadOffsetError(Exception):
+    """Raised when a resumable chunk does not start where the upload ended."""
+
+    def __init__(self, current: int):
+        super().__init__(f'upload offset mismatch, current size is {current}')
+        self.current = current
+
+
+def _stat_key(st: os.stat_result) -> tuple:
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def file_etag(path: str):
+    """Return sha256 based ETag of *path* or ``None`` if it does not exist.
+
+    The digest is cached by ``(inode, mtime, size)`` so unchanged files are
+    hashed only once.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    cached = _etag_cache.get(path)
+    if cached and cached[0] == _stat_key(st):
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()
+    _etag_cache[path] = (_stat_key(st), etag)
+    return etag
+
+
+def read_file_versioned(path: str) -> tuple[bytes, str, float]:
+    """Read *path* and return ``(content, etag, mtime)`` of the same version.
+
+    Raises:
+        FileNotFoundError: if *path* does not exist.
+    """
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    key = _stat_key(st)
+    cached = _etag_cache.get(path)
+    if cached and cached[0] == key:
+        etag = cached[1]
+    else:
+        etag = hashlib.sha256(data).hexdigest()
+        _etag_cache[path] = (key, etag)
+    return data, etag, st.st_mtime
+
+
+def combine_etags(*etags) -> str:
+    """Return ETag for a resource assembled from several files."""
+    return hashlib.sha256('/'.join(e or '-' for e in etags).encode()).hexdigest()
+
+
+def conditional_response(data, etag: str, mtime: float = None,
+                         mimetype: str = 'text/plain'):
+    """Return *data* with ETag/Last-Modified, or 304 if the client has it."""
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    if mtime is not None:
+        response.last_modified = mtime
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def versioned_text_response(path: str):
+    """Serve text file *path* with a strong ETag, answering 304 when possible.
+
+    Raises:
+        FileNotFoundError: if *path* does not exist.
+    """
+    cached = not_modified(file_etag(path))
+    if cached is not None:
+        return cached
+    data, etag, mtime = read_file_versioned(path)
+    return conditional_response(data, etag, mtime)
+
+
+def not_modified(etag: str):
+    """Return 304 response if ``If-None-Match`` matches *etag*, else ``None``."""
+    if etag and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+    return None
+
+
+def if_match_failed(etag) -> bool:
+    """Return ``True`` if the request carries ``If-Match`` not matching *etag*.
+
+    A missing file (``etag`` is ``None``) never matches.
+    """
+    if 'If-Match' not in request.headers:
+        return False
+    if etag is None:
+        return True
+    return not request.if_match.contains(etag)
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Replace *path* with *data* via temp file, fsync and rename.
+
+    Readers see either the old or the new content, never a partial file.
+    A symlinked *path* keeps its link; its target is replaced.
+    """
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        _copy_mode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _fsync_dir(directory)
+
+
+def _fsync_dir(directory: str) -> None:
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def send_path(path: str, mimetype: str = None, etag=True):
+    """Return streaming response for *path* with ``Range`` support.
+
+    ``etag`` may be a precomputed strong ETag; by default werkzeug derives
+    one from mtime and size.
+
+    Raises:
+        FileNotFoundError: if *path* does not exist.
+    """
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = send_file(
+        path, mimetype=mimetype, conditional=True, etag=etag, max_age=0
+    )
+    response.cache_control.no_cache = True
+    return response
+
+
+def is_upload_buffer(name: str) -> bool:
+    """Whether *name* is a temporary or partial upload of another file."""
+    return name.startswith('.') and name.endswith(('.part', '.tmp'))
+
+
+def partial_upload_path(path: str) -> str:
+    """Return path of the resumable upload buffer for *path*."""
+    directory, name = os.path.split(os.path.realpath(path))
+    return os.path.join(directory, f'.{name}.part')
+
+
+def receive_upload(
+    path: str,
+    stream,
+    offset: int = None,
+    final: bool = True,
+    max_bytes: int = UPLOAD_MAX_BYTES,
+) -> int:
+    """Stream *stream* into *path* and return the number of bytes stored.
+
+    Without ``offset`` the whole body is written to a temporary file which
+    replaces *path* once complete.  With ``offset`` the body is appended to
+    the partial upload of *path*; ``offset`` must equal the size already
+    received (``0`` restarts the upload).  The partial file replaces *path*
+    when ``final`` is true.
+
+    Raises:
+        ValueError: if ``final`` is false without ``offset``; such a body
+            could never be completed.
+        UploadOffsetError: if ``offset`` does not match the partial upload.
+        UploadTooLargeError: if the upload grows beyond ``max_bytes``.
+    """
+    if offset is None and not final:
+        raise ValueError('an intermediate chunk (final=0) requires offset')
+    # Replace the target of a symlink, not the link itself
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    if offset is None:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.tmp')
+        written = 0
+    else:
+        tmp_path = partial_upload_path(path)
+        try:
+            current = os.path.getsize(tmp_path)
+        except FileNotFoundError:
+            current = 0
+        if offset not in (0, current):
+            raise UploadOffsetError(current)
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if offset == 0 else os.O_APPEND)
+        fd = os.open(tmp_path, flags, 0o600)
+        written = offset
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadTooLargeError(f'upload exceeds {max_bytes} bytes')
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if offset is None:
+            os.unlink(tmp_path)
+        raise
+
+    if final:
+        _copy_mode(path, tmp_path)
+        os.replace(tmp_path, path)
+        _fsync_dir(directory)
+        logging.info(f'Файл {path} обновлён ({written} байт)')
+    return written
+
+
+def _copy_mode(path: str, tmp_path: str) -> None:
+    """Give *tmp_path* the permissions of *path* (or default 0644)."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        os.chmod(tmp_path, 0o644)
+        return
+    os.chmod(tmp_path, st.st_mode & 0o7777)
+    try:
+        os.chown(tmp_path, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
@@ -0,0 +1,267 @@
+"""Incremental SHA-256 index of the offline artifact store.
+
+Every regular file below ``ANSIBLE_FILES_DIR`` is recorded in the
+``file_hashes`` table together with the size, mtime and inode it had when it
+was hashed.  Updating the index only hashes files whose stat changed, and a
+quick verification compares stats without reading any content.
+
+Files are hashed in OS threads.  Under gevent workers the threads of
+``concurrent.futures`` are greenlets sharing one OS thread, so gevent's
+native thread pool is used instead; otherwise hashing would stall every
+request and the gunicorn heartbeat.
+"""
+
+import base64
+import datetime
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import ANSIBLE_FILES_DIR
+from db_utils import get_db
+
+HASH_WORKERS = int(os.getenv('HASH_INDEX_WORKERS', 4))
+HASH_READ_SIZE = 8 * 1024 * 1024
+
+_update_lock = threading.Lock()
+_buffers = threading.local()
+_state = {'running': False, 'last_result': None}
+
+
+def _walk(root: str):
+    """Yield ``(relative path, stat)`` of regular files below *root*."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield os.path.relpath(entry.path, root), entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        logging.warning(f'Не удалось прочитать {entry.path}: {e}')
+        except OSError as e:
+            logging.warning(f'Не удалось прочитать каталог {directory}: {e}')
+
+
+def _executor(workers: int):
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(max_workers=max(1, workers))
+    return ThreadPoolExecutor(max_workers=max(1, workers))
+
+
+def hash_file(path: str) -> str:
+    """Return hex SHA-256 of *path* using large sequential reads."""
+    digest = hashlib.sha256()
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None:
+        # One read buffer per worker thread, reused for every file
+        buf = _buffers.buf = bytearray(HASH_READ_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def _load_index() -> dict:
+    with get_db() as db:
+        rows = db.execute(
+            'SELECT path, size, mtime_ns, inode, sha256 FROM file_hashes'
+        ).fetchall()
+    return {r['path']: (r['size'], r['mtime_ns'], r['inode'], r['sha256']) for r in rows}
+
+
+def _stat_tuple(st: os.stat_result) -> tuple:
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def _compare(root: str):
+    """Return ``(index, current stats, changed paths, missing paths)``."""
+    index = _load_index()
+    current = dict(_walk(root))
+    changed = [
+        path for path, st in current.items()
+        if path not in index or index[path][:3] != _stat_tuple(st)
+    ]
+    missing = [path for path in index if path not in current]
+    return index, current, changed, missing
+
+
+def update_index(root: str = ANSIBLE_FILES_DIR, workers: int = HASH_WORKERS) -> dict:
+    """Hash new and changed files below *root* and drop missing ones."""
+    started = time.monotonic()
+    _, current, changed, missing = _compare(root)
+
+    def work(path):
+        try:
+            return path, hash_file(os.path.join(root, path))
+        except OSError as e:
+            logging.warning(f'Не удалось вычислить хеш {path}: {e}')
+            return path, None
+
+    now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    rows = []
+    hashed_bytes = 0
+    with _executor(workers) as pool:
+        for path, sha in pool.map(work, changed):
+            if sha is None:
+                continue
+            st = current[path]
+            hashed_bytes += st.st_size
+            rows.append((path, st.st_size, st.st_mtime_ns, st.st_ino, sha, now))
+    with get_db() as db:
+        db.executemany(
+            """
+            INSERT INTO file_hashes(path, size, mtime_ns, inode, sha256, hashed)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                size = excluded.size,
+                mtime_ns = excluded.mtime_ns,
+                inode = excluded.inode,
+                sha256 = excluded.sha256,
+                hashed = excluded.hashed
+            """,
+            rows,
+        )
+        db.executemany('DELETE FROM file_hashes WHERE path = ?', [(p,) for p in missing])
+    result = {
+        'scanned': len(current),
+        'hashed': len(rows),
+        'hashed_bytes': hashed_bytes,
+        'removed': len(missing),
+        'duration': round(time.monotonic() - started, 3),
+        'finished': now,
+    }
+    logging.info(f'Индекс файлов обновлён: {result}')
+    return result
+
+
+def start_update(root: str = ANSIBLE_FILES_DIR) -> bool:
+    """Run :func:`update_index` in a background thread.
+
+    Returns ``False`` if an update is already running.
+    """
+    if not _update_lock.acquire(blocking=False):
+        return False
+
+    def worker():
+        _state['running'] = True
+        try:
+            _state['last_result'] = update_index(root)
+        except Exception as e:
+            logging.error(f'Ошибка обновления индекса файлов: {e}', exc_info=True)
+            _state['last_result'] = {'error': str(e)}
+        finally:
+            _state['running'] = False
+            _update_lock.release()
+
+    threading.Thread(target=worker, name='hash-index', daemon=True).start()
+    return True
+
+
+def index_status() -> dict:
+    with get_db() as db:
+        row = db.execute(
+            'SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes, '
+            'MAX(hashed) AS last_hashed FROM file_hashes'
+        ).fetchone()
+    return {
+        'files': row['files'],
+        'bytes': row['bytes'],
+        'last_hashed': row['last_hashed'],
+        'running': _state['running'],
+        'last_result': _state['last_result'],
+    }
+
+
+def verify_tree(root: str = ANSIBLE_FILES_DIR, deep: bool = False) -> dict:
+    """Compare files below *root* with the index.
+
+    The default check only compares size, mtime and inode, so an unchanged
+    tree is verified without reading file content.  With ``deep`` files whose
+    stat matches are re-hashed as well to detect silent corruption.
+    """
+    started = time.monotonic()
+    index, current, changed, missing = _compare(root)
+    new = [p for p in changed if p not in index]
+    modified = [p for p in changed if p in index]
+    corrupt = []
+    if deep:
+        changed_set = set(changed)
+        unchanged = [p for p in current if p in index and p not in changed_set]
+
+        def check(path):
+            try:
+                return path, hash_file(os.path.join(root, path)) != index[path][3]
+            except OSError:
+                return path, True
+
+        with _executor(HASH_WORKERS) as pool:
+            corrupt = [p for p, bad in pool.map(check, unchanged) if bad]
+    return {
+        'checked': len(current),
+        'new': sorted(new),
+        'changed': sorted(modified),
+        'missing': sorted(missing),
+        'corrupt': sorted(corrupt),
+        'duration': round(time.monotonic() - started, 3),
+    }
+
+
+def find_duplicates() -> list[dict]:
+    """Return groups of indexed files with identical content."""
+    with get_db() as db:
+        rows = db.execute(
+            """
+            SELECT sha256, size, path FROM file_hashes
+            WHERE sha256 IN (
+                SELECT sha256 FROM file_hashes GROUP BY sha256 HAVING COUNT(*) > 1
+            )
+            ORDER BY size DESC, sha256, path
+            """
+        ).fetchall()
+    groups: dict[str, dict] = {}
+    for row in rows:
+        group = groups.setdefault(
+            row['sha256'], {'sha256': row['sha256'], 'size': row['size'], 'paths': []}
+        )
+        group['paths'].append(row['path'])
+    return list(groups.values())
+
+
+def lookup_digest(path: str, root: str = ANSIBLE_FILES_DIR):
+    """Return indexed SHA-256 of *path* if the index entry is still current."""
+    rel = os.path.relpath(path, root)
+    try:
+        st = os.stat(path)
+        with get_db() as db:
+            row = db.execute(
+                'SELECT size, mtime_ns, inode, sha256 FROM file_hashes WHERE path = ?',
+                (rel,),
+            ).fetchone()
+    except OSError:
+        return None
+    if row and (row['size'], row['mtime_ns'], row['inode']) == _stat_tuple(st):
+        return row['sha256']
+    return None
+
+
+def digest_headers(sha256_hex: str) -> dict:
+    """Return ``Digest``/``Repr-Digest`` headers for *sha256_hex*."""
+    b64 = base64.b64encode(bytes.fromhex(sha256_hex)).decode()
+    return {'Digest': f'sha-256={b64}', 'Repr-Digest': f'sha-256=:{b64}:'}
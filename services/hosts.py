@@ -0,0 +1,248 @@
+"""In-memory host registry, the read model for dashboards and lookups.
+
+A host's state is spread over the ``hosts`` and ``playbook_status`` tables.
+The registry keeps one compact record per MAC, indexed by MAC, IP and stage,
+plus the playbook status by IP, so a host is a couple of dictionary lookups
+away.  It is loaded once per process and every writer updates it right after
+its own database write; reads never touch SQLite.  ``version`` grows with
+every change, ``shape_version`` only when a host is added or its IP, stage or
+details change (not for a mere last-seen update).
+
+Each process has its own copy.  With several gunicorn workers, changes made
+by another worker (the dnsmasq ingestion runs in the task leader only) show
+up after ``reload()``; set ``TASKS_HOST_REGISTRY_RELOAD_INTERVAL`` then.
+"""
+
+import datetime
+import threading
+import time
+
+from config import ONLINE_TIMEOUT
+from db_utils import get_db
+
+EARLY_STAGES = ('', 'dhcp')
+
+
+def _epoch(ts: str) -> float:
+    try:
+        return datetime.datetime.fromisoformat(ts).replace(
+            tzinfo=datetime.timezone.utc
+        ).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def is_early_stage(stage) -> bool:
+    """Stages seen before the installer runs, replaced by any later one."""
+    return not stage or stage in EARLY_STAGES or stage.startswith('tftp:')
+
+
+class HostRecord:
+    """Immutable snapshot of one host; changes replace the record."""
+
+    __slots__ = ('mac', 'ip', 'stage', 'details', 'ts', 'first_ts', 'seen')
+
+    def __init__(self, mac, ip, stage, details, ts, first_ts):
+        self.mac = mac
+        self.ip = ip or ''
+        self.stage = stage or ''
+        self.details = details or ''
+        self.ts = ts or ''
+        self.first_ts = first_ts or ''
+        self.seen = _epoch(self.ts)
+
+    def online(self, now: float = None) -> bool:
+        return self.seen >= (now or time.time()) - ONLINE_TIMEOUT
+
+    def to_dict(self) -> dict:
+        return {
+            'mac': self.mac,
+            'ip': self.ip,
+            'stage': self.stage,
+            'details': self.details,
+            'ts': self.ts,
+            'first_ts': self.first_ts,
+        }
+
+
+class HostRegistry:
+    def __init__(self):
+        self.version = 0
+        self.shape_version = 0
+        self._by_mac: dict[str, HostRecord] = {}
+        self._by_ip: dict[str, set] = {}
+        self._by_stage: dict[str, set] = {}
+        self._playbook: dict[str, tuple[str, str]] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    # -- loading -----------------------------------------------------------
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    def load(self) -> None:
+        """Load the registry unless it already is."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+    def reload(self) -> None:
+        """Re-read the tables, e.g. after another process changed them."""
+        with self._lock:
+            self._load()
+
+    def _load(self) -> None:
+        # Runs under the lock so a concurrent write is applied after the swap
+        with get_db() as db:
+            hosts = db.execute(
+                'SELECT mac, ip, stage, details, ts, first_ts FROM hosts'
+            ).fetchall()
+            playbook = db.execute(
+                'SELECT ip, status, updated FROM playbook_status'
+            ).fetchall()
+        self._by_mac = {}
+        self._by_ip = {}
+        self._by_stage = {}
+        for row in hosts:
+            self._index(HostRecord(*row))
+        self._playbook = {row['ip']: (row['status'], row['updated']) for row in playbook}
+        self._loaded = True
+        self.version += 1
+        self.shape_version += 1
+
+    def reset(self) -> None:
+        """Forget everything; the next read loads the (recreated) database."""
+        with self._lock:
+            self._by_mac, self._by_ip, self._by_stage, self._playbook = {}, {}, {}, {}
+            self._loaded = False
+            self.version += 1
+            self.shape_version += 1
+
+    def _index(self, record: HostRecord) -> None:
+        self._by_mac[record.mac] = record
+        self._by_ip.setdefault(record.ip, set()).add(record.mac)
+        self._by_stage.setdefault(record.stage, set()).add(record.mac)
+
+    def _unindex(self, record: HostRecord) -> None:
+        for index, key in ((self._by_ip, record.ip), (self._by_stage, record.stage)):
+            macs = index.get(key)
+            if macs is not None:
+                macs.discard(record.mac)
+                if not macs:
+                    del index[key]
+
+    def _put(self, record: HostRecord) -> None:
+        old = self._by_mac.get(record.mac)
+        if old is not None:
+            self._unindex(old)
+        self._index(record)
+        self.version += 1
+        if old is None or (old.ip, old.stage, old.details) != (record.ip, record.stage, record.details):
+            self.shape_version += 1
+
+    # -- writes (call after the database write succeeded) ---------------------
+
+    def register(self, mac: str, ip: str, stage: str, details: str, ts: str) -> None:
+        """Mirror of the ``register_host`` upsert."""
+        with self._lock:
+            if not self._loaded:
+                return
+            old = self._by_mac.get(mac)
+            first_ts = old.first_ts if old is not None and old.first_ts else ts
+            self._put(HostRecord(mac, ip, stage, details, ts, first_ts))
+
+    def ingest(self, mac: str, ip: str, stage: str, ts: str) -> None:
+        """Mirror of the dnsmasq ingestion upsert: early stages never win."""
+        with self._lock:
+            if not self._loaded:
+                return
+            old = self._by_mac.get(mac)
+            if old is None:
+                self._put(HostRecord(mac, ip, stage, '', ts, ts))
+                return
+            if not stage or not is_early_stage(old.stage):
+                stage = old.stage
+            self._put(HostRecord(
+                mac, ip or old.ip, stage, old.details, ts, old.first_ts or ts,
+            ))
+
+    def add_missing(self, mac: str, ip: str, ts: str) -> None:
+        """Mirror of the inventory ``INSERT OR IGNORE``."""
+        with self._lock:
+            if self._loaded and mac not in self._by_mac:
+                self._put(HostRecord(mac, ip, '', '', ts, ts))
+
+    def set_playbook(self, ip: str, status: str, updated: str) -> None:
+        with self._lock:
+            if self._loaded:
+                self._playbook[ip] = (status, updated)
+                self.version += 1
+
+    # -- reads ---------------------------------------------------------------
+
+    def __contains__(self, mac: str) -> bool:
+        self._ensure_loaded()
+        return mac in self._by_mac
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._by_mac)
+
+    def get(self, mac: str):
+        """Return the :class:`HostRecord` of *mac* or ``None``."""
+        self._ensure_loaded()
+        return self._by_mac.get(mac)
+
+    def stage(self, mac: str) -> str:
+        record = self.get(mac)
+        return record.stage if record is not None else ''
+
+    def by_ip(self, ip: str) -> list:
+        self._ensure_loaded()
+        with self._lock:
+            macs = list(self._by_ip.get(ip, ()))
+        return [self._by_mac[m] for m in macs if m in self._by_mac]
+
+    def mac_for_ip(self, ip: str) -> str:
+        """MAC of the most recently seen host with *ip*, or ``''``."""
+        records = self.by_ip(ip)
+        return max(records, key=lambda r: r.ts).mac if records else ''
+
+    def by_stage(self, stage: str) -> list:
+        self._ensure_loaded()
+        with self._lock:
+            macs = list(self._by_stage.get(stage, ()))
+        return [self._by_mac[m] for m in macs if m in self._by_mac]
+
+    def stages(self) -> dict:
+        """Number of hosts per stage."""
+        self._ensure_loaded()
+        with self._lock:
+            return {stage: len(macs) for stage, macs in self._by_stage.items()}
+
+    def all(self) -> list:
+        """All records, most recently seen first."""
+        self._ensure_loaded()
+        with self._lock:
+            records = list(self._by_mac.values())
+        records.sort(key=lambda r: r.ts, reverse=True)
+        return records
+
+    def playbook(self, ip: str):
+        """Return ``(status, updated)`` of the last playbook run on *ip* or ``None``."""
+        self._ensure_loaded()
+        return self._playbook.get(ip)
+
+    def view(self, record: HostRecord, now: float = None) -> dict:
+        """Joined view of *record*: host fields, playbook status and liveness."""
+        item = record.to_dict()
+        playbook = self._playbook.get(record.ip)
+        item['playbook_status'] = playbook[0] if playbook else None
+        item['playbook_updated'] = playbook[1] if playbook else None
+        item['online'] = record.online(now)
+        return item
+
+
+registry = HostRegistry()
@@ -0,0 +1,242 @@
+"""Ansible dynamic inventory built from the static inventory and the host registry.
+
+Every host of ``ANSIBLE_INVENTORY`` keeps its groups and variables.  Hosts
+known to the registry get ``pxe_mac``, ``pxe_stage`` and ``pxe_first_seen``
+and are put in the ``pxe_registered`` and ``pxe_stage_<stage>`` groups;
+hosts that registered through ``/api/register`` but are missing from the
+file are added by IP to ``pxe_new`` so Ansible sees them without editing the
+INI file.  Hosts only seen through a DHCP lease or TFTP request are left out,
+the playbook must not run against every DHCP client.
+
+The result is rebuilt only when the inventory file or the shape of the
+registry changes and is kept serialized in two forms: the script format with
+``_meta.hostvars`` served by ``/api/ansible/dynamic-inventory`` (and
+``scripts/pxe-inventory.py``), and a file for Ansible's ``yaml`` inventory
+plugin at ``ANSIBLE_DYNAMIC_INVENTORY`` that ``ansible-playbook -i`` reads
+without running anything.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shlex
+import threading
+
+from config import ANSIBLE_INVENTORY, DB_PATH
+from services.files import atomic_write
+from services.hosts import is_early_stage, registry as host_registry
+
+DYNAMIC_INVENTORY_PATH = os.getenv(
+    'ANSIBLE_DYNAMIC_INVENTORY', os.path.join(os.path.dirname(DB_PATH), 'inventory.json')
+)
+USE_DYNAMIC_INVENTORY = os.getenv('ANSIBLE_USE_DYNAMIC_INVENTORY', '0') == '1'
+
+IPV4_RE = re.compile(r'^\d{1,3}(\.\d{1,3}){3}$')
+GROUP_RE = re.compile(r'[^A-Za-z0-9_]')
+
+
+def _vars(tokens) -> dict:
+    return dict(t.split('=', 1) for t in tokens if '=' in t)
+
+
+def parse_inventory(text: str) -> tuple[dict, dict]:
+    """Parse INI inventory *text* into ``(groups, hostvars)``.
+
+    ``groups`` maps a group name to ``{'hosts', 'vars', 'children'}``; hosts
+    outside any section belong to ``ungrouped``.  Quoted values such as
+    ``ansible_ssh_common_args='-o X Y'`` are unquoted like a shell would.
+    """
+    groups: dict[str, dict] = {}
+    hostvars: dict[str, dict] = {}
+    section, kind = 'ungrouped', 'hosts'
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith(('#', ';')):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section, _, kind = line[1:-1].partition(':')
+            kind = kind or 'hosts'
+            groups.setdefault(section, {'hosts': [], 'vars': {}, 'children': []})
+            continue
+        group = groups.setdefault(section, {'hosts': [], 'vars': {}, 'children': []})
+        try:
+            parts = shlex.split(line)
+        except ValueError:
+            # Unbalanced quote, keep the old whitespace split
+            parts = line.split()
+        if kind == 'vars':
+            group['vars'].update(_vars(parts))
+        elif kind == 'children':
+            group['children'].append(parts[0])
+        else:
+            group['hosts'].append(parts[0])
+            hostvars.setdefault(parts[0], {}).update(_vars(parts[1:]))
+    return groups, hostvars
+
+
+class DynamicInventory:
+    """Cached dynamic inventory, see the module docstring."""
+
+    def __init__(self, path: str = ANSIBLE_INVENTORY, output: str = DYNAMIC_INVENTORY_PATH):
+        self.path = path
+        self.output = output
+        self._static_key = None
+        self._static = ({}, {})
+        self._key = None
+        self._data = b'{}'
+        self._yaml = b'{}'
+        self._etag = ''
+        self._groups: dict[str, dict] = {}
+        self._hostvars: dict[str, dict] = {}
+        self._written = None
+        self._lock = threading.Lock()
+
+    def _stat_key(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load_static(self) -> tuple[dict, dict]:
+        key = self._stat_key()
+        if key is None:
+            self._static_key, self._static = None, ({}, {})
+        elif key != self._static_key:
+            with open(self.path, encoding='utf-8', errors='replace') as f:
+                self._static = parse_inventory(f.read())
+            self._static_key = key
+        return self._static
+
+    def _build(self) -> tuple[dict, dict]:
+        static_groups, static_vars = self._load_static()
+        groups = {
+            name: {'hosts': list(g['hosts']), 'vars': g['vars'], 'children': g['children']}
+            for name, g in static_groups.items()
+        }
+        hostvars = {host: dict(vars) for host, vars in static_vars.items()}
+        by_mac = {v['mac'].lower(): h for h, v in hostvars.items() if v.get('mac')}
+        by_addr = {v.get('ansible_host', h): h for h, v in hostvars.items()}
+
+        def member(group: str, host: str) -> None:
+            groups.setdefault(group, {'hosts': [], 'vars': {}, 'children': []})['hosts'].append(host)
+
+        seen = set()
+        # Most recently seen first, so a reused IP belongs to its current owner
+        for record in host_registry.all():
+            host = by_mac.get(record.mac) or by_addr.get(record.ip)
+            if host is None:
+                if not IPV4_RE.match(record.ip) or is_early_stage(record.stage):
+                    continue
+                host = record.ip
+                if host not in seen:
+                    hostvars[host] = {}
+                    member('pxe_new', host)
+            if host in seen:
+                continue
+            seen.add(host)
+            hostvars[host].update(
+                pxe_mac=record.mac, pxe_stage=record.stage, pxe_first_seen=record.first_ts,
+            )
+            member('pxe_registered', host)
+            if record.stage:
+                member('pxe_stage_' + GROUP_RE.sub('_', record.stage), host)
+        return groups, hostvars
+
+    @staticmethod
+    def _entry(group: dict, hosts) -> dict:
+        entry = {'hosts': hosts}
+        if group['vars']:
+            entry['vars'] = group['vars']
+        if group['children']:
+            entry['children'] = group['children']
+        return entry
+
+    def _script_format(self, groups: dict, hostvars: dict) -> dict:
+        data = {
+            name: self._entry(group, sorted(set(group['hosts'])))
+            for name, group in sorted(groups.items())
+        }
+        # Hosts and vars of an explicit [all] section stay on the top group
+        top = data.setdefault('all', {'hosts': []})
+        top['children'] = sorted(set(top.get('children', [])) | set(groups) - {'all'})
+        data['_meta'] = {'hostvars': hostvars}
+        return data
+
+    def _yaml_format(self, groups: dict, hostvars: dict) -> dict:
+        data = {}
+        for name, group in sorted(groups.items()):
+            entry = self._entry(
+                group, {h: hostvars.get(h) or None for h in sorted(set(group['hosts']))}
+            )
+            if group['children']:
+                entry['children'] = {c: None for c in group['children']}
+            data[name] = entry
+        top = data.pop('all', {})
+        top.setdefault('children', {}).update(data)
+        return {'all': top}
+
+    def _refresh(self) -> None:
+        key = (self._stat_key(), host_registry.shape_version)
+        if key == self._key:
+            return
+        with self._lock:
+            key = (self._stat_key(), host_registry.shape_version)
+            if key == self._key:
+                return
+            groups, hostvars = self._build()
+            data = json.dumps(
+                self._script_format(groups, hostvars), sort_keys=True, separators=(',', ':')
+            ).encode()
+            self._yaml = json.dumps(self._yaml_format(groups, hostvars), sort_keys=True).encode()
+            self._groups, self._hostvars = groups, hostvars
+            self._data = data
+            self._etag = hashlib.sha1(data).hexdigest()
+            self._key = key
+
+    def snapshot(self) -> tuple[bytes, str]:
+        """Return ``(script format JSON, etag)`` of the current inventory."""
+        self._refresh()
+        return self._data, self._etag
+
+    def select(self, hosts=(), group: str = None) -> tuple[dict, list]:
+        """Return ``({host: vars}, unknown)`` for *hosts* plus the members of *group*.
+
+        Raises:
+            KeyError: if *group* does not exist.
+        """
+        self._refresh()
+        names = list(hosts)
+        if group == 'all':
+            names += sorted(self._hostvars)
+        elif group:
+            pending, visited = [group], set()
+            while pending:
+                name = pending.pop()
+                if name in visited:
+                    continue
+                visited.add(name)
+                members = self._groups[name] if name == group else self._groups.get(name)
+                if members:
+                    names += members['hosts']
+                    pending += members['children']
+        targets, unknown = {}, []
+        for name in names:
+            if name in self._hostvars:
+                targets[name] = self._hostvars[name]
+            elif name not in unknown:
+                unknown.append(name)
+        return targets, unknown
+
+    def file(self) -> str:
+        """Write the ``yaml`` plugin inventory if it changed and return its path."""
+        self._refresh()
+        with self._lock:
+            if self._written != self._etag or not os.path.exists(self.output):
+                atomic_write(self.output, self._yaml)
+                self._written = self._etag
+        return self.output
+
+
+inventory = DynamicInventory()
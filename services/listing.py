@@ -0,0 +1,326 @@
+"""Cached directory listings for the file browser.
+
+Listings are built with a single ``os.scandir`` pass and kept per directory
+until the directory mtime changes.  Sorting, filtering and cursor based
+pagination are done on the cached entries, so browsing a folder with tens of
+thousands of packages does not touch the filesystem again.  Temporary and
+partial uploads (``.<name>.part``, ``.<name>.*.tmp``) are not listed.
+"""
+
+import base64
+import bisect
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from services.files import is_upload_buffer
+
+LISTING_CACHE_SIZE = int(os.getenv('LISTING_CACHE_SIZE', 256))
+# Directories whose file sizes are kept for recursive totals
+LISTING_TREE_CACHE_SIZE = int(os.getenv('LISTING_TREE_CACHE_SIZE', 65536))
+# Seconds a recursive directory total is reused before the subtree is checked again
+LISTING_TREE_TTL = float(os.getenv('LISTING_TREE_TTL', 60))
+SORT_FIELDS = ('name', 'size', 'modified')
+
+
+def format_size(size_bytes: int) -> str:
+    if size_bytes < 1024:
+        return f"{size_bytes} B"
+    if size_bytes < 1024 ** 2:
+        return f"{size_bytes / 1024:.1f} KB"
+    if size_bytes < 1024 ** 3:
+        return f"{size_bytes / (1024 ** 2):.1f} MB"
+    return f"{size_bytes / (1024 ** 3):.1f} GB"
+
+
+class _Listing:
+    """Entries of one directory as of ``mtime_ns``."""
+
+    __slots__ = ('mtime_ns', 'entries', 'orders', 'files_size')
+
+    def __init__(self, mtime_ns: int, entries: list[dict]):
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        # (sort field, descending) -> (sorted entries, sort keys)
+        self.orders: dict[tuple, tuple[list[dict], list[tuple]]] = {}
+        self.files_size = sum(e['size_bytes'] for e in entries)
+
+    def ordered(self, sort: str, descending: bool = False):
+        if (sort, descending) not in self.orders:
+            items = sorted(self.entries, key=lambda e: _sort_key(e, sort, descending))
+            self.orders[sort, descending] = (
+                items, [_sort_key(e, sort, descending) for e in items]
+            )
+        return self.orders[sort, descending]
+
+
+@functools.total_ordering
+class _Desc:
+    """Sorts its value in reverse order."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _sort_value(entry: dict, sort: str):
+    if sort == 'size':
+        return entry['size_bytes']
+    if sort == 'modified':
+        return entry['mtime']
+    return entry['name'].lower()
+
+
+def _make_key(is_file: bool, value, name: str, descending: bool) -> tuple:
+    # Directories come first in both orders
+    if descending:
+        return (is_file, _Desc(value), _Desc(name))
+    return (is_file, value, name)
+
+
+def _sort_key(entry: dict, sort: str, descending: bool = False) -> tuple:
+    return _make_key(not entry['is_dir'], _sort_value(entry, sort), entry['name'], descending)
+
+
+def _encode_cursor(key: tuple, sort: str, order: str) -> str:
+    is_file, value, name = key
+    if isinstance(value, _Desc):
+        value, name = value.value, name.value
+    raw = json.dumps(
+        {'s': sort, 'o': order, 'k': [is_file, value, name]}, separators=(',', ':')
+    ).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def _decode_cursor(cursor: str, sort: str, order: str) -> tuple:
+    """Sort key stored in *cursor*.
+
+    Raises:
+        ValueError: if the cursor is malformed or was made for another sort
+            field or order.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        is_file, value, name = data['k']
+        cursor_sort, cursor_order = data['s'], data['o']
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise ValueError('Cursor belongs to another sort order')
+    value_type = str if sort == 'name' else (int, float)
+    if (
+        not isinstance(is_file, bool)
+        or not isinstance(name, str)
+        or not isinstance(value, value_type)
+        or isinstance(value, bool)
+    ):
+        raise ValueError('Invalid cursor')
+    return _make_key(is_file, value, name, order == 'desc')
+
+
+class DirectoryLister:
+    """Per-directory listing cache validated by directory mtime."""
+
+    def __init__(self, max_dirs: int = LISTING_CACHE_SIZE,
+                 max_tree_dirs: int = LISTING_TREE_CACHE_SIZE, tree_ttl: float = LISTING_TREE_TTL):
+        self.max_dirs = max_dirs
+        self.max_tree_dirs = max_tree_dirs
+        self.tree_ttl = tree_ttl
+        self._cache: OrderedDict[str, _Listing] = OrderedDict()
+        # directory -> (mtime_ns, size of its files, names of its subdirectories)
+        self._trees: OrderedDict[str, tuple] = OrderedDict()
+        # directory -> (monotonic time, recursive total)
+        self._totals: dict[str, tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, directory: str) -> _Listing:
+        """Return listing of *directory*, rescanning it only if it changed."""
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with self._lock:
+            listing = self._cache.get(directory)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                self._cache.move_to_end(directory)
+                return listing
+        listing = _Listing(mtime_ns, _scan(directory))
+        with self._lock:
+            self._cache[directory] = listing
+            self._cache.move_to_end(directory)
+            while len(self._cache) > self.max_dirs:
+                self._cache.popitem(last=False)
+        return listing
+
+    def _tree_node(self, directory: str) -> tuple:
+        """``(mtime_ns, files size, subdirectories)`` of *directory*.
+
+        Kept apart from the listing cache, so walking a large tree neither
+        evicts the listings being browsed nor builds sort orders.
+        """
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with self._lock:
+            node = self._trees.get(directory)
+            if node is not None and node[0] == mtime_ns:
+                self._trees.move_to_end(directory)
+                return node
+            listing = self._cache.get(directory)
+        if listing is None or listing.mtime_ns != mtime_ns:
+            listing = _Listing(mtime_ns, _scan(directory))
+        node = (
+            mtime_ns,
+            listing.files_size,
+            tuple(e['name'] for e in listing.entries if e['is_dir'] and not e['is_link']),
+        )
+        with self._lock:
+            self._trees[directory] = node
+            self._trees.move_to_end(directory)
+            while len(self._trees) > self.max_tree_dirs:
+                self._trees.popitem(last=False)
+        return node
+
+    def tree_size(self, directory: str) -> int:
+        """Return total size of files below *directory*.
+
+        The sum of plain files is kept per directory, so a walk costs one
+        ``stat`` per directory and rescans only directories whose mtime
+        changed; the total itself is reused for ``LISTING_TREE_TTL``
+        seconds, so paging through a folder does not walk it again.
+        Rewriting a file in place does not change the directory mtime and is
+        not noticed until the directory changes.
+        """
+        now = time.monotonic()
+        cached = self._totals.get(directory)
+        if cached is not None and now - cached[0] < self.tree_ttl:
+            return cached[1]
+        total = 0
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                _, files_size, subdirs = self._tree_node(current)
+            except OSError:
+                if current == directory:
+                    raise
+                continue
+            total += files_size
+            pending.extend(os.path.join(current, name) for name in subdirs)
+        with self._lock:
+            if len(self._totals) >= self.max_tree_dirs:
+                self._totals.clear()
+            self._totals[directory] = (now, total)
+        return total
+
+    def page(
+        self,
+        directory: str,
+        sort: str = 'name',
+        order: str = 'asc',
+        query: str = '',
+        cursor: str = '',
+        limit: int = 500,
+        with_totals: bool = False,
+    ) -> dict:
+        """Return one page of *directory* entries.
+
+        ``cursor`` is the opaque ``next_cursor`` of the previous page; it
+        encodes the sort field, order and sort key of the last returned
+        entry, so pages stay consistent when files are added or removed in
+        between.  Directories come first in either order.
+
+        Raises:
+            ValueError: on unknown sort field or order, a *limit* below 1, or
+                a malformed cursor or one made for another sort.
+        """
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+        if sort not in SORT_FIELDS:
+            raise ValueError(f'Unknown sort field: {sort}')
+        if order not in ('asc', 'desc'):
+            raise ValueError(f'Unknown sort order: {order}')
+        listing = self.get(directory)
+        items, keys = listing.ordered(sort, order == 'desc')
+        if query:
+            needle = query.lower()
+            selected = [i for i, e in enumerate(items) if needle in e['name'].lower()]
+            items = [items[i] for i in selected]
+            keys = [keys[i] for i in selected]
+
+        if cursor:
+            start = bisect.bisect_right(keys, _decode_cursor(cursor, sort, order))
+        else:
+            start = 0
+        end = start + limit
+        window = items[start:end]
+        window_keys = keys[start:end]
+        has_more = end < len(items)
+
+        files = []
+        for entry in window:
+            item = {
+                'name': entry['name'],
+                'size': entry['size'],
+                'modified': entry['modified'],
+                'is_dir': entry['is_dir'],
+            }
+            if with_totals and entry['is_dir']:
+                try:
+                    item['size_bytes'] = self.tree_size(
+                        os.path.join(directory, entry['name'])
+                    )
+                    item['size'] = format_size(item['size_bytes'])
+                except OSError:
+                    pass
+            else:
+                item['size_bytes'] = entry['size_bytes']
+            files.append(item)
+        return {
+            'files': files,
+            'total': len(items),
+            'next_cursor': (
+                _encode_cursor(window_keys[-1], sort, order) if has_more and window_keys else None
+            ),
+        }
+
+
+def _scan(directory: str) -> list[dict]:
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if is_upload_buffer(entry.name):
+                continue
+            try:
+                # follows symlinks like the previous os.stat based listing
+                st = entry.stat()
+                is_dir = entry.is_dir()
+            except OSError as e:
+                logging.warning(
+                    f"Не удалось получить информацию о файле {entry.path}: {e}"
+                )
+                continue
+            entries.append(
+                {
+                    'name': entry.name,
+                    'is_dir': is_dir,
+                    'is_link': entry.is_symlink(),
+                    'size_bytes': 0 if is_dir else st.st_size,
+                    'size': '-' if is_dir else format_size(st.st_size),
+                    'mtime': st.st_mtime,
+                    'modified': datetime.datetime.fromtimestamp(
+                        st.st_mtime
+                    ).strftime('%d.%m.%Y %H:%M'),
+                }
+            )
+    return entries
+
+
+lister = DirectoryLister()
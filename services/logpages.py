@@ -0,0 +1,193 @@
+"""Byte-range paging and grep of remote log files, rotated ones included.
+
+Only the shell commands are built and their output parsed here; :mod:`logtail`
+runs them over SSH.  Offsets count bytes of the (decompressed) content.  A
+page is read with ``tail -c +N | head -c LEN``, which seeks in a plain file,
+so only the viewed bytes are read and sent; ``.gz`` siblings are streamed
+through ``gzip -dc`` and the pipe closes as soon as the window is read.
+
+Every command prints a ``<size> <read start>`` header line first.  The read
+starts one byte before the requested offset so the parser can tell whether
+the window begins at a line start; partial lines at either edge are dropped
+and the returned ``start``/``end`` are exact line boundaries for prev/next.
+"""
+
+import os
+import posixpath
+import re
+import shlex
+
+PAGE_DEFAULT = int(os.getenv('LOGTAIL_PAGE_BYTES', 64 * 1024))
+PAGE_MAX = int(os.getenv('LOGTAIL_PAGE_MAX_BYTES', 1024 * 1024))
+GREP_MAX_MATCHES = int(os.getenv('LOGTAIL_GREP_MAX_MATCHES', 500))
+GREP_MAX_BYTES = int(os.getenv('LOGTAIL_GREP_MAX_BYTES', 1024 * 1024))
+GREP_MAX_CONTEXT = 20
+
+SAFE_NAME_RE = re.compile(r'^[\w.@+-]+$')
+GREP_LINE_RE = re.compile(rb'^(\d+)([:-])(.*)$', re.S)
+
+
+def sibling_path(logpath: str, name: str = '') -> str:
+    """Path of *name*, the log itself or one of its rotated siblings.
+
+    Raises:
+        ValueError: if *name* is not ``<base>``, ``<base>.*`` or ``<base>-*``.
+    """
+    if not name:
+        return logpath
+    directory, base = posixpath.split(logpath)
+    if not SAFE_NAME_RE.match(name) or not (
+        name == base or name.startswith(base + '.') or name.startswith(base + '-')
+    ):
+        raise ValueError(f'{name} is not a rotation of {base}')
+    return posixpath.join(directory, name)
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith('.gz')
+
+
+def list_command(logpath: str) -> str:
+    directory, base = posixpath.split(logpath)
+    q = shlex.quote
+    return (
+        f"find {q(directory or '.')} -maxdepth 1 -type f "
+        f"\\( -name {q(base)} -o -name {q(base + '.*')} -o -name {q(base + '-*')} \\) "
+        "-printf '%f\\t%s\\t%T@\\n'"
+    )
+
+
+def parse_list(output: str, logpath: str) -> list[dict]:
+    """Siblings from :func:`list_command`, the live file first, then newest first."""
+    base = posixpath.basename(logpath)
+    files = []
+    for line in output.splitlines():
+        parts = line.split('\t')
+        if len(parts) != 3:
+            continue
+        name, size, mtime = parts
+        files.append({
+            'name': name,
+            'size': int(size),
+            'mtime': int(float(mtime)),
+            'compressed': is_compressed(name),
+        })
+    files.sort(key=lambda f: (f['name'] != base, -f['mtime']))
+    return files
+
+
+def _size(path: str) -> str:
+    q = shlex.quote(path)
+    if is_compressed(path):
+        # The gzip trailer holds the size, no decompression needed.  It is
+        # only stored modulo 2**32; a size below the compressed one has
+        # wrapped and is counted by decompressing.  Larger wraps and
+        # multi-member files (only the last member is reported) go unnoticed.
+        return (
+            f"gzip -l -- {q} | awk 'NR == 2 {{print ($2 < $1) ? \"count\" : $2}}' | "
+            f"{{ read s; [ \"$s\" = count ] && s=$(gzip -dc -- {q} | wc -c); echo \"$s\"; }}"
+        )
+    return f"stat -c %s -- {q}"
+
+
+def _read_from(path: str, start: str) -> str:
+    """Command printing the content of *path* from byte *start* (shell expression)."""
+    q = shlex.quote(path)
+    if is_compressed(path):
+        return f"gzip -dc -- {q} | tail -c +$(({start} + 1))"
+    return f"tail -c +$(({start} + 1)) -- {q}"
+
+
+def page_command(path: str, offset, length: int, backward: bool) -> str:
+    """Read *length* bytes after *offset*, or before it with *backward*.
+
+    ``offset=None`` with *backward* reads the last page.
+    """
+    script = f"size=$({_size(path)}); [ -n \"$size\" ] || exit 2; "
+    if backward:
+        end = '$size' if offset is None else str(int(offset))
+        script += (
+            f"end={end}; [ \"$end\" -gt \"$size\" ] && end=$size; "
+            f"s=$((end - {length} - 1)); [ \"$s\" -lt 0 ] && s=0; "
+            f"n=$((end - s)); "
+        )
+    else:
+        s = max(int(offset or 0) - 1, 0)
+        script += f"s={s}; n={length + (1 if offset else 0)}; "
+    script += f"echo \"$size $s\"; {_read_from(path, '$s')} | head -c \"$n\""
+    return script
+
+
+def parse_page(output: bytes, backward: bool) -> dict:
+    header, _, data = output.partition(b'\n')
+    size, start = (int(v) for v in header.split())
+    if start > 0:
+        # The first byte precedes the window; the window begins after the
+        # first newline (right away when that byte is a newline itself)
+        idx = data.find(b'\n')
+        cut = idx + 1 if idx != -1 else 1
+        data = data[cut:]
+        start += cut
+    start = min(start, size)
+    end = start + len(data)
+    if not backward and end < size:
+        last = data.rfind(b'\n')
+        if last != -1:
+            data = data[:last + 1]
+            end = start + len(data)
+    return {
+        'size': size,
+        'start': start,
+        'end': end,
+        'prev': start if start > 0 else None,
+        'next': end if end < size else None,
+        'lines': data.decode('utf-8', errors='replace').splitlines(),
+    }
+
+
+def grep_command(path: str, pattern: str, context: int, max_matches: int,
+                 offset: int = 0, ignore_case: bool = False) -> str:
+    flags = '-a -b -E' + (' -i' if ignore_case else '')
+    return (
+        f"echo \"$({_size(path)}) {int(offset)}\"; "
+        f"{_read_from(path, str(int(offset)))} | "
+        f"grep {flags} -C {int(context)} -m {int(max_matches)} -e {shlex.quote(pattern)} | "
+        f"head -c {GREP_MAX_BYTES}"
+    )
+
+
+def parse_grep(output: bytes, max_matches: int) -> dict:
+    """Matches and context lines with absolute offsets, grouped like ``grep -C``."""
+    header, _, body = output.partition(b'\n')
+    size, base = (int(v) for v in header.split())
+    groups, group = [], []
+    matches, next_offset = 0, None
+    for raw in body.split(b'\n'):
+        if raw == b'--':
+            if group:
+                groups.append(group)
+            group = []
+            continue
+        m = GREP_LINE_RE.match(raw)
+        if not m:
+            continue
+        offset = base + int(m.group(1))
+        is_match = m.group(2) == b':'
+        group.append({
+            'offset': offset,
+            'match': is_match,
+            'text': m.group(3).decode('utf-8', errors='replace'),
+        })
+        if is_match:
+            matches += 1
+            next_offset = offset + len(m.group(3)) + 1
+    if group:
+        groups.append(group)
+    return {
+        'size': size,
+        'from': base,
+        'matches': matches,
+        'groups': groups,
+        # grep stopped at max_matches: continue the search from here
+        'next': next_offset if matches >= max_matches else None,
+    }
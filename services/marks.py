@@ -0,0 +1,154 @@
+"""Ansible completion marks pushed by the hosts themselves.
+
+The last task of the playbook (or a small agent) POSTs the content of
+``/opt/ansible_mark.json`` to ``/api/ansible/mark`` with
+``Authorization: Bearer $ANSIBLE_MARK_TOKEN``, e.g.::
+
+    - name: Report completion to pxe-watch
+      uri:
+        url: "http://pxe-watch:5000/api/ansible/mark"
+        method: POST
+        headers: {Authorization: "Bearer {{ pxe_mark_token }}"}
+        body_format: json
+        body: {status: ok, ip: "{{ ansible_host }}"}
+
+The mark is stored in ``ansible_marks`` and its status in ``playbook_status``
+(and the host registry) at once.  :func:`services.get_ansible_mark` answers
+from the stored mark; while a run is queued it reports ``pending``, while it
+is in progress it waits up to
+``ANSIBLE_MARK_PUSH_DEADLINE`` seconds for the push before reading the file
+over SSH.  A mark read over SSH is stored the same way, so a host is pulled
+at most once per run.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+from db_utils import get_db
+from services.hosts import registry as host_registry
+
+MARK_TOKEN = os.getenv('ANSIBLE_MARK_TOKEN', '')
+MARK_PUSH_DEADLINE = int(os.getenv('ANSIBLE_MARK_PUSH_DEADLINE', 900))
+MARK_MAX_BYTES = int(os.getenv('ANSIBLE_MARK_MAX_BYTES', 64 * 1024))
+STATUS_ALIASES = {'success': 'ok', 'error': 'failed', 'failure': 'failed'}
+STATUSES = ('ok', 'failed', 'running')
+# Playbook statuses of a run that has not finished yet
+IN_PROGRESS = ('queued', 'running')
+TS_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class MarkError(ValueError):
+    """Raised for a mark that is not a valid completion mark."""
+
+
+def normalize_mark(data, strict: bool = True) -> dict:
+    """Validate a mark document and return it with a normalized ``status``.
+
+    Raises:
+        MarkError: if *data* is not an object, or with *strict* has a status
+            other than ``STATUSES``.
+    """
+    if not isinstance(data, dict):
+        raise MarkError('mark must be a JSON object')
+    status = data.get('status', 'ok')
+    if not isinstance(status, str):
+        raise MarkError('status must be a string')
+    status = status.strip().lower() or 'ok'
+    status = STATUS_ALIASES.get(status, status)
+    if strict and status not in STATUSES:
+        raise MarkError(f'unknown status {status!r}')
+    return dict(data, status=status)
+
+
+class MarkStore:
+    """Marks by IP, loaded once and written through to the database."""
+
+    def __init__(self):
+        self._marks: dict[str, dict] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with get_db() as db:
+                for row in db.execute('SELECT ip, status, data, received, source FROM ansible_marks'):
+                    self._marks[row['ip']] = {
+                        'data': json.loads(row['data'] or '{}'),
+                        'status': row['status'],
+                        'received': row['received'],
+                        'source': row['source'],
+                    }
+            self._loaded = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._marks.clear()
+            self._loaded = False
+
+    def store(self, ip: str, data: dict, source: str) -> dict:
+        """Save normalized mark *data* of *ip* and update its playbook status."""
+        self._ensure_loaded()
+        received = datetime.datetime.utcnow().strftime(TS_FORMAT)
+        text = json.dumps(data, ensure_ascii=False)
+        with get_db() as db:
+            db.execute(
+                """
+                INSERT INTO ansible_marks (ip, status, data, received, source)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(ip) DO UPDATE SET
+                    status = excluded.status,
+                    data = excluded.data,
+                    received = excluded.received,
+                    source = excluded.source
+                """,
+                (ip, data['status'], text, received, source),
+            )
+            db.execute(
+                """
+                INSERT INTO playbook_status (ip, status, updated)
+                VALUES (?, ?, ?)
+                ON CONFLICT(ip) DO UPDATE SET
+                    status = excluded.status,
+                    updated = excluded.updated
+                """,
+                (ip, data['status'], received),
+            )
+        host_registry.set_playbook(ip, data['status'], received)
+        mark = {'data': data, 'status': data['status'], 'received': received, 'source': source}
+        self._marks[ip] = mark
+        return mark
+
+    def current(self, ip: str):
+        """Stored mark of *ip* unless a newer playbook run was queued since."""
+        self._ensure_loaded()
+        mark = self._marks.get(ip)
+        if mark is None:
+            return None
+        stored = host_registry.playbook(ip)
+        if stored and stored[0] in IN_PROGRESS and (stored[1] or '') > mark['received']:
+            return None
+        return dict(mark['data'], received=mark['received'], source=mark['source'])
+
+    @staticmethod
+    def awaiting_push(ip: str) -> bool:
+        """Whether the running playbook of *ip* may still push its mark."""
+        if not MARK_TOKEN:
+            return False
+        stored = host_registry.playbook(ip)
+        if not stored or stored[0] != 'running' or not stored[1]:
+            return False
+        try:
+            started = datetime.datetime.strptime(stored[1], TS_FORMAT)
+        except ValueError:
+            return False
+        age = (datetime.datetime.utcnow() - started).total_seconds()
+        return age < MARK_PUSH_DEADLINE
+
+
+marks = MarkStore()
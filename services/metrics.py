@@ -0,0 +1,247 @@
+"""In-process metrics exposed in Prometheus text format on ``/metrics``.
+
+Counters and histograms are split into shards chosen by the calling thread
+(or greenlet), each with its own lock, and the shards are only merged when
+metrics are scraped.  Recording a value costs one uncontended lock and a few
+list updates, so instrumenting hot paths like ``/api/register`` is cheap.
+Gauges are callbacks evaluated at scrape time.
+
+Values are per process; run a single worker or scrape each one.
+"""
+
+import bisect
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import db_utils
+from config import INSTALL_DONE_STAGES
+
+SHARDS = 16
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+LONG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+# Stages clients report are free text; only these become label values
+KNOWN_STAGES = frozenset(
+    [s.strip() for s in os.getenv('METRICS_STAGES', 'unknown,installing').split(',') if s.strip()]
+    + INSTALL_DONE_STAGES
+)
+
+
+_shard = threading.local()
+# next() on a count is atomic, threads take shards round-robin
+_shard_counter = itertools.count()
+
+
+def _shard_index() -> int:
+    # Thread idents are aligned, so ``ident % SHARDS`` would always be 0
+    try:
+        return _shard.index
+    except AttributeError:
+        _shard.index = next(_shard_counter) % SHARDS
+        return _shard.index
+
+
+def stage_label(stage: str) -> str:
+    """*stage* if it is one of ``KNOWN_STAGES``, otherwise ``other``."""
+    return stage if stage in KNOWN_STAGES else 'other'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def header(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self._shards = [({}, threading.Lock()) for _ in range(SHARDS)]
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        values, lock = self._shards[_shard_index()]
+        with lock:
+            values[labels] = values.get(labels, 0) + amount
+
+    def collect(self) -> dict:
+        total: dict[tuple, float] = {}
+        for values, lock in self._shards:
+            with lock:
+                items = list(values.items())
+            for key, value in items:
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {value:g}')
+        return lines
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per bucket counts..., +Inf count, sum]
+        self._shards = [({}, threading.Lock()) for _ in range(SHARDS)]
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        values, lock = self._shards[_shard_index()]
+        with lock:
+            row = values.get(labels)
+            if row is None:
+                row = values[labels] = [0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def collect(self) -> dict:
+        total: dict[tuple, list] = {}
+        for values, lock in self._shards:
+            with lock:
+                items = [(k, list(v)) for k, v in values.items()]
+            for key, row in items:
+                acc = total.get(key)
+                if acc is None:
+                    total[key] = row
+                else:
+                    for i, v in enumerate(row):
+                        acc[i] += v
+        return total
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, row in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{bound:g}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            cumulative += row[len(self.buckets)]
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            plain = _format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{plain} {row[-1]:g}')
+            lines.append(f'{self.name}_count{plain} {cumulative}')
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge whose samples come from ``func`` returning ``{labels: value}``."""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, func, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, value in sorted(self.func().items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {value:g}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, func, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help, func, labels))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f'# {metric.name} unavailable: {_escape(e)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REGISTRATIONS = registry.counter(
+    'pxe_registrations_total', 'Host registrations by stage', ('stage',))
+REGISTRATION_SECONDS = registry.histogram(
+    'pxe_registration_duration_seconds', 'Time to store a registration')
+PLAYBOOK_RUNS = registry.counter(
+    'pxe_playbook_runs_total', 'Finished ansible-playbook runs by outcome', ('outcome',))
+PLAYBOOK_SECONDS = registry.histogram(
+    'pxe_playbook_duration_seconds', 'ansible-playbook run duration', ('outcome',),
+    buckets=LONG_BUCKETS)
+SSH_COMMANDS = registry.counter(
+    'pxe_ssh_commands_total', 'Remote commands by call site and outcome', ('site', 'outcome'))
+SSH_SECONDS = registry.histogram(
+    'pxe_ssh_command_duration_seconds', 'Remote command latency by call site', ('site',))
+SQLITE_SECONDS = registry.histogram(
+    'pxe_sqlite_transaction_duration_seconds', 'SQLite transaction duration', ('outcome',))
+STREAMS_STARTED = registry.counter(
+    'pxe_streams_started_total', 'Log streams started by kind', ('kind',))
+STREAMS_REJECTED = registry.counter(
+    'pxe_streams_rejected_total', 'Log streams rejected by limits', ('kind',))
+
+db_utils.TimedConnection.observer = SQLITE_SECONDS.observe
+
+
+@contextmanager
+def ssh_call(site: str):
+    """Time a remote command; set ``state['ok'] = False`` to record a failure.
+
+    An exception leaving the block is recorded as an error as well.
+    """
+    state = {'ok': True}
+    started = time.perf_counter()
+    try:
+        yield state
+    except BaseException:
+        state['ok'] = False
+        raise
+    finally:
+        SSH_SECONDS.observe(time.perf_counter() - started, site)
+        SSH_COMMANDS.inc(site, 'ok' if state['ok'] else 'error')
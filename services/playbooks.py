@@ -0,0 +1,68 @@
+"""Playbook run queue: bounded concurrency and one pending run per host.
+
+Every registration asks for a playbook run.  During a mass rollout that used
+to start one ``ansible-playbook`` per request at once.  Runs now wait for one
+of ``ANSIBLE_PLAYBOOK_CONCURRENCY`` slots, a request for a host that is
+already queued replaces the queued run (e.g. with another run profile), and
+one for a host whose run is in progress schedules exactly one more run after
+it (the host changed since it started).
+"""
+
+import logging
+import os
+import threading
+
+PLAYBOOK_CONCURRENCY = int(os.getenv('ANSIBLE_PLAYBOOK_CONCURRENCY', 8))
+
+QUEUED, RUNNING, RERUN = 'queued', 'running', 'rerun'
+
+
+class PlaybookQueue:
+    def __init__(self, concurrency: int = PLAYBOOK_CONCURRENCY):
+        self._slots = threading.BoundedSemaphore(max(1, concurrency))
+        self._state: dict[str, str] = {}
+        # Latest function submitted for each host, run at the next start
+        self._funcs: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, ip: str, func) -> bool:
+        """Run *func* for *ip* when a slot is free; ``False`` if merged into a pending run.
+
+        A merged *func* replaces the one of the pending run.
+        """
+        with self._lock:
+            self._funcs[ip] = func
+            state = self._state.get(ip)
+            if state == RUNNING:
+                self._state[ip] = RERUN
+            if state is not None:
+                return False
+            self._state[ip] = QUEUED
+        threading.Thread(target=self._run, args=(ip,), daemon=True).start()
+        return True
+
+    def _run(self, ip: str) -> None:
+        while True:
+            with self._slots:
+                with self._lock:
+                    self._state[ip] = RUNNING
+                    func = self._funcs[ip]
+                try:
+                    func()
+                except Exception as e:
+                    logging.error(f'Ошибка выполнения playbook для {ip}: {e}')
+            with self._lock:
+                if self._state.get(ip) != RERUN:
+                    self._state.pop(ip, None)
+                    self._funcs.pop(ip, None)
+                    return
+                self._state[ip] = QUEUED
+
+    def counts(self) -> dict:
+        with self._lock:
+            states = list(self._state.values())
+        running = sum(1 for s in states if s != QUEUED)
+        return {'running': running, 'queued': len(states) - running}
+
+
+queue = PlaybookQueue()
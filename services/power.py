@@ -0,0 +1,104 @@
+"""Power actions on hosts: Wake-on-LAN and reboot over SSH.
+
+Used by the ``/api/host/*`` endpoints and by the rollout controller.
+"""
+
+import logging
+import subprocess
+
+from config import ANSIBLE_INVENTORY, SSH_PASSWORD, SSH_USER
+from services.metrics import ssh_call
+
+
+class PowerError(RuntimeError):
+    """Raised when a power action could not be sent."""
+
+
+def get_ssh_credentials(ip: str) -> tuple[str, str]:
+    """Return SSH user and password for *ip* from Ansible inventory.
+
+    Falls back to ``SSH_USER`` and ``SSH_PASSWORD`` if the inventory does not
+    contain specific credentials for the host. Inventory lines are expected to
+    be in the form ``host var1=value1 var2=value2``.
+    """
+    user = SSH_USER
+    password = SSH_PASSWORD
+    try:
+        with open(ANSIBLE_INVENTORY) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or line.startswith('['):
+                    continue
+                parts = line.split()
+                host = parts[0]
+                if host == ip:
+                    vars_dict = {
+                        k: v
+                        for k, v in (
+                            p.split('=', 1) for p in parts[1:] if '=' in p
+                        )
+                    }
+                    user = vars_dict.get('ansible_user', user)
+                    password = (
+                        vars_dict.get('ansible_password')
+                        or vars_dict.get('ansible_ssh_pass')
+                        or password
+                    )
+                    break
+    except FileNotFoundError:
+        logging.warning(
+            f'Inventory file {ANSIBLE_INVENTORY} not found when looking up {ip}'
+        )
+    except Exception as e:
+        logging.error(f'Error reading inventory {ANSIBLE_INVENTORY}: {e}')
+    return user, password
+
+
+def wake(mac: str) -> str:
+    """Send a Wake-on-LAN packet to *mac* and return a message.
+
+    Raises:
+        PowerError: if ``wakeonlan`` is missing or fails.
+    """
+    try:
+        subprocess.run(['wakeonlan', mac], capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise PowerError(
+            f"Ошибка выполнения wakeonlan: {e.stderr.strip() if e.stderr else str(e)}"
+        ) from e
+    except FileNotFoundError as e:
+        raise PowerError("Команда 'wakeonlan' не найдена. Установите пакет 'wakeonlan'.") from e
+    logging.info(f'Wake-on-LAN пакет отправлен на {mac}')
+    return f'Wake-on-LAN пакет отправлен на {mac}.'
+
+
+def reboot(ip: str) -> str:
+    """Ask *ip* to reboot over SSH and return a message.
+
+    The host drops the connection while rebooting, so an SSH timeout or error
+    still counts as sent (and is logged).
+    """
+    user, password = get_ssh_credentials(ip)
+    cmd = (
+        f"sshpass -p '{password}' ssh -o StrictHostKeyChecking=no "
+        f"-o UserKnownHostsFile=/dev/null {user}@{ip} "
+        "\"nohup sh -c 'sleep 2 && reboot' >/dev/null 2>&1 &\""
+    )
+    try:
+        with ssh_call('reboot'):
+            subprocess.run(
+                cmd, shell=True, check=True, timeout=10, capture_output=True, text=True
+            )
+    except subprocess.TimeoutExpired as e:
+        msg = f'Команда перезагрузки отправлена на {ip} (таймаут ожидания ответа)'
+        logging.warning(msg + f" | Stderr: {e.stderr if e.stderr else 'N/A'}")
+        return msg
+    except subprocess.CalledProcessError as e:
+        msg = f'Команда перезагрузки отправлена на {ip} (возможна ошибка SSH)'
+        detailed_msg = f"{msg}. Код ошибки SSH: {e.returncode}"
+        if e.stderr:
+            detailed_msg += f". Вывод SSH: {e.stderr.strip()}"
+        logging.warning(detailed_msg)
+        return msg
+    logging.info(f'Команда перезагрузки отправлена на {ip}')
+    return f'Команда перезагрузки отправлена на {ip}'
@@ -0,0 +1,105 @@
+"""Per-host preseed rendering.
+
+Preseed files in ``PRESEED_DIR`` are treated as Jinja templates and rendered
+with variables of the requesting host taken from the ``hosts`` table and the
+Ansible inventory.  Jinja keeps compiled templates and reloads them when the
+file changes; rendered output is cached per template version and host
+variables so a boot storm of identical requests renders each preseed once.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined
+
+from config import PRESEED_DIR, PRESEED_PATH
+from logtail import load_inventory
+from services.hosts import registry as host_registry
+
+RENDER_CACHE_SIZE = int(os.getenv('PRESEED_RENDER_CACHE_SIZE', 2048))
+
+_env = Environment(
+    loader=FileSystemLoader(PRESEED_DIR),
+    auto_reload=True,
+    cache_size=256,
+    undefined=StrictUndefined,
+    keep_trailing_newline=True,
+)
+_rendered: OrderedDict[tuple, bytes] = OrderedDict()
+_rendered_lock = threading.Lock()
+
+
+def normalize_mac(mac: str) -> str:
+    """Return MAC in ``aa:bb:cc:dd:ee:ff`` form (empty string if invalid)."""
+    digits = re.sub(r'[^0-9a-fA-F]', '', mac or '')
+    if len(digits) != 12:
+        return ''
+    return ':'.join(digits[i:i + 2] for i in range(0, 12, 2)).lower()
+
+
+def inventory_vars_for(mac: str, ip: str) -> tuple[str, dict]:
+    """Return ``(inventory host name, vars)`` of the host with *mac* or *ip*."""
+    inventory = load_inventory()
+    for host, vars in inventory.items():
+        if vars.get('mac', '').lower() == mac:
+            return host, vars
+    if ip and ip in inventory:
+        return ip, inventory[ip]
+    return '', {}
+
+
+def host_vars(mac: str, ip: str = '') -> dict:
+    """Collect template variables for the host with *mac*."""
+    record = host_registry.get(mac)
+    vars = {'mac': mac, 'ip': ip, 'stage': '', 'details': '', 'first_seen': ''}
+    if record is not None:
+        vars.update(
+            ip=record.ip if record.ip and record.ip != '—' else ip,
+            stage=record.stage,
+            details=record.details,
+            first_seen=record.first_ts,
+        )
+    inventory_host, inventory_vars = inventory_vars_for(mac, vars['ip'])
+    vars['inventory_hostname'] = inventory_host
+    vars.update(inventory_vars)
+    return vars
+
+
+def default_template_name() -> str:
+    """Return name of the active preseed (target of ``PRESEED_PATH``)."""
+    if not os.path.exists(PRESEED_PATH):
+        return ''
+    return os.path.basename(os.path.realpath(PRESEED_PATH))
+
+
+def render_preseed(template_name: str, vars: dict) -> bytes:
+    """Render *template_name* with *vars*, reusing cached output.
+
+    Raises:
+        jinja2.TemplateNotFound: if the template does not exist.
+        jinja2.TemplateError: if rendering fails.
+    """
+    try:
+        st = os.stat(os.path.join(PRESEED_DIR, template_name))
+        version = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        version = None
+    vars_hash = hashlib.sha1(
+        json.dumps(vars, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    key = (template_name, version, vars_hash)
+    with _rendered_lock:
+        cached = _rendered.get(key)
+        if cached is not None:
+            _rendered.move_to_end(key)
+            return cached
+    output = _env.get_template(template_name).render(**vars).encode('utf-8')
+    with _rendered_lock:
+        _rendered[key] = output
+        while len(_rendered) > RENDER_CACHE_SIZE:
+            _rendered.popitem(last=False)
+    return output
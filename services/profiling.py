@@ -0,0 +1,379 @@
+"""Per-endpoint latency tracking and on-demand sampled profiling.
+
+Every request's time to response is appended to a bounded per-endpoint
+window; percentiles are computed only when ``/api/profile/latency`` is read.
+Streamed bodies (``/api/tail`` and friends) are measured up to the first
+byte.
+
+A profiling session targets one endpoint (``api.api_register``) or one
+background job (``task:inventory_sync``) and runs for ``seconds`` or until
+``limit`` samples were taken, profiling one of every ``every`` requests or
+runs with ``cProfile``.  Long-running jobs never return, so for them the
+job's thread (its greenlet under gevent workers) is sampled from a helper
+thread instead and only collapsed stacks are available.  While no session
+is active the request hooks cost one attribute check.
+
+``cProfile`` hooks the OS thread, not the greenlet.  Under gevent workers a
+profiled request also records whatever other greenlets run while it waits
+(other requests, streams, background jobs), so endpoint profiles are not
+strictly per request.
+"""
+
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import deque
+
+from flask import g, request
+
+LATENCY_WINDOW = int(os.getenv('PROFILE_LATENCY_WINDOW', 300))
+LATENCY_SAMPLES = int(os.getenv('PROFILE_LATENCY_SAMPLES', 2048))
+MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 600))
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.005))
+COLLAPSE_MAX_DEPTH = 64
+
+
+def current_runner():
+    """Handle of the calling thread for :func:`runner_frame`.
+
+    Under gevent monkey-patching threads are greenlets that share one OS
+    thread, so the greenlet itself is returned instead of the thread ident.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        import gevent
+        return gevent.getcurrent()
+    return threading.get_ident()
+
+
+def runner_frame(runner):
+    """Current frame of *runner*, ``None`` if it is not running."""
+    if runner is None:
+        return None
+    if isinstance(runner, int):
+        return sys._current_frames().get(runner)
+    # A switched-out greenlet keeps its stack in gr_frame
+    return None if runner.dead else runner.gr_frame
+
+
+class LatencyTracker:
+    """Rolling window of request durations per endpoint."""
+
+    def __init__(self, window: int = LATENCY_WINDOW, samples: int = LATENCY_SAMPLES):
+        self.window = window
+        self.samples = samples
+        self._series: dict[str, deque] = {}
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        series = self._series.get(endpoint)
+        if series is None:
+            series = self._series.setdefault(endpoint, deque(maxlen=self.samples))
+        # deque.append is atomic, no lock needed on the request path
+        series.append((time.monotonic(), seconds))
+
+    def snapshot(self) -> dict:
+        cutoff = time.monotonic() - self.window
+        result = {}
+        for endpoint, series in list(self._series.items()):
+            values = sorted(s for ts, s in list(series) if ts >= cutoff)
+            if not values:
+                continue
+
+            def pct(p):
+                return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2)
+
+            result[endpoint] = {
+                'count': len(values),
+                'rate': round(len(values) / self.window, 3),
+                'p50_ms': pct(0.5),
+                'p90_ms': pct(0.9),
+                'p99_ms': pct(0.99),
+                'max_ms': round(values[-1] * 1000, 2),
+            }
+        return {'window': self.window, 'endpoints': result}
+
+
+class ProfileSession:
+    def __init__(self, target: str, every: int, seconds: float, limit: int,
+                 sampling: bool = False):
+        self.target = target
+        self.every = max(1, every)
+        self.seconds = min(max(1.0, seconds), MAX_SECONDS)
+        self.limit = max(1, limit)
+        self.mode = 'sampling' if sampling else 'cprofile'
+        self.started = time.time()
+        self.deadline = time.monotonic() + self.seconds
+        self.seen = 0
+        self.samples = 0
+        self.finished = None
+        self.reason = None
+        self.stats = None
+        self.stacks: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        """Return ``True`` if the current request or run should be profiled."""
+        with self.lock:
+            if self.finished is not None:
+                return False
+            self.seen += 1
+            return self.seen % self.every == 0
+
+    def add(self, profile: cProfile.Profile) -> bool:
+        """Merge *profile*; return ``True`` once the sample limit is reached."""
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.samples += 1
+            return self.samples >= self.limit
+
+    def info(self) -> dict:
+        return {
+            'target': self.target,
+            'mode': self.mode,
+            'every': self.every,
+            'seconds': self.seconds,
+            'limit': self.limit,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.started)),
+            'seen': self.seen,
+            'samples': self.samples,
+            'active': self.finished is None,
+            'finished_reason': self.reason,
+        }
+
+
+def collapse_stats(stats: pstats.Stats) -> str:
+    """Render *stats* as collapsed stacks (``a;b;c <microseconds>``).
+
+    cProfile only records caller/callee pairs, so time of a function called
+    from several places is split between the paths in proportion to the
+    time each caller spent in it.
+    """
+    def label(func):
+        filename, line, name = func
+        if filename == '~':
+            return name
+        return f'{os.path.basename(filename)}:{line}({name})'
+
+    callees: dict[tuple, dict] = {}
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge[3]
+
+    lines: dict[str, float] = {}
+
+    def visit(func, path, on_path, share):
+        _, _, tt, ct, _ = stats.stats[func]
+        if ct <= 0 or share <= 0:
+            return
+        scale = min(1.0, share / ct)
+        if tt * scale > 0:
+            key = ';'.join(path)
+            lines[key] = lines.get(key, 0) + tt * scale
+        if len(path) >= COLLAPSE_MAX_DEPTH:
+            return
+        for callee, edge_ct in callees.get(func, {}).items():
+            if callee in on_path:
+                continue
+            on_path.add(callee)
+            visit(callee, path + [label(callee)], on_path, edge_ct * scale)
+            on_path.discard(callee)
+
+    for root in roots:
+        visit(root, [label(root)], {root}, stats.stats[root][3])
+    out = [f'{stack} {int(seconds * 1e6)}' for stack, seconds in lines.items()
+           if int(seconds * 1e6) > 0]
+    return '\n'.join(sorted(out)) + '\n'
+
+
+class Profiler:
+    def __init__(self):
+        # Hot path check: ``None`` unless a session is running
+        self.target = None
+        self.session: ProfileSession = None
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        # cProfile instances must not overlap (Python 3.12 allows only one)
+        self._active = threading.Lock()
+
+    def start(self, target: str, every: int = 1, seconds: float = 60, limit: int = 100,
+              runner=None) -> ProfileSession:
+        """Start a session, replacing a running one.
+
+        With *runner* (see :func:`current_runner`) the stacks of that thread
+        or greenlet are sampled instead of profiling calls of *target*.
+
+        Raises:
+            ValueError: if *runner* is given but is not running.
+        """
+        sampling = runner is not None
+        if sampling and runner_frame(runner) is None:
+            raise ValueError(f'{target} is not running')
+        session = ProfileSession(target, every, seconds, limit, sampling)
+        with self._lock:
+            if self.session is not None:
+                self._finish(self.session, 'replaced')
+            self.session = session
+            self.target = target if not sampling else None
+        if sampling:
+            threading.Thread(
+                target=self._sample_thread, args=(session, runner),
+                name='profile-sampler', daemon=True,
+            ).start()
+        logging.info(f'Профилирование {target} ({session.mode}) на {session.seconds:g} с')
+        return session
+
+    def stop(self, reason: str = 'stopped') -> ProfileSession:
+        with self._lock:
+            if self.session is not None:
+                self._finish(self.session, reason)
+            return self.session
+
+    def _finish(self, session: ProfileSession, reason: str) -> None:
+        with session.lock:
+            if session.finished is None:
+                session.finished = time.monotonic()
+                session.reason = reason
+        if self.session is session:
+            self.target = None
+
+    def _current(self, target: str):
+        session = self.session
+        if session is None or session.target != target or session.finished is not None:
+            return None
+        if time.monotonic() >= session.deadline:
+            with self._lock:
+                self._finish(session, 'deadline')
+            return None
+        return session
+
+    def _begin(self, target: str):
+        session = self._current(target)
+        if session is None or not session.take():
+            return None
+        if not self._active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return session, profile
+
+    def _end(self, state) -> None:
+        session, profile = state
+        profile.disable()
+        self._active.release()
+        if session.add(profile):
+            with self._lock:
+                self._finish(session, 'limit')
+
+    def run_task(self, name: str, func):
+        """Call ``func()``, profiling it if a session targets ``task:<name>``."""
+        if self.target is None:
+            return func()
+        state = self._begin(f'task:{name}')
+        if state is None:
+            return func()
+        try:
+            return func()
+        finally:
+            self._end(state)
+
+    def _sample_thread(self, session: ProfileSession, runner) -> None:
+        while session.finished is None:
+            if time.monotonic() >= session.deadline:
+                with self._lock:
+                    self._finish(session, 'deadline')
+                break
+            frame = runner_frame(runner)
+            if frame is None:
+                with self._lock:
+                    self._finish(session, 'thread exited')
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:'
+                             f'{code.co_firstlineno}({code.co_name})')
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            with session.lock:
+                session.stacks[key] = session.stacks.get(key, 0) + 1
+                session.seen += 1
+                session.samples += 1
+            if session.samples >= session.limit:
+                with self._lock:
+                    self._finish(session, 'limit')
+                break
+            time.sleep(SAMPLE_INTERVAL)
+
+    def pstats_dump(self) -> bytes:
+        """Return the current session's data in ``pstats`` file format.
+
+        Raises:
+            LookupError: if there is no cProfile data.
+        """
+        session = self.session
+        if session is None or session.stats is None:
+            raise LookupError('no cProfile data')
+        with session.lock:
+            return marshal.dumps(session.stats.stats)
+
+    def collapsed(self) -> str:
+        """Return the current session's data as collapsed stacks.
+
+        Raises:
+            LookupError: if there is no data.
+        """
+        session = self.session
+        if session is None:
+            raise LookupError('no profile data')
+        with session.lock:
+            if session.mode == 'sampling':
+                if not session.stacks:
+                    raise LookupError('no profile data')
+                return ''.join(f'{k} {v}\n' for k, v in sorted(session.stacks.items()))
+            if session.stats is None:
+                raise LookupError('no cProfile data')
+            return collapse_stats(session.stats)
+
+    def top(self, limit: int = 30) -> str:
+        """Return a ``pstats`` text report sorted by cumulative time."""
+        session = self.session
+        if session is None or session.stats is None:
+            return ''
+        out = io.StringIO()
+        with session.lock:
+            stats = pstats.Stats(stream=out)
+            stats.add(session.stats)
+            stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def init_app(self, app) -> None:
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self) -> None:
+        g._profile_start = time.perf_counter()
+        if self.target is not None and self.target == request.endpoint:
+            g._profile_state = self._begin(request.endpoint)
+
+    def _teardown_request(self, exc) -> None:
+        state = g.pop('_profile_state', None)
+        if state is not None:
+            self._end(state)
+        started = g.pop('_profile_start', None)
+        if started is not None:
+            self.latency.record(request.endpoint or 'unmatched', time.perf_counter() - started)
+
+
+profiler = Profiler()
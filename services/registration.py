@@ -1,7 +1,13 @@
 import datetime
 import logging
 
+from config import INSTALL_DONE_STAGES
 from db_utils import get_db
+from services.analytics import analytics as install_analytics
+from services.hosts import is_early_stage, registry as host_registry
+from services.metrics import REGISTRATIONS, REGISTRATION_SECONDS, stage_label
+from services.rollout import controller as rollouts
+from services.run_profiles import FACT_CACHE_ENABLED, facts
 
 
 def register_host(mac: str, ip: str, stage: str, details: str) -> None:
@@ -15,8 +21,10 @@ def register_host(mac: str, ip: str, stage: str, details: str) -> None:
         logging.warning('Отсутствует MAC-адрес в запросе')
         raise ValueError("Missing MAC")
 
+    REGISTRATIONS.inc(stage_label(stage))
     ts = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-    with get_db() as db:
+    previous = host_registry.stage(mac)
+    with REGISTRATION_SECONDS.time(), get_db() as db:
         db.execute(
             '''
             INSERT INTO hosts(mac, ip, stage, details, ts, first_ts)
@@ -30,4 +38,22 @@ def register_host(mac: str, ip: str, stage: str, details: str) -> None:
             ''',
             (mac, ip, stage, details, ts, ts),
         )
+    host_registry.register(mac, ip, stage, details, ts)
+    try:
+        install_analytics.observe(mac, stage, ts)
+    except Exception as e:
+        # Analytics must never fail a registration
+        logging.error(f'Не удалось записать переход этапа для {mac}: {e}')
+    if FACT_CACHE_ENABLED and stage not in INSTALL_DONE_STAGES and (
+        previous in INSTALL_DONE_STAGES or is_early_stage(previous)
+    ):
+        # A new install: facts of the old system must not be reused
+        try:
+            facts.invalidate_host(mac, ip)
+        except Exception as e:
+            logging.error(f'Не удалось сбросить кэш фактов для {mac}: {e}')
+    try:
+        rollouts.observe(mac, stage, ip)
+    except Exception as e:
+        logging.error(f'Не удалось обновить rollout для {mac}: {e}')
     logging.info(f'Зарегистрирован или обновлен хост с MAC: {mac}')
@@ -0,0 +1,401 @@
+"""Rollouts: reinstall many hosts in waves without saturating TFTP, HTTP or Ansible.
+
+A rollout is a list of MACs split into waves of ``wave_size``.  The
+``rollout_admit`` job calls :meth:`RolloutController.tick`, which admits
+hosts of the first wave with pending hosts while
+
+* fewer than ``max_installing`` admitted hosts have not finished installing
+  (reached one of ``INSTALL_DONE_STAGES``),
+* fewer than ``playbook_concurrency`` of the rollout's hosts have a running
+  playbook (0 disables the check), and
+* every host of the earlier waves has finished, failed or reached one of
+  ``advance_stages`` (the stages after which it no longer loads the installer
+  from the server).
+
+Admitting a host sets its one-shot boot action (``install`` by default) and
+sends the power action: ``wol``, ``reboot`` or ``none`` for hosts that are
+already looping at the iPXE prompt.  Until it is admitted, a host of a
+running or paused rollout gets the ``wait`` boot script, so powering a whole
+hall on at once is harmless.  Stages are taken from registrations as they
+arrive (:meth:`observe`), so a stage passed between two ticks is not missed.
+
+Rollouts and their hosts are stored in ``rollouts`` and ``rollout_hosts``
+and kept in memory like the host registry: loaded once per process and
+written through.
+"""
+
+import datetime
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import INSTALL_DONE_STAGES
+from db_utils import get_db
+from services.boot import BOOT_ACTIONS, state as boot_state
+from services.hosts import registry as host_registry
+from services.marks import IN_PROGRESS
+from services.power import reboot, wake
+from services.preseed import normalize_mac
+
+ROLLOUT_TICK_INTERVAL = float(os.getenv('ROLLOUT_TICK_INTERVAL', 5))
+ROLLOUT_HOST_TIMEOUT = int(os.getenv('ROLLOUT_HOST_TIMEOUT', 3600))
+ROLLOUT_POWER_PARALLEL = int(os.getenv('ROLLOUT_POWER_PARALLEL', 16))
+ROLLOUT_ADVANCE_STAGES = [
+    s.strip() for s in os.getenv('ROLLOUT_ADVANCE_STAGES', 'installing').split(',')
+    if s.strip()
+]
+ROLLOUT_WAVE_SIZE = int(os.getenv('ROLLOUT_WAVE_SIZE', 25))
+ROLLOUT_MAX_INSTALLING = int(os.getenv('ROLLOUT_MAX_INSTALLING', 50))
+ROLLOUT_PLAYBOOK_CONCURRENCY = int(os.getenv('ROLLOUT_PLAYBOOK_CONCURRENCY', 0))
+
+POWER_ACTIONS = ('wol', 'reboot', 'none')
+ACTIVE = ('running', 'paused')
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class RolloutError(ValueError):
+    """Raised for an invalid rollout request or state change."""
+
+
+def _now() -> str:
+    return datetime.datetime.utcnow().strftime(TS_FORMAT)
+
+
+def _age(ts: str, now: datetime.datetime) -> float:
+    try:
+        return (now - datetime.datetime.strptime(ts, TS_FORMAT)).total_seconds()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class RolloutController:
+    def __init__(self):
+        self._rollouts: dict[int, dict] = {}
+        self._hosts: dict[int, dict[str, dict]] = {}
+        # MAC -> id of the active rollout it belongs to
+        self._active: dict[str, int] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    # -- loading -----------------------------------------------------------
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with get_db() as db:
+                for row in db.execute('SELECT * FROM rollouts'):
+                    rollout = dict(row)
+                    rollout['advance_stages'] = [
+                        s for s in (row['advance_stages'] or '').split(',') if s
+                    ]
+                    self._rollouts[rollout['id']] = rollout
+                active = [rid for rid, r in self._rollouts.items() if r['status'] in ACTIVE]
+                for rid in active:
+                    self._hosts[rid] = {
+                        row['mac']: dict(row)
+                        for row in db.execute(
+                            'SELECT * FROM rollout_hosts WHERE rollout_id = ?', (rid,)
+                        )
+                    }
+                    for mac in self._hosts[rid]:
+                        self._active[mac] = rid
+            self._loaded = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._rollouts.clear()
+            self._hosts.clear()
+            self._active.clear()
+            self._loaded = False
+
+    # -- operator actions --------------------------------------------------
+
+    def create(self, macs, name: str = '', power: str = 'wol',
+               boot_action: str = 'install', wave_size: int = ROLLOUT_WAVE_SIZE,
+               max_installing: int = ROLLOUT_MAX_INSTALLING,
+               playbook_concurrency: int = ROLLOUT_PLAYBOOK_CONCURRENCY,
+               advance_stages=None) -> dict:
+        """Create a running rollout of *macs*; they are held until admitted.
+
+        Raises:
+            RolloutError: for invalid parameters or MACs, or hosts already in
+                an active rollout.
+        """
+        self._ensure_loaded()
+        macs = [m for m in macs if m]
+        invalid = [m for m in macs if not normalize_mac(m)]
+        if invalid:
+            raise RolloutError(f'invalid MAC: {", ".join(map(str, invalid[:10]))}')
+        # Same form as the iPXE hold check and power actions use
+        macs = list(dict.fromkeys(normalize_mac(m) for m in macs))
+        if not macs:
+            raise RolloutError('no hosts')
+        if power not in POWER_ACTIONS:
+            raise RolloutError(f'power must be one of {", ".join(POWER_ACTIONS)}')
+        if boot_action and boot_action not in BOOT_ACTIONS:
+            raise RolloutError(f'boot_action must be one of {", ".join(BOOT_ACTIONS)}')
+        if wave_size < 1 or max_installing < 1 or playbook_concurrency < 0:
+            raise RolloutError('wave_size and max_installing must be positive')
+        stages = ROLLOUT_ADVANCE_STAGES if advance_stages is None else [
+            s for s in advance_stages if s
+        ]
+        with self._lock:
+            busy = [m for m in macs if m in self._active]
+            if busy:
+                raise RolloutError(f'already in an active rollout: {", ".join(busy[:10])}')
+            if power == 'reboot':
+                missing = [m for m in macs if not getattr(host_registry.get(m), 'ip', '')]
+                if missing:
+                    raise RolloutError(f'no IP known for reboot: {", ".join(missing[:10])}')
+            now = _now()
+            rollout = {
+                'name': name or f'rollout {now}',
+                'status': 'running',
+                'power': power,
+                'boot_action': boot_action or '',
+                'wave_size': wave_size,
+                'max_installing': max_installing,
+                'playbook_concurrency': playbook_concurrency,
+                'advance_stages': stages,
+                'created': now,
+                'updated': now,
+            }
+            hosts = {}
+            for i, mac in enumerate(macs):
+                record = host_registry.get(mac)
+                hosts[mac] = {
+                    'mac': mac,
+                    'ip': record.ip if record else '',
+                    'wave': i // wave_size,
+                    'state': 'pending',
+                    'advanced': 0,
+                    'admitted': None,
+                    'finished': None,
+                    'error': None,
+                }
+            with get_db() as db:
+                cur = db.execute(
+                    """
+                    INSERT INTO rollouts (name, status, power, boot_action, wave_size,
+                        max_installing, playbook_concurrency, advance_stages, created, updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (rollout['name'], 'running', power, rollout['boot_action'], wave_size,
+                     max_installing, playbook_concurrency, ','.join(stages), now, now),
+                )
+                rid = rollout['id'] = cur.lastrowid
+                db.executemany(
+                    """
+                    INSERT INTO rollout_hosts (rollout_id, mac, ip, wave, state, advanced)
+                    VALUES (?, ?, ?, ?, 'pending', 0)
+                    """,
+                    [(rid, h['mac'], h['ip'], h['wave']) for h in hosts.values()],
+                )
+            for h in hosts.values():
+                h['rollout_id'] = rid
+            self._rollouts[rid] = rollout
+            self._hosts[rid] = hosts
+            for mac in hosts:
+                self._active[mac] = rid
+        logging.info(f'Создан rollout {rid} на {len(macs)} хостов, волны по {wave_size}')
+        return self.get(rid)
+
+    def _set_status(self, rid: int, status: str, allowed: tuple) -> dict:
+        self._ensure_loaded()
+        with self._lock:
+            rollout = self._rollouts.get(rid)
+            if rollout is None:
+                raise KeyError(rid)
+            if rollout['status'] not in allowed:
+                raise RolloutError(f'rollout is {rollout["status"]}')
+            now = _now()
+            with get_db() as db:
+                db.execute(
+                    'UPDATE rollouts SET status = ?, updated = ? WHERE id = ?', (status, now, rid)
+                )
+                if status == 'aborted':
+                    db.execute(
+                        "UPDATE rollout_hosts SET state = 'skipped'"
+                        " WHERE rollout_id = ? AND state = 'pending'",
+                        (rid,),
+                    )
+            rollout['status'] = status
+            rollout['updated'] = now
+            if status not in ACTIVE:
+                for host in self._hosts.pop(rid, {}).values():
+                    self._active.pop(host['mac'], None)
+        logging.info(f'Rollout {rid}: {status}')
+        return self.get(rid)
+
+    def pause(self, rid: int) -> dict:
+        """Stop admitting hosts; pending hosts stay held."""
+        return self._set_status(rid, 'paused', ('running',))
+
+    def resume(self, rid: int) -> dict:
+        return self._set_status(rid, 'running', ('paused',))
+
+    def abort(self, rid: int) -> dict:
+        """Stop the rollout; pending hosts are skipped and no longer held."""
+        return self._set_status(rid, 'aborted', ACTIVE)
+
+    # -- reads -------------------------------------------------------------
+
+    def holds(self, mac: str) -> bool:
+        """Whether *mac* waits for admission and must not boot the installer."""
+        self._ensure_loaded()
+        rid = self._active.get(mac)
+        if rid is None:
+            return False
+        host = self._hosts[rid].get(mac)
+        return host is not None and host['state'] == 'pending'
+
+    def list(self) -> list:
+        self._ensure_loaded()
+        return [self._summary(r) for r in sorted(
+            self._rollouts.values(), key=lambda r: r['id'], reverse=True
+        )]
+
+    def get(self, rid: int, with_hosts: bool = False):
+        self._ensure_loaded()
+        rollout = self._rollouts.get(rid)
+        if rollout is None:
+            return None
+        summary = self._summary(rollout)
+        if with_hosts:
+            summary['hosts'] = sorted(self._host_rows(rid), key=lambda h: (h['wave'], h['mac']))
+        return summary
+
+    def _host_rows(self, rid: int) -> list:
+        hosts = self._hosts.get(rid)
+        if hosts is not None:
+            return [dict(h) for h in hosts.values()]
+        with get_db() as db:
+            return [dict(row) for row in db.execute(
+                'SELECT * FROM rollout_hosts WHERE rollout_id = ?', (rid,)
+            )]
+
+    def _summary(self, rollout: dict) -> dict:
+        hosts = self._host_rows(rollout['id'])
+        counts: dict[str, int] = {}
+        for h in hosts:
+            counts[h['state']] = counts.get(h['state'], 0) + 1
+        pending = [h['wave'] for h in hosts if h['state'] == 'pending']
+        return dict(
+            rollout,
+            hosts_total=len(hosts),
+            counts=counts,
+            waves=max((h['wave'] for h in hosts), default=-1) + 1,
+            current_wave=min(pending) if pending else None,
+        )
+
+    # -- progress ----------------------------------------------------------
+
+    def _update_host(self, host: dict, **fields) -> None:
+        assignments = ', '.join(f'{k} = ?' for k in fields)
+        with get_db() as db:
+            db.execute(
+                f'UPDATE rollout_hosts SET {assignments} WHERE rollout_id = ? AND mac = ?',
+                (*fields.values(), host['rollout_id'], host['mac']),
+            )
+        host.update(fields)
+
+    def observe(self, mac: str, stage: str, ip: str = '') -> None:
+        """Record a registration of *mac* at *stage* for its rollout."""
+        self._ensure_loaded()
+        mac = normalize_mac(mac)
+        rid = self._active.get(mac)
+        if rid is None:
+            return
+        with self._lock:
+            host = self._hosts.get(rid, {}).get(mac)
+            if host is None or host['state'] not in ('pending', 'admitted'):
+                return
+            fields = {}
+            if ip and ip != host['ip']:
+                fields['ip'] = ip
+            if stage in INSTALL_DONE_STAGES:
+                fields.update(state='done', advanced=1, finished=_now())
+            elif stage in self._rollouts[rid]['advance_stages'] and not host['advanced']:
+                fields['advanced'] = 1
+            if fields:
+                self._update_host(host, **fields)
+
+    def tick(self) -> dict:
+        """Admit the hosts that fit now; returns admitted count by rollout."""
+        self._ensure_loaded()
+        admitted = {}
+        for rid, rollout in list(self._rollouts.items()):
+            if rollout['status'] == 'running':
+                admitted[rid] = self._advance(rollout)
+        return admitted
+
+    def _advance(self, rollout: dict) -> int:
+        rid = rollout['id']
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            hosts = list(self._hosts.get(rid, {}).values())
+            for h in hosts:
+                if h['state'] == 'admitted' and _age(h['admitted'], now) > ROLLOUT_HOST_TIMEOUT:
+                    self._update_host(h, state='failed', error='timeout', finished=_now())
+                    logging.warning(f'Rollout {rid}: {h["mac"]} не завершил установку вовремя')
+            installing = [h for h in hosts if h['state'] == 'admitted']
+            pending = sorted(
+                (h for h in hosts if h['state'] == 'pending'), key=lambda h: (h['wave'], h['mac'])
+            )
+            if not pending:
+                if not installing:
+                    self._set_status(rid, 'done', ('running',))
+                return 0
+            wave = pending[0]['wave']
+            if any(
+                h['wave'] < wave and h['state'] == 'admitted' and not h['advanced']
+                for h in hosts
+            ):
+                return 0
+            slots = rollout['max_installing'] - len(installing)
+            if rollout['playbook_concurrency']:
+                playbooks = sum(
+                    1 for h in hosts
+                    if h['ip'] and (host_registry.playbook(h['ip']) or ('',))[0] in IN_PROGRESS
+                )
+                slots = min(slots, rollout['playbook_concurrency'] - playbooks)
+            batch = [h for h in pending if h['wave'] == wave][:max(slots, 0)]
+            ts = _now()
+            # Released before the power action so the boot request finds it admitted
+            for h in batch:
+                self._update_host(h, state='admitted', admitted=ts)
+        if not batch:
+            return 0
+        with ThreadPoolExecutor(min(len(batch), ROLLOUT_POWER_PARALLEL)) as executor:
+            errors = list(executor.map(lambda h: self._admit(rollout, h), batch))
+        with self._lock:
+            for h, error in zip(batch, errors):
+                if error:
+                    self._update_host(h, state='failed', error=error, finished=_now())
+        logging.info(f'Rollout {rid}: волна {wave}, допущено {len(batch)} хостов')
+        return len(batch)
+
+    @staticmethod
+    def _admit(rollout: dict, host: dict):
+        """Start the install of *host*; returns an error message on failure."""
+        try:
+            if rollout['boot_action']:
+                boot_state.set_action(host['mac'], rollout['boot_action'])
+            if rollout['power'] == 'wol':
+                wake(host['mac'])
+            elif rollout['power'] == 'reboot':
+                ip = host['ip'] or getattr(host_registry.get(host['mac']), 'ip', '')
+                if not ip:
+                    return 'no IP for reboot'
+                reboot(ip)
+        except Exception as e:
+            logging.error(f'Rollout {rollout["id"]}: не удалось запустить {host["mac"]}: {e}')
+            return str(e)
+        return None
+
+
+controller = RolloutController()
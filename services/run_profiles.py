@@ -0,0 +1,356 @@
+"""Run profiles and the managed fact cache for ``ansible-playbook`` runs.
+
+A profile sets forks, strategy, pipelining and the fact gather subset of a
+run.  They are passed to ``ansible-playbook`` as ``ANSIBLE_*`` environment
+variables, so ``ansible.cfg`` on the server stays untouched and anything a
+profile leaves unset keeps its ``ansible.cfg`` value.  ``default`` and
+``fast`` are built in; profiles saved through the API are stored in
+``run_profiles`` and may override them.  The profile of a run is, in order:
+the one asked for, the one mapped to an inventory group of the host
+(``run_profile_groups``, alphabetically first group wins) and
+``ANSIBLE_RUN_PROFILE``.
+
+With ``ANSIBLE_FACT_CACHE=1`` (off by default) every run uses the
+``jsonfile`` cache plugin in ``ANSIBLE_FACT_CACHE_DIR`` with
+``gathering = smart``, so facts are gathered once per
+``ANSIBLE_FACT_CACHE_TTL`` instead of on every registration.  The facts of a
+host are dropped when it starts a new install.
+
+Every run is recorded in ``playbook_runs`` with its profile, so
+:meth:`RunProfiles.stats` can compare durations across profiles.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from config import DB_PATH
+from db_utils import get_db
+from services.analytics import Rollup
+from services.inventory import inventory as dynamic_inventory
+
+DEFAULT_PROFILE = os.getenv('ANSIBLE_RUN_PROFILE', 'default')
+FACT_CACHE_ENABLED = os.getenv('ANSIBLE_FACT_CACHE', '0') == '1'
+FACT_CACHE_DIR = os.getenv(
+    'ANSIBLE_FACT_CACHE_DIR', os.path.join(os.path.dirname(DB_PATH), 'facts')
+)
+FACT_CACHE_TTL = int(os.getenv('ANSIBLE_FACT_CACHE_TTL', 86400))
+
+BUILTIN_PROFILES = {
+    'default': {},
+    'fast': {
+        'forks': 50,
+        'strategy': 'free',
+        'pipelining': True,
+        'gather_subset': '!all,network',
+    },
+}
+STRATEGIES = ('linear', 'free', 'host_pinned')
+MAX_FORKS = 500
+NAME_RE = re.compile(r'^[\w.-]{1,64}$')
+SUBSET_RE = re.compile(r'^!?[a-z_]+(,!?[a-z_]+)*$')
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class ProfileError(ValueError):
+    """Raised for an invalid profile or profile name."""
+
+
+def validate_profile(data) -> dict:
+    """Return the known settings of *data*, checked and normalized.
+
+    Raises:
+        ProfileError: if a setting has an invalid value.
+    """
+    if not isinstance(data, dict):
+        raise ProfileError('profile must be a JSON object')
+    profile = {}
+    if data.get('forks') is not None:
+        try:
+            forks = int(data['forks'])
+        except (TypeError, ValueError):
+            raise ProfileError('forks must be an integer') from None
+        if not 1 <= forks <= MAX_FORKS:
+            raise ProfileError(f'forks must be between 1 and {MAX_FORKS}')
+        profile['forks'] = forks
+    if data.get('strategy'):
+        if data['strategy'] not in STRATEGIES:
+            raise ProfileError(f'strategy must be one of {", ".join(STRATEGIES)}')
+        profile['strategy'] = data['strategy']
+    if data.get('pipelining') is not None:
+        profile['pipelining'] = bool(data['pipelining'])
+    if data.get('gather_subset'):
+        subset = str(data['gather_subset']).replace(' ', '')
+        if not SUBSET_RE.match(subset):
+            raise ProfileError('gather_subset must look like "!all,network"')
+        profile['gather_subset'] = subset
+    return profile
+
+
+def profile_env(profile: dict) -> dict:
+    """``ANSIBLE_*`` variables for *profile* and the fact cache."""
+    env = {}
+    if 'forks' in profile:
+        env['ANSIBLE_FORKS'] = str(profile['forks'])
+    if 'strategy' in profile:
+        env['ANSIBLE_STRATEGY'] = profile['strategy']
+    if 'pipelining' in profile:
+        env['ANSIBLE_PIPELINING'] = 'True' if profile['pipelining'] else 'False'
+    if 'gather_subset' in profile:
+        env['ANSIBLE_GATHER_SUBSET'] = profile['gather_subset']
+    if FACT_CACHE_ENABLED:
+        env.update(
+            ANSIBLE_GATHERING='smart',
+            ANSIBLE_CACHE_PLUGIN='jsonfile',
+            ANSIBLE_CACHE_PLUGIN_CONNECTION=FACT_CACHE_DIR,
+            ANSIBLE_CACHE_PLUGIN_TIMEOUT=str(FACT_CACHE_TTL),
+        )
+    return env
+
+
+class RunProfiles:
+    """Saved profiles and group mappings, loaded once and written through."""
+
+    def __init__(self):
+        self._profiles: dict[str, dict] = {}
+        self._groups: dict[str, str] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with get_db() as db:
+                for row in db.execute('SELECT name, settings FROM run_profiles'):
+                    self._profiles[row['name']] = json.loads(row['settings'] or '{}')
+                for row in db.execute('SELECT group_name, profile FROM run_profile_groups'):
+                    self._groups[row['group_name']] = row['profile']
+            self._loaded = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._profiles.clear()
+            self._groups.clear()
+            self._loaded = False
+
+    # -- profiles ----------------------------------------------------------
+
+    def profiles(self) -> dict:
+        self._ensure_loaded()
+        return {**BUILTIN_PROFILES, **self._profiles}
+
+    def get(self, name: str):
+        return self.profiles().get(name)
+
+    def save(self, name: str, data) -> dict:
+        """Create or replace profile *name*.
+
+        Raises:
+            ProfileError: for an invalid name or setting.
+        """
+        if not NAME_RE.match(name or ''):
+            raise ProfileError('invalid profile name')
+        profile = validate_profile(data)
+        self._ensure_loaded()
+        with get_db() as db:
+            db.execute(
+                """
+                INSERT INTO run_profiles (name, settings, updated) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    settings = excluded.settings,
+                    updated = excluded.updated
+                """,
+                (name, json.dumps(profile), datetime.datetime.utcnow().strftime(TS_FORMAT)),
+            )
+        self._profiles[name] = profile
+        return profile
+
+    def delete(self, name: str) -> bool:
+        """Delete saved profile *name*; a built-in one of that name shows again.
+
+        Raises:
+            ProfileError: if a group is still mapped to a profile that would vanish.
+        """
+        self._ensure_loaded()
+        if name not in self._profiles:
+            return False
+        used = sorted(g for g, p in self._groups.items() if p == name)
+        if used and name not in BUILTIN_PROFILES:
+            raise ProfileError(f'profile is used by groups: {", ".join(used)}')
+        with get_db() as db:
+            db.execute('DELETE FROM run_profiles WHERE name = ?', (name,))
+        del self._profiles[name]
+        return True
+
+    # -- group mapping -----------------------------------------------------
+
+    def groups(self) -> dict:
+        self._ensure_loaded()
+        return dict(self._groups)
+
+    def set_group(self, group: str, profile: str) -> None:
+        """Map inventory *group* to *profile*, or unmap it when *profile* is empty.
+
+        Raises:
+            ProfileError: if *profile* does not exist.
+        """
+        self._ensure_loaded()
+        with get_db() as db:
+            if not profile:
+                db.execute('DELETE FROM run_profile_groups WHERE group_name = ?', (group,))
+                self._groups.pop(group, None)
+                return
+            if self.get(profile) is None:
+                raise ProfileError(f'unknown profile {profile}')
+            db.execute(
+                """
+                INSERT INTO run_profile_groups (group_name, profile) VALUES (?, ?)
+                ON CONFLICT(group_name) DO UPDATE SET profile = excluded.profile
+                """,
+                (group, profile),
+            )
+        self._groups[group] = profile
+
+    def resolve(self, ip: str, name: str = None) -> tuple[str, dict]:
+        """Return ``(name, settings)`` of the profile for a run triggered for *ip*.
+
+        Raises:
+            ProfileError: if *name* is given and does not exist.
+        """
+        if name:
+            profile = self.get(name)
+            if profile is None:
+                raise ProfileError(f'unknown profile {name}')
+            return name, profile
+        for group, mapped in sorted(self.groups().items()):
+            try:
+                targets, _ = dynamic_inventory.select((), group)
+            except KeyError:
+                continue
+            if any(host == ip or vars.get('ansible_host') == ip for host, vars in targets.items()):
+                profile = self.get(mapped)
+                if profile is not None:
+                    return mapped, profile
+        return DEFAULT_PROFILE, self.get(DEFAULT_PROFILE) or {}
+
+    # -- run statistics ----------------------------------------------------
+
+    @staticmethod
+    def record(ip: str, profile: str, started: str, seconds: float, outcome: str) -> None:
+        with get_db() as db:
+            db.execute(
+                """
+                INSERT INTO playbook_runs (ip, profile, started, seconds, outcome)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (ip, profile, started, seconds, outcome),
+            )
+
+    def stats(self, days: float = 30) -> dict:
+        """Run durations per profile over the last *days*, relative to the default."""
+        since = (
+            datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        ).strftime(TS_FORMAT)
+        rollups: dict[str, Rollup] = {}
+        outcomes: dict[str, dict] = {}
+        with get_db() as db:
+            for row in db.execute(
+                'SELECT profile, seconds, outcome FROM playbook_runs WHERE started >= ?',
+                (since,),
+            ):
+                rollups.setdefault(row['profile'], Rollup()).add(row['seconds'])
+                counts = outcomes.setdefault(row['profile'], {})
+                counts[row['outcome']] = counts.get(row['outcome'], 0) + 1
+        summaries = {name: r.summary() for name, r in sorted(rollups.items())}
+        base = summaries.get(DEFAULT_PROFILE, {}).get('p50')
+        for name, summary in summaries.items():
+            summary['outcomes'] = outcomes[name]
+            summary['p50_vs_default'] = (
+                round(summary['p50'] / base, 2) if base and summary['p50'] is not None else None
+            )
+        return {'since': since, 'default': DEFAULT_PROFILE, 'profiles': summaries}
+
+    @staticmethod
+    def prune(cutoff: str) -> int:
+        with get_db() as db:
+            return db.execute('DELETE FROM playbook_runs WHERE started < ?', (cutoff,)).rowcount
+
+
+class FactCache:
+    """The ``jsonfile`` fact cache directory: one file per inventory hostname."""
+
+    def __init__(self, path: str = FACT_CACHE_DIR, ttl: int = FACT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _file(self, host: str):
+        if not host or host.startswith('.') or '/' in host:
+            return None
+        return os.path.join(self.path, host)
+
+    def hosts(self) -> list:
+        """Cached hosts with the age of their facts, oldest first."""
+        now = time.time()
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return []
+        hosts = []
+        for entry in entries:
+            try:
+                age = now - entry.stat().st_mtime
+            except OSError:
+                continue
+            if entry.is_file():
+                hosts.append({
+                    'host': entry.name,
+                    'age': round(age),
+                    'expired': age > self.ttl,
+                })
+        return sorted(hosts, key=lambda h: -h['age'])
+
+    def invalidate(self, *hosts) -> int:
+        """Drop the facts of inventory *hosts*; returns the number of files removed."""
+        removed = 0
+        for host in set(hosts):
+            path = self._file(host)
+            if path is None:
+                continue
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def invalidate_host(self, mac: str, ip: str) -> int:
+        """Drop the facts of every inventory name of the host with *mac* / *ip*."""
+        names = {ip} if ip else set()
+        try:
+            targets, _ = dynamic_inventory.select((), 'all')
+        except KeyError:
+            targets = {}
+        for host, vars in targets.items():
+            if (ip and vars.get('ansible_host') == ip) or (
+                mac and mac in (vars.get('pxe_mac'), (vars.get('mac') or '').lower())
+            ):
+                names.add(host)
+        removed = self.invalidate(*names)
+        if removed:
+            logging.info(f'Кэш фактов Ansible сброшен для {mac or ip}')
+        return removed
+
+    def prune(self) -> int:
+        """Remove expired fact files; Ansible ignores them but never deletes them."""
+        return self.invalidate(*(h['host'] for h in self.hosts() if h['expired']))
+
+
+profiles = RunProfiles()
+facts = FactCache()
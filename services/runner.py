@@ -0,0 +1,169 @@
+"""Ad-hoc command runner across inventory hosts.
+
+One shell command runs on many hosts through :func:`logtail.build_ssh_command`
+with at most ``parallel`` SSH sessions at a time.  Each host gets its own
+timeout and its output is capped at ``max_output`` bytes (the rest is read
+and dropped so the remote side never blocks).  Results are yielded in
+completion order; :func:`group_results` folds identical answers together so
+hundreds of equal outputs read as one line plus the exceptions.
+
+The runner executes arbitrary commands (on the panel itself for hosts with
+``ansible_connection=local``), so ``/api/run`` is disabled until
+``RUN_TOKEN`` is set and then requires it as a bearer token.
+"""
+
+import os
+import selectors
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from logtail import build_ssh_command
+from services.metrics import ssh_call
+
+RUN_TOKEN = os.getenv('RUN_TOKEN', '')
+RUN_MAX_PARALLEL = int(os.getenv('RUN_MAX_PARALLEL', 64))
+RUN_DEFAULT_PARALLEL = int(os.getenv('RUN_DEFAULT_PARALLEL', 16))
+RUN_MAX_TIMEOUT = float(os.getenv('RUN_MAX_TIMEOUT', 300))
+RUN_DEFAULT_TIMEOUT = float(os.getenv('RUN_DEFAULT_TIMEOUT', 30))
+RUN_MAX_OUTPUT = int(os.getenv('RUN_MAX_OUTPUT', 64 * 1024))
+READ_SIZE = 65536
+
+
+class CommandRun:
+    """One command on a set of hosts; iterate to get per-host results."""
+
+    def __init__(self, command: str, targets: dict, parallel: int = RUN_DEFAULT_PARALLEL,
+                 timeout: float = RUN_DEFAULT_TIMEOUT, max_output: int = RUN_MAX_OUTPUT):
+        self.command = command
+        self.targets = targets
+        self.parallel = max(1, min(parallel, RUN_MAX_PARALLEL))
+        self.timeout = max(1.0, min(timeout, RUN_MAX_TIMEOUT))
+        self.max_output = max(0, min(max_output, RUN_MAX_OUTPUT))
+        self._procs: dict[str, subprocess.Popen] = {}
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(self.parallel, thread_name_prefix='run')
+        try:
+            pending = {
+                executor.submit(self._run_one, host, vars)
+                for host, vars in self.targets.items()
+            }
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # Reached early when the client disconnects from the stream
+            self.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def cancel(self) -> None:
+        """Stop starting new hosts and kill the running sessions."""
+        with self._lock:
+            self._cancelled = True
+            procs = list(self._procs.values())
+        for proc in procs:
+            _kill(proc)
+
+    def _run_one(self, host: str, vars: dict) -> dict:
+        result = {'host': host, 'status': 'error', 'rc': None, 'output': '',
+                  'truncated': False, 'seconds': 0.0}
+        started = time.monotonic()
+        is_local, cmd = build_ssh_command(host, vars, self.command)
+        try:
+            with ssh_call('run') as call:
+                with self._lock:
+                    if self._cancelled:
+                        result['output'] = 'cancelled'
+                        return result
+                    proc = subprocess.Popen(
+                        cmd, shell=is_local, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                        start_new_session=True,
+                    )
+                    self._procs[host] = proc
+                try:
+                    output, truncated, timed_out = self._collect(proc, started)
+                finally:
+                    with self._lock:
+                        self._procs.pop(host, None)
+                result['output'] = output.decode('utf-8', errors='replace')
+                result['truncated'] = truncated
+                if timed_out:
+                    result['status'] = 'timeout'
+                else:
+                    result['rc'] = proc.returncode
+                    result['status'] = 'ok' if proc.returncode == 0 else 'failed'
+                call['ok'] = result['status'] == 'ok'
+        except Exception as e:
+            result['output'] = str(e)
+        result['seconds'] = round(time.monotonic() - started, 3)
+        return result
+
+    def _collect(self, proc: subprocess.Popen, started: float) -> tuple[bytes, bool, bool]:
+        chunks, size, truncated, timed_out = [], 0, False, False
+        deadline = started + self.timeout
+        with selectors.DefaultSelector() as sel:
+            sel.register(proc.stdout, selectors.EVENT_READ)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+                if not sel.select(remaining):
+                    continue
+                data = os.read(proc.stdout.fileno(), READ_SIZE)
+                if not data:
+                    break
+                if size < self.max_output:
+                    chunks.append(data[:self.max_output - size])
+                truncated = truncated or size + len(data) > self.max_output
+                size += len(data)
+        proc.stdout.close()
+        if timed_out:
+            _kill(proc)
+        try:
+            proc.wait(max(deadline - time.monotonic(), 1))
+        except subprocess.TimeoutExpired:
+            _kill(proc)
+            proc.wait()
+            timed_out = True
+        return b''.join(chunks), truncated, timed_out
+
+
+def _kill(proc: subprocess.Popen) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def group_results(results: list) -> list:
+    """Fold results with the same status, exit code and output, largest group first."""
+    groups: dict[tuple, dict] = {}
+    for r in results:
+        key = (r['status'], r['rc'], r['output'])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'status': r['status'], 'rc': r['rc'], 'output': r['output'],
+                'count': 0, 'hosts': [],
+            }
+        group['count'] += 1
+        group['hosts'].append(r['host'])
+    ordered = sorted(groups.values(), key=lambda g: -g['count'])
+    for group in ordered:
+        group['hosts'].sort()
+    return ordered
+
+
+def status_counts(results: list) -> dict:
+    counts: dict[str, int] = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    return counts
@@ -0,0 +1,245 @@
+"""Supervisor for long-lived streaming subprocesses.
+
+Log tailing and journal endpoints spawn ``tail -F``/``journalctl -f`` (usually
+through SSH) and keep them alive for as long as the HTTP response is being
+read.  The supervisor keeps track of every such process, enforces global and
+per-host limits, kills idle or too old streams and always reaps the children
+so that abandoned browser tabs do not leave processes behind.
+"""
+
+import itertools
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from services.metrics import registry, STREAMS_STARTED, STREAMS_REJECTED
+
+STREAM_MAX_TOTAL = int(os.getenv('STREAM_MAX_TOTAL', 64))
+STREAM_MAX_PER_HOST = int(os.getenv('STREAM_MAX_PER_HOST', 8))
+STREAM_IDLE_TIMEOUT = int(os.getenv('STREAM_IDLE_TIMEOUT', 900))
+STREAM_MAX_AGE = int(os.getenv('STREAM_MAX_AGE', 6 * 3600))
+STREAM_REAP_INTERVAL = 10
+
+
+class StreamLimitError(Exception):
+    """Raised when a new stream would exceed configured limits."""
+
+
+class Stream:
+    """Single supervised streaming subprocess."""
+
+    __slots__ = (
+        'id', 'kind', 'host', 'owner', 'command', 'proc',
+        'started', 'last_activity', 'bytes_sent', 'kill_reason', 'released',
+    )
+
+    def __init__(self, stream_id, kind, host, owner, command, proc):
+        self.id = stream_id
+        self.kind = kind
+        self.host = host
+        self.owner = owner
+        self.command = command
+        self.proc = proc
+        self.started = time.time()
+        self.last_activity = self.started
+        self.bytes_sent = 0
+        self.kill_reason = None
+        self.released = False
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'host': self.host,
+            'owner': self.owner,
+            'command': self.command,
+            'pid': self.proc.pid,
+            'started': self.started,
+            'age': round(now - self.started, 1),
+            'idle': round(now - self.last_activity, 1),
+            'bytes_sent': self.bytes_sent,
+        }
+
+
+class StreamSupervisor:
+    """Track streaming subprocesses and make sure they are terminated."""
+
+    def __init__(
+        self,
+        max_total: int = STREAM_MAX_TOTAL,
+        max_per_host: int = STREAM_MAX_PER_HOST,
+        idle_timeout: int = STREAM_IDLE_TIMEOUT,
+        max_age: int = STREAM_MAX_AGE,
+    ):
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._streams: dict[int, Stream] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._reaper = None
+
+    def _start_reaper(self) -> None:
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(
+                target=self._reap_loop, name='stream-reaper', daemon=True
+            )
+            self._reaper.start()
+
+    def spawn(self, kind: str, host: str, owner: str, command, shell: bool = False) -> Stream:
+        """Start *command* as a supervised stream.
+
+        The process is placed in its own session so that the whole pipeline
+        (``ssh``, ``tail``, ``grep``...) can be killed at once.
+
+        Raises:
+            StreamLimitError: if global or per-host limit is reached.
+        """
+        with self._lock:
+            if len(self._streams) >= self.max_total:
+                STREAMS_REJECTED.inc(kind)
+                raise StreamLimitError('too many active streams')
+            per_host = sum(1 for s in self._streams.values() if s.host == host)
+            if per_host >= self.max_per_host:
+                STREAMS_REJECTED.inc(kind)
+                raise StreamLimitError(f'too many active streams for {host}')
+            proc = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                shell=shell,
+                start_new_session=True,
+            )
+            shown = command if isinstance(command, str) else ' '.join(command)
+            if isinstance(command, list) and command and command[0] == 'sshpass':
+                # Never expose passwords in the stream listing
+                shown = ' '.join(command[3:])
+            stream = Stream(next(self._ids), kind, host, owner, shown, proc)
+            self._streams[stream.id] = stream
+        STREAMS_STARTED.inc(kind)
+        self._start_reaper()
+        return stream
+
+    def iter_lines(self, stream: Stream):
+        """Yield output lines of *stream*, updating activity counters."""
+        try:
+            for line in iter(stream.proc.stdout.readline, ''):
+                stream.last_activity = time.time()
+                yield line
+        except ValueError:
+            # stdout was closed while the stream was being killed
+            pass
+        finally:
+            self.release(stream)
+            stream.proc.stdout.close()
+
+    def record_sent(self, stream: Stream, nbytes: int) -> None:
+        stream.bytes_sent += nbytes
+
+    def release(self, stream: Stream, reason: str = '') -> None:
+        """Kill the process group of *stream* and reap it.
+
+        Safe to call several times; only the first call does the work.
+        """
+        with self._lock:
+            if stream.released:
+                return
+            stream.released = True
+            self._streams.pop(stream.id, None)
+        stream.kill_reason = reason
+        _kill_process_group(stream.proc)
+        if stream.kill_reason:
+            logging.info(
+                f'Поток {stream.id} ({stream.kind} {stream.host}) остановлен: '
+                f'{stream.kill_reason}'
+            )
+
+    def kill(self, stream_id: int, reason: str = 'killed by operator') -> bool:
+        with self._lock:
+            stream = self._streams.get(stream_id)
+        if not stream:
+            return False
+        self.release(stream, reason)
+        return True
+
+    def release_all(self, reason: str = 'server shutdown') -> None:
+        """Kill every active stream, e.g. when the worker exits."""
+        with self._lock:
+            streams = list(self._streams.values())
+        for stream in streams:
+            self.release(stream, reason)
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            streams = list(self._streams.values())
+        return [s.to_dict() for s in streams]
+
+    def count(self) -> int:
+        return len(self._streams)
+
+    def reap(self) -> None:
+        """Kill idle and over-age streams and release exited processes."""
+        now = time.time()
+        with self._lock:
+            streams = list(self._streams.values())
+        for stream in streams:
+            if stream.proc.poll() is not None:
+                self.release(stream)
+            elif self.max_age and now - stream.started > self.max_age:
+                self.release(stream, 'max age exceeded')
+            elif self.idle_timeout and now - stream.last_activity > self.idle_timeout:
+                self.release(stream, 'idle timeout')
+
+    def _reap_loop(self) -> None:
+        while True:
+            time.sleep(STREAM_REAP_INTERVAL)
+            try:
+                self.reap()
+            except Exception as e:
+                logging.error(f'Ошибка при очистке потоков: {e}', exc_info=True)
+
+
+def _kill_process_group(proc: subprocess.Popen, timeout: float = 3) -> None:
+    """Terminate process group of *proc*, escalating to SIGKILL, and wait."""
+    if proc.poll() is not None:
+        # Leader is gone but pipeline members may still be alive
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    else:
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                break
+            except PermissionError:
+                proc.send_signal(sig)
+            try:
+                proc.wait(timeout=timeout)
+                break
+            except subprocess.TimeoutExpired:
+                continue
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logging.warning(f'Процесс {proc.pid} не завершился после SIGKILL')
+
+
+supervisor = StreamSupervisor()
+
+
+def _active_streams() -> dict:
+    counts: dict[tuple, int] = {}
+    for s in supervisor.list():
+        counts[(s['kind'],)] = counts.get((s['kind'],), 0) + 1
+    return counts
+
+
+registry.gauge('pxe_streams_active', 'Active log streams by kind', _active_streams, ('kind',))
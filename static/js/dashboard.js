@@ -49,12 +49,18 @@
     document.addEventListener('DOMContentLoaded', () => {
         updatePortainerLinks();
     });
+    // ETags of loaded files, sent back as If-Match when saving
+    const fileEtags = {};
+    async function fetchText(apiUrl) {
+      const res = await fetch(apiUrl);
+      if (!res.ok) throw new Error(`HTTP ${res.status}`);
+      fileEtags[apiUrl] = res.headers.get('ETag');
+      return res.text();
+    }
     async function openModalWithContent(modalId, apiUrl, contentElementId, isPlaybook = false) {
       const modal = document.getElementById(modalId);
       try {
-        const res = await fetch(apiUrl);
-        if (!res.ok) throw new Error();
-        const content = await res.text();
+        const content = await fetchText(apiUrl);
         if (isPlaybook && playbookEditor) {
           playbookEditor.setValue(content);
           setTimeout(() => playbookEditor.refresh(), 100);
@@ -74,12 +80,13 @@
         const content = isPlaybook && playbookEditor
           ? playbookEditor.getValue()
           : document.getElementById(contentElementId).value;
-        const res = await fetch(apiUrl, {
-          method: 'POST',
-          headers: { 'Content-Type': 'text/plain' },
-          body: content
-        });
-        if (!res.ok) throw new Error((await res.json()).msg);
+        const headers = { 'Content-Type': 'text/plain' };
+        if (fileEtags[apiUrl]) headers['If-Match'] = fileEtags[apiUrl];
+        const res = await fetch(apiUrl, { method: 'POST', headers, body: content });
+        if (res.status === 412) throw new Error('файл был изменён другим пользователем, перезагрузите его');
+        const data = await res.json();
+        if (!res.ok) throw new Error(data.msg);
+        if (data.etag) fileEtags[apiUrl] = `"${data.etag}"`;
         alert('Сохранено.');
         if (successCallback) successCallback();
       } catch (e) {
@@ -146,8 +153,7 @@
         setIpxeEdit(true);
       } else {
         setIpxeEdit(false);
-        const res = await fetch('/api/ipxe');
-        textarea.value = await res.text();
+        textarea.value = await fetchText('/api/ipxe');
       }
     };
 
@@ -157,8 +163,7 @@
         setDnsmasqEdit(true);
       } else {
         setDnsmasqEdit(false);
-        const res = await fetch('/api/dnsmasq');
-        textarea.value = await res.text();
+        textarea.value = await fetchText('/api/dnsmasq');
       }
     };
 
@@ -188,8 +193,7 @@
     async function loadPreseedContent() {
       const name = document.getElementById('preseed-select').value;
       if (!name) return;
-      const res = await fetch(`/api/preseed?name=${encodeURIComponent(name)}`);
-      const text = await res.text();
+      const text = await fetchText(`/api/preseed?name=${encodeURIComponent(name)}`);
       document.getElementById('preseed-content').value = text;
     }
 
@@ -277,48 +281,63 @@
     };
     let currentFilesPath = '';
     const baseFilesPath = document.getElementById('files-modal-title').textContent.replace(/^Файлы\s*/, '');
-    async function loadFilesList() {
+    function appendFileRow(listBody, file) {
+        const tr = document.createElement('tr');
+        const escapedName = file.name.replace(/&/g, "&amp;").replace(/</g, "<").replace(/>/g, ">").replace(/"/g, "&quot;").replace(/'/g, "&#039;");
+        if (file.is_dir) {
+            tr.innerHTML = `<td title="${escapedName}" style="cursor:pointer">${escapedName}</td><td>-</td><td>${file.modified}</td>`;
+            tr.querySelector('td').onclick = () => {
+                currentFilesPath = currentFilesPath ? `${currentFilesPath}/${file.name}` : file.name;
+                loadFilesList();
+            };
+        } else {
+            tr.innerHTML = `<td title="${escapedName}">${escapedName}</td><td>${file.size}</td><td>${file.modified}</td>`;
+        }
+        listBody.appendChild(tr);
+    }
+    function appendMoreRow(listBody, cursor) {
+        const moreTr = document.createElement('tr');
+        moreTr.innerHTML = '<td colspan="3" style="text-align: center; cursor:pointer">Показать ещё...</td>';
+        moreTr.onclick = () => {
+            moreTr.remove();
+            loadFilesList(cursor);
+        };
+        listBody.appendChild(moreTr);
+    }
+    async function loadFilesList(cursor = '') {
         const listBody = document.getElementById('files-simple-list-body');
-        listBody.innerHTML = '<tr><td colspan="3" style="text-align: center;">Загрузка...</td></tr>';
+        if (!cursor) listBody.innerHTML = '<tr><td colspan="3" style="text-align: center;">Загрузка...</td></tr>';
         try {
-            const res = await fetch(`/api/ansible/files?path=${encodeURIComponent(currentFilesPath)}`);
+            let url = `/api/ansible/files?path=${encodeURIComponent(currentFilesPath)}`;
+            if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+            const res = await fetch(url);
             const data = await res.json();
-            listBody.innerHTML = '';
             if (data.error) {
                 listBody.innerHTML = `<tr><td colspan="3" style="color:var(--danger);">Ошибка: ${data.error}</td></tr>`;
                 return;
             }
-            const title = document.getElementById('files-modal-title');
-            title.textContent = `Файлы ${baseFilesPath}${currentFilesPath ? '/' + currentFilesPath : ''}`;
-            if (currentFilesPath) {
-                const upTr = document.createElement('tr');
-                upTr.innerHTML = '<td colspan="3" style="cursor:pointer">..</td>';
-                upTr.onclick = () => {
-                    currentFilesPath = data.parent;
-                    loadFilesList();
-                };
-                listBody.appendChild(upTr);
-            }
-            if (data.files.length === 0) {
-                const emptyTr = document.createElement('tr');
-                emptyTr.innerHTML = '<td colspan="3" style="text-align: center; font-style: italic;">Файлы не найдены</td>';
-                listBody.appendChild(emptyTr);
-                return;
-            }
-            data.files.forEach(file => {
-                const tr = document.createElement('tr');
-                const escapedName = file.name.replace(/&/g, "&amp;").replace(/</g, "<").replace(/>/g, ">").replace(/"/g, "&quot;").replace(/'/g, "&#039;");
-                if (file.is_dir) {
-                    tr.innerHTML = `<td title="${escapedName}" style="cursor:pointer">${escapedName}</td><td>-</td><td>${file.modified}</td>`;
-                    tr.querySelector('td').onclick = () => {
-                        currentFilesPath = currentFilesPath ? `${currentFilesPath}/${file.name}` : file.name;
+            if (!cursor) {
+                listBody.innerHTML = '';
+                const title = document.getElementById('files-modal-title');
+                title.textContent = `Файлы ${baseFilesPath}${currentFilesPath ? '/' + currentFilesPath : ''}`;
+                if (currentFilesPath) {
+                    const upTr = document.createElement('tr');
+                    upTr.innerHTML = '<td colspan="3" style="cursor:pointer">..</td>';
+                    upTr.onclick = () => {
+                        currentFilesPath = data.parent;
                         loadFilesList();
                     };
-                } else {
-                    tr.innerHTML = `<td title="${escapedName}">${escapedName}</td><td>${file.size}</td><td>${file.modified}</td>`;
+                    listBody.appendChild(upTr);
+                }
+                if (data.files.length === 0) {
+                    const emptyTr = document.createElement('tr');
+                    emptyTr.innerHTML = '<td colspan="3" style="text-align: center; font-style: italic;">Файлы не найдены</td>';
+                    listBody.appendChild(emptyTr);
+                    return;
                 }
-                listBody.appendChild(tr);
-            });
+            }
+            data.files.forEach(file => appendFileRow(listBody, file));
+            if (data.next_cursor) appendMoreRow(listBody, data.next_cursor);
         } catch (e) {
             console.error("Ошибка при загрузке списка файлов:", e);
             listBody.innerHTML = `<tr><td colspan="3" style="color:var(--danger);">Ошибка загрузки: ${e.message}</td></tr>`;
@@ -329,12 +348,25 @@
         openModal(document.getElementById('files-modal'));
         loadFilesList();
     };
-    document.getElementById('add-dhcp-host').onclick = () => {
+    document.getElementById('add-dhcp-host').onclick = async () => {
       const mac = prompt('MAC:');
       const ip = prompt('IP:');
-      if (mac && ip) {
-        const textarea = document.getElementById('dnsmasq-content');
-        textarea.value = `dhcp-host=${mac},${ip},12h\n${textarea.value}`;
+      if (!mac || !ip) return;
+      const hostname = prompt('Имя хоста (необязательно):') || '';
+      try {
+        const res = await fetch('/api/dhcp/reservations', {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ mac, ip, hostname })
+        });
+        const data = await res.json();
+        if (data.status === 'ok') {
+          alert('Резервация добавлена, dnsmasq перечитает её без перезапуска.');
+        } else {
+          alert(`Ошибка: ${data.msg}`);
+        }
+      } catch (e) {
+        alert(`Ошибка: ${e.message}`);
       }
     };
     document.getElementById('clear-db').onclick = async () => {
@@ -374,6 +406,31 @@
     }
 
     setInterval(loadAnsibleLog, 3000);
+    async function loadBootDownloads() {
+      try {
+        const res = await fetch('/api/boot/downloads');
+        const data = await res.json();
+        if (!data.enabled) return;
+        document.querySelectorAll('#hosts-table-body .boot-download').forEach(el => el.remove());
+        data.clients.forEach(c => {
+          if (!c.active) return;
+          const row = (c.mac && document.querySelector(`#hosts-table-body tr[data-mac="${c.mac}"]`))
+            || document.querySelector(`#hosts-table-body tr[data-ip="${c.ip}"]`);
+          if (!row) return;
+          const span = document.createElement('span');
+          span.className = 'boot-download';
+          span.textContent = ` ⬇ ${c.current} (${(c.bytes / 1048576).toFixed(1)} MB)`;
+          // sendfile transfers are counted only when they finish
+          span.title = c.sending ? `Отправка через sendfile, ${c.idle} с` : `Без активности ${c.idle} с`;
+          if (c.idle > 60 && !c.sending) span.style.color = '#ff6b6b';
+          row.cells[2].appendChild(span);
+        });
+      } catch (e) {
+        console.error('Ошибка загрузки статистики скачивания:', e);
+      }
+    }
+
+    setInterval(loadBootDownloads, 5000);
     const ansibleLogEl = document.getElementById('ansible-log');
     ansibleLogEl.addEventListener('scroll', () => {
       const atBottom = ansibleLogEl.scrollTop + ansibleLogEl.clientHeight >= ansibleLogEl.scrollHeight - 5;
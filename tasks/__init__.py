@@ -1,58 +1,143 @@
-import threading
-import time
+import datetime
+import os
 import subprocess
-import logging
 import re
+import time
+
+from db_utils import get_db
+from services import set_playbook_status, sync_inventory_hosts
+from services.boot import state as boot_state
+from services.dnsmasq import ingestor as dnsmasq_ingestor
+from services.dhcp import applier as dhcp_applier
+from services.analytics import analytics as install_analytics
+from services.hosts import is_early_stage, registry as host_registry
+from services.rollout import ROLLOUT_TICK_INTERVAL, controller as rollouts
+from services.run_profiles import facts as fact_cache, profiles as run_profiles
+from .scheduler import scheduler
 
-from services import set_playbook_status
+INVENTORY_SYNC_INTERVAL = int(os.getenv('TASKS_INVENTORY_SYNC_INTERVAL', 60))
+LIVENESS_INTERVAL = int(os.getenv('TASKS_LIVENESS_INTERVAL', 60))
+RETENTION_INTERVAL = int(os.getenv('TASKS_RETENTION_INTERVAL', 3600))
+RETENTION_DAYS = int(os.getenv('TASKS_RETENTION_DAYS', 30))
+DHCP_REFRESH_INTERVAL = int(os.getenv('TASKS_DHCP_REFRESH_INTERVAL', 300))
+# Only needed with several workers; 0 disables the job
+HOST_REGISTRY_RELOAD_INTERVAL = int(os.getenv('TASKS_HOST_REGISTRY_RELOAD_INTERVAL', 0))
 
 # Ensure background threads start only once
 _tasks_started = False
 
 
 def ansible_log_monitor() -> None:
-    """Tail Ansible service logs and update playbook status by host."""
+    """Tail Ansible service logs and update playbook status by host.
+
+    Returns when ``journalctl`` exits; the scheduler restarts it.
+    """
     pattern = re.compile(
         r"(?P<ip>(?:\d{1,3}\.){3}\d{1,3})\s*:\s*(?P<stats>.*)"
     )
-    while True:
-        cmd = [
-            "journalctl",
-            "-u",
-            "ansible-api.service",
-            "-f",
-            "--no-pager",
-            "-n",
-            "0",
-            "-o",
-            "cat",
-        ]
-        try:
-            proc = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
-            )
-            for line in iter(proc.stdout.readline, ""):
-                clean = re.sub(r"\x1b\[[0-9;]*m", "", line)
-                m = pattern.search(clean)
-                if not m:
-                    continue
-                ip = m.group("ip")
-                stats = dict(re.findall(r"(\w+)=(\d+)", m.group("stats")))
-                failed = int(stats.get("failed", 0))
-                unreachable = int(stats.get("unreachable", 0))
-                status = "ok" if failed == 0 and unreachable == 0 else "failed"
-                set_playbook_status(ip, status)
-        except Exception as e:
-            logging.error(
-                f"Ошибка в анализе логов Ansible: {e}", exc_info=True
-            )
-            time.sleep(5)
+    cmd = [
+        "journalctl",
+        "-u",
+        "ansible-api.service",
+        "-f",
+        "--no-pager",
+        "-n",
+        "0",
+        "-o",
+        "cat",
+    ]
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    try:
+        for line in iter(proc.stdout.readline, ""):
+            clean = re.sub(r"\x1b\[[0-9;]*m", "", line)
+            m = pattern.search(clean)
+            if not m:
+                continue
+            ip = m.group("ip")
+            stats = dict(re.findall(r"(\w+)=(\d+)", m.group("stats")))
+            failed = int(stats.get("failed", 0))
+            unreachable = int(stats.get("unreachable", 0))
+            status = "ok" if failed == 0 and unreachable == 0 else "failed"
+            set_playbook_status(ip, status)
+    finally:
+        proc.kill()
+        proc.wait()
+    if proc.returncode:
+        raise RuntimeError(f"journalctl завершился с кодом {proc.returncode}")
+
+
+def host_liveness() -> dict:
+    """Count hosts seen within ``ONLINE_TIMEOUT`` and hosts stuck at PXE stages."""
+    now = time.time()
+    total = online = stuck = 0
+    for record in host_registry.all():
+        total += 1
+        if record.online(now):
+            online += 1
+        elif record.stage and is_early_stage(record.stage):
+            stuck += 1
+    return {"total": total, "online": online, "stuck_in_pxe": stuck}
+
+
+def retention() -> dict:
+    """Drop boot actions, playbook results, raw analytics and run durations older
+    than the retention, and expired cached facts.
+
+    Runs in the leader only, so only the leader's in-memory boot actions and
+    host registry are refreshed.  With several workers the others keep
+    serving dropped boot actions until they restart.
+    """
+    cutoff = (
+        datetime.datetime.utcnow() - datetime.timedelta(days=RETENTION_DAYS)
+    ).strftime("%Y-%m-%d %H:%M:%S")
+    with get_db() as db:
+        actions = db.execute(
+            "DELETE FROM boot_actions WHERE created < ?", (cutoff,)
+        ).rowcount
+        statuses = db.execute(
+            "DELETE FROM playbook_status WHERE updated < ?"
+            " AND ip NOT IN (SELECT ip FROM hosts WHERE ip IS NOT NULL)",
+            (cutoff,),
+        ).rowcount
+    if actions:
+        boot_state.reset()
+    if statuses:
+        host_registry.reload()
+    analytics = install_analytics.prune(cutoff)
+    runs = run_profiles.prune(cutoff)
+    facts = fact_cache.prune()
+    return {
+        "boot_actions": actions,
+        "playbook_status": statuses,
+        "analytics": analytics,
+        "playbook_runs": runs,
+        "expired_facts": facts,
+    }
 
 
 def start_background_tasks() -> None:
-    """Start all background threads."""
+    """Register and start background jobs.
+
+    Each process runs the scheduler; singleton jobs only run in the process
+    that holds the leader lock.
+    """
     global _tasks_started
     if _tasks_started:
         return
     _tasks_started = True
-    threading.Thread(target=ansible_log_monitor, daemon=True).start()
+    scheduler.add("ansible_log_monitor", ansible_log_monitor)
+    scheduler.add("dnsmasq_ingest", dnsmasq_ingestor.run_forever)
+    scheduler.add("inventory_sync", sync_inventory_hosts, INVENTORY_SYNC_INTERVAL)
+    # Applied in the job itself so render and reload failures reach task_status
+    scheduler.add("dhcp_reservations", dhcp_applier.apply, DHCP_REFRESH_INTERVAL)
+    scheduler.add("host_liveness", host_liveness, LIVENESS_INTERVAL)
+    scheduler.add("retention", retention, RETENTION_INTERVAL)
+    scheduler.add("rollout_admit", rollouts.tick, ROLLOUT_TICK_INTERVAL)
+    if HOST_REGISTRY_RELOAD_INTERVAL > 0:
+        scheduler.add(
+            "host_registry_reload", host_registry.reload,
+            HOST_REGISTRY_RELOAD_INTERVAL, singleton=False,
+        )
+    scheduler.start()
@@ -0,0 +1,247 @@
+"""Background job scheduler with a single leader across worker processes.
+
+Every worker process runs a :class:`Scheduler`, but singleton jobs only run
+in the process holding an exclusive ``flock`` on ``TASKS_LOCK_PATH``.  The
+kernel drops the lock when the leader exits, and another worker picks it up
+within ``LEADER_RETRY`` seconds.  Failed or exited jobs are restarted with
+exponential backoff and jitter.  Run statistics are written to the
+``task_status`` table so ``/api/tasks`` shows the same view from any worker.
+"""
+
+import datetime
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from config import DB_PATH
+from db_utils import get_db
+from services.metrics import registry
+from services.profiling import current_runner, profiler
+
+TASKS_LOCK_PATH = os.getenv('TASKS_LOCK_PATH', DB_PATH + '.tasks.lock')
+LEADER_RETRY = float(os.getenv('TASKS_LEADER_RETRY', 5))
+BACKOFF_BASE = float(os.getenv('TASKS_BACKOFF_BASE', 1))
+BACKOFF_MAX = float(os.getenv('TASKS_BACKOFF_MAX', 300))
+JITTER = float(os.getenv('TASKS_JITTER', 0.1))
+
+
+def _now() -> str:
+    return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class Job:
+    """A periodic job (``interval`` seconds) or a long-running one (``None``)."""
+
+    def __init__(self, name: str, func, interval: float = None, singleton: bool = True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.singleton = singleton
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.running = False
+        self.last_start = None
+        self.last_end = None
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.last_error = None
+        self.last_result = None
+        self.next_run = None
+        # Thread ident or greenlet running the job, for sampling profiles
+        self.runner = None
+
+    def backoff(self) -> float:
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** max(0, self.consecutive_failures - 1))
+        return _jitter(delay)
+
+
+def _jitter(delay: float) -> float:
+    return max(0.0, delay * (1 + random.uniform(-JITTER, JITTER)))
+
+
+class LeaderLock:
+    """Exclusive ``flock`` held for the lifetime of the leader process."""
+
+    def __init__(self, path: str = TASKS_LOCK_PATH):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f'{os.getpid()}\n'.encode())
+        self._fd = fd
+        return True
+
+    def leader_pid(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+
+class Scheduler:
+    def __init__(self, lock: LeaderLock = None):
+        self.lock = lock or LeaderLock()
+        self.jobs: dict[str, Job] = {}
+        self._leader = threading.Event()
+        self._started = False
+
+    def add(self, name: str, func, interval: float = None, singleton: bool = True) -> Job:
+        job = self.jobs[name] = Job(name, func, interval, singleton)
+        return job
+
+    def start(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._elect, name='tasks-leader', daemon=True).start()
+        for job in self.jobs.values():
+            threading.Thread(
+                target=self._run_job, args=(job,), name=f'task-{job.name}', daemon=True
+            ).start()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader.is_set()
+
+    def _elect(self) -> None:
+        while not self._leader.is_set():
+            try:
+                if self.lock.try_acquire():
+                    logging.info(f'Процесс {os.getpid()} выполняет фоновые задачи')
+                    self._leader.set()
+                    return
+            except OSError as e:
+                logging.error(f'Ошибка блокировки {self.lock.path}: {e}')
+            time.sleep(_jitter(LEADER_RETRY))
+
+    def _run_job(self, job: Job) -> None:
+        job.runner = current_runner()
+        if job.singleton:
+            self._leader.wait()
+        if job.interval:
+            # Spread periodic jobs so they do not all start at once
+            time.sleep(random.uniform(0, min(job.interval, 5)))
+        while True:
+            job.running = True
+            job.last_start = _now()
+            self._save(job)
+            started = time.monotonic()
+            try:
+                job.last_result = profiler.run_task(job.name, job.func)
+                job.last_error = None
+                job.consecutive_failures = 0
+            except Exception as e:
+                job.failures += 1
+                job.consecutive_failures += 1
+                job.last_error = str(e)
+                logging.error(f'Ошибка в задаче {job.name}: {e}', exc_info=True)
+            job.runs += 1
+            job.running = False
+            job.last_duration = round(time.monotonic() - started, 3)
+            job.total_duration += job.last_duration
+            job.last_end = _now()
+
+            if job.consecutive_failures:
+                delay = job.backoff()
+            elif job.interval:
+                delay = _jitter(job.interval)
+            else:
+                # A long-running job is not expected to return; restart it
+                job.consecutive_failures += 1
+                delay = job.backoff()
+                logging.warning(f'Задача {job.name} завершилась, перезапуск через {delay:.1f} с')
+            job.next_run = (
+                datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+            ).strftime('%Y-%m-%d %H:%M:%S')
+            self._save(job)
+            time.sleep(delay)
+
+    def _save(self, job: Job) -> None:
+        try:
+            with get_db() as db:
+                db.execute(
+                    """
+                    INSERT INTO task_status(
+                        name, pid, running, runs, failures, last_start, last_end,
+                        last_duration, avg_duration, last_error, last_result,
+                        next_run, updated
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET
+                        pid = excluded.pid,
+                        running = excluded.running,
+                        runs = excluded.runs,
+                        failures = excluded.failures,
+                        last_start = excluded.last_start,
+                        last_end = excluded.last_end,
+                        last_duration = excluded.last_duration,
+                        avg_duration = excluded.avg_duration,
+                        last_error = excluded.last_error,
+                        last_result = excluded.last_result,
+                        next_run = excluded.next_run,
+                        updated = excluded.updated
+                    """,
+                    (
+                        job.name, os.getpid(), int(job.running), job.runs, job.failures,
+                        job.last_start, job.last_end, job.last_duration,
+                        round(job.total_duration / job.runs, 3) if job.runs else None,
+                        job.last_error,
+                        json.dumps(job.last_result, default=str) if job.last_result is not None else None,
+                        job.next_run, _now(),
+                    ),
+                )
+        except Exception as e:
+            logging.warning(f'Не удалось сохранить состояние задачи {job.name}: {e}')
+
+    def status(self) -> dict:
+        with get_db() as db:
+            rows = db.execute('SELECT * FROM task_status ORDER BY name').fetchall()
+        jobs = []
+        for row in rows:
+            item = dict(row)
+            item['running'] = bool(item['running'])
+            item['last_result'] = json.loads(item['last_result']) if item['last_result'] else None
+            job = self.jobs.get(row['name'])
+            if job is not None:
+                item['interval'] = job.interval
+            jobs.append(item)
+        return {
+            'pid': os.getpid(),
+            'leader': self.is_leader,
+            'leader_pid': self.lock.leader_pid(),
+            'jobs': jobs,
+        }
+
+
+scheduler = Scheduler()
+
+
+def _job_gauge(attr):
+    return lambda: {(job.name,): float(getattr(job, attr) or 0) for job in scheduler.jobs.values()}
+
+
+registry.gauge('pxe_task_leader', 'Whether this process runs singleton jobs',
+               lambda: {(): float(scheduler.is_leader)})
+registry.gauge('pxe_task_runs', 'Completed runs of background jobs', _job_gauge('runs'), ('job',))
+registry.gauge('pxe_task_failures', 'Failed runs of background jobs', _job_gauge('failures'), ('job',))
+registry.gauge('pxe_task_running', 'Whether a background job is running', _job_gauge('running'), ('job',))
+registry.gauge('pxe_task_last_duration_seconds', 'Duration of the last job run',
+               _job_gauge('last_duration'), ('job',))
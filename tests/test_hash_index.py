@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GEVENT_SCRIPT = textwrap.dedent('''
+    import sys
+    from gevent import monkey
+    monkey.patch_all()
+
+    from services import hash_index
+
+    real_ident = monkey.get_original('_thread', 'get_ident')
+    hashed_in = set()
+    hash_file = hash_index.hash_file
+
+
+    def recording_hash_file(path):
+        hashed_in.add(real_ident())
+        return hash_file(path)
+
+
+    hash_index.hash_file = recording_hash_file
+    result = hash_index.update_index(sys.argv[1], workers=2)
+    assert result['hashed'] == 3, result
+    assert real_ident() not in hashed_in, 'hashed on the gevent hub thread'
+    deep = hash_index.verify_tree(sys.argv[1], deep=True)
+    assert deep['corrupt'] == [], deep
+''')
+
+
+def test_hashes_in_os_threads_under_gevent(tmp_path):
+    files = tmp_path / 'files'
+    files.mkdir()
+    for i in range(3):
+        (files / f'f{i}.bin').write_bytes(os.urandom(1024) * (i + 1))
+    env = dict(os.environ, PYTHONPATH=ROOT, DB_PATH=str(tmp_path / 'pxe.db'))
+    result = subprocess.run(
+        [sys.executable, '-c', GEVENT_SCRIPT, str(files)],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
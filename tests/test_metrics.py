@@ -0,0 +1,36 @@
+import threading
+
+from services import metrics
+
+
+def test_threads_spread_across_shards():
+    indexes = set()
+    barrier = threading.Barrier(metrics.SHARDS)
+
+    def record():
+        # Keep every thread alive until all have picked a shard
+        indexes.add(metrics._shard_index())
+        barrier.wait()
+
+    threads = [threading.Thread(target=record) for _ in range(metrics.SHARDS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(indexes) == metrics.SHARDS
+
+
+def test_counter_merges_shards():
+    counter = metrics.Counter('test_total', 'test', ('kind',))
+
+    def record():
+        for _ in range(100):
+            counter.inc('a')
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert counter.collect() == {('a',): 800}
+    assert sum(1 for values, _ in counter._shards if values) == 8
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter, monkey-patching cannot be undone
+GEVENT_SCRIPT = textwrap.dedent('''
+    from gevent import monkey
+    monkey.patch_all()
+
+    import time
+
+    from services.profiling import profiler
+    from tasks.scheduler import Scheduler
+
+
+    def ansible_log_monitor():
+        while True:
+            time.sleep(0.001)
+
+
+    scheduler = Scheduler()
+    job = scheduler.add('ansible_log_monitor', ansible_log_monitor, singleton=False)
+    scheduler._save = lambda job: None
+    scheduler.start()
+    time.sleep(0.1)
+    session = profiler.start('task:ansible_log_monitor', seconds=5, limit=20, runner=job.runner)
+    while session.finished is None:
+        time.sleep(0.01)
+    assert session.reason == 'limit', session.reason
+    print(profiler.collapsed())
+''')
+
+
+def test_sample_long_running_job_under_gevent(tmp_path):
+    env = dict(os.environ, PYTHONPATH=ROOT, DB_PATH=str(tmp_path / 'pxe.db'))
+    result = subprocess.run(
+        [sys.executable, '-c', GEVENT_SCRIPT],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    assert '(ansible_log_monitor)' in result.stdout
@@ -1,31 +1,22 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, Response, render_template
 import datetime
 
 from config import LOCAL_OFFSET, ANSIBLE_FILES_DIR
-from db_utils import get_db
 from services import sync_inventory_hosts
+from services.hosts import registry as host_registry
+from services.metrics import registry
 
 web_bp = Blueprint('web', __name__)
 
 @web_bp.route('/')
 def dashboard():
     sync_inventory_hosts()
-    db = get_db()
-    rows = db.execute('''
-        SELECT h.mac, h.ip, h.ts
-        FROM hosts h
-        INNER JOIN (
-            SELECT mac, MAX(ts) AS last_ts FROM hosts GROUP BY mac
-        ) grp
-        ON h.mac = grp.mac AND h.ts = grp.last_ts
-        ORDER BY ts DESC
-    ''').fetchall()
     hosts = []
-    for mac, ip, ts_utc in rows:
-        last_seen = datetime.datetime.fromisoformat(ts_utc) + LOCAL_OFFSET
+    for record in host_registry.all():
+        last_seen = datetime.datetime.fromisoformat(record.ts) + LOCAL_OFFSET
         hosts.append({
-            'mac': mac,
-            'ip': ip or '—',
+            'mac': record.mac,
+            'ip': record.ip or '—',
             'last': last_seen.strftime('%H:%M:%S'),
         })
     return render_template(
@@ -33,3 +24,9 @@ def dashboard():
         hosts=hosts,
         ansible_files_path=ANSIBLE_FILES_DIR,
     )
+
+
+@web_bp.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint."""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')